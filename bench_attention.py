@@ -0,0 +1,87 @@
+import argparse
+import multiprocessing as mp
+import resource
+import time
+import torch
+from torch_attention import Multihead_Attention
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--max_len', type=int, default=720,
+                        help='sequence length')
+    parser.add_argument('--batch', type=int, default=32,
+                        help='batch size')
+    parser.add_argument('--n_units', type=int, default=256,
+                        help='attention size')
+    parser.add_argument('--n_head', type=int, default=4,
+                        help='attention head size')
+    parser.add_argument('--causality', action='store_true',
+                        help='mask future steps')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='timed iterations')
+    parser.add_argument('--disable_cuda', action='store_true',
+                        help='Disable CUDA')
+    return parser.parse_args()
+
+
+def measure(args, fused, queue):
+    if torch.cuda.is_available() and not args.disable_cuda:
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+    torch.manual_seed(23333)
+    model = Multihead_Attention(args.n_units, num_heads=args.n_head, dropout=0.1, causality=args.causality,
+                                fused=fused).to(device)
+    x = torch.randn(args.batch, args.max_len, args.n_units, device=device)
+    # 随机长度，保留padding部分为0
+    lengths = torch.randint(1, args.max_len + 1, (args.batch,), device=device)
+    x = x * (torch.arange(args.max_len, device=device)[None, :] < lengths[:, None]).unsqueeze(-1).float()
+    # ru_maxrss 是进程的最高水位，基线必须在第一次前向之前取，否则计时阶段的新增峰值约为0
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    model.eval()
+    with torch.no_grad():
+        reference = model(x)
+    model.train()
+    model(x).sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+    start_t = time.time()
+    for _ in range(args.repeat):
+        model.zero_grad()
+        model(x).sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        # ru_maxrss 以KB为单位，统计第一次前向以来新增的峰值
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 2 ** 10
+    queue.put(((time.time() - start_t) / args.repeat * 1000, peak, reference.cpu()))
+
+
+def run():
+    args = parse_args()
+    # 每种实现在独立进程中运行，保证CPU上的峰值内存互不影响
+    ctx = mp.get_context('spawn')
+    results = {}
+    for fused in [False, True]:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=measure, args=(args, fused, queue))
+        proc.start()
+        results[fused] = queue.get()
+        proc.join()
+    diff = (results[False][2] - results[True][2]).abs().max().item()
+    print('T={} N={} units={} heads={} causality={}'.format(args.max_len, args.batch, args.n_units, args.n_head,
+                                                             args.causality))
+    print('{:>8} {:>12} {:>12}'.format('fused', 'step ms', 'peak MB'))
+    for fused in [False, True]:
+        print('{:>8} {:>12.2f} {:>12.1f}'.format(str(fused), results[fused][0], results[fused][1]))
+    print('max eval output diff {:.2e}'.format(diff))
+
+
+if __name__ == '__main__':
+    run()
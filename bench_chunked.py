@@ -0,0 +1,98 @@
+import os
+import argparse
+import multiprocessing as mp
+import resource
+import time
+import numpy as np
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--max_len', type=int, default=720,
+                        help='sequence length')
+    parser.add_argument('--chunks', type=int, nargs='+', default=[0, 240, 60, 16],
+                        help='queries per chunk, 0 for the one-shot softmax')
+    parser.add_argument('--batch', type=int, default=32,
+                        help='batch size')
+    parser.add_argument('--n_hidden', type=int, default=128,
+                        help='attention size')
+    parser.add_argument('--n_block', type=int, default=4,
+                        help='num of blocks')
+    parser.add_argument('--n_head', type=int, default=4,
+                        help='num of attention heads')
+    parser.add_argument('--causal', action='store_true',
+                        help='add the causal bias')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed iterations')
+    return parser.parse_args()
+
+
+def measure(args, chunk, queue):
+    # 每个配置在独立进程中运行，峰值内存互不影响
+    import tensorflow as tf
+    from tensorflow.contrib.memory_stats import MaxBytesInUse
+    from models.attention_module import self_transformer
+
+    tf.set_random_seed(23333)
+    rng = np.random.RandomState(23333)
+    x = rng.randn(args.batch, args.max_len, args.n_hidden).astype(np.float32)
+    seq_len = rng.randint(1, args.max_len + 1, args.batch)
+    seq_len[0] = args.max_len
+    padding = (np.arange(args.max_len)[None, :] >= seq_len[:, None]).astype(np.float32)
+    inputs = tf.placeholder(tf.float32, [None, None, args.n_hidden])
+    inputs_padding = tf.placeholder(tf.float32, [None, None])
+    # 固定 op seed，各进程的初始权重相同
+    with tf.variable_scope('stack', initializer=tf.glorot_uniform_initializer(seed=23333)):
+        outputs = self_transformer(inputs, inputs, inputs_padding, args.n_block, args.n_hidden, args.n_head, 1.0,
+                                   True, False, causal=args.causal, chunk=chunk or None)
+    loss = tf.reduce_sum(outputs * tf.expand_dims(1. - inputs_padding, 2))
+    grads = tf.gradients(loss, [inputs] + tf.trainable_variables())
+    train_op = tf.train.GradientDescentOptimizer(1e-3).minimize(loss)
+    on_gpu = tf.test.is_gpu_available(cuda_only=True)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        # ru_maxrss 是最高水位，基线在第一次运行之前取
+        base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        feed_dict = {inputs: x, inputs_padding: padding}
+        reference = sess.run([outputs] + grads, feed_dict=feed_dict)
+        sess.run(train_op, feed_dict=feed_dict)
+        start_t = time.time()
+        for _ in range(args.repeat):
+            sess.run(train_op, feed_dict=feed_dict)
+        step_t = (time.time() - start_t) / args.repeat * 1000
+        if on_gpu:
+            peak = sess.run(MaxBytesInUse()) / 2 ** 20
+        else:
+            peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 2 ** 10
+    queue.put((step_t, peak, reference))
+
+
+def run():
+    args = parse_args()
+    ctx = mp.get_context('spawn')
+    results = {}
+    for chunk in args.chunks:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=measure, args=(args, chunk, queue))
+        proc.start()
+        results[chunk] = queue.get()
+        proc.join()
+    base = results[args.chunks[0]]
+    print('T={} N={} units={} blocks={} heads={} causal={}, train step'.format(
+        args.max_len, args.batch, args.n_hidden, args.n_block, args.n_head, args.causal))
+    print('{:>8} {:>10} {:>10} {:>14} {:>14}'.format('chunk', 'step ms', 'peak MB', 'output diff', 'grad diff'))
+    for chunk in args.chunks:
+        step_t, peak, reference = results[chunk]
+        output_diff = np.abs(reference[0] - base[2][0]).max()
+        grad_diff = max(np.abs(g - b).max() for g, b in zip(reference[1:], base[2][1:]))
+        print('{:>8} {:>10.1f} {:>10.1f} {:>14.2e} {:>14.2e}'.format(chunk or 'full', step_t, peak, output_diff,
+                                                                     grad_diff))
+
+
+if __name__ == '__main__':
+    run()
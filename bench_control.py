@@ -0,0 +1,86 @@
+import argparse
+import logging
+import time
+import numpy as np
+import tensorflow as tf
+from models.DIMM import DIMM_Model
+from models.control import TrainControl
+from inference import PlaceholderBatch, dimm_config, n_index, n_medicine
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--num_steps', type=int, default=10000,
+                        help='num of step')
+    parser.add_argument('--checkpoint', type=int, default=160,
+                        help='steps between the lr/is_train/n_batch updates of the trainers')
+    parser.add_argument('--window', type=int, default=1000,
+                        help='steps per reported window')
+    parser.add_argument('--max_len', type=int, default=48,
+                        help='sequence length')
+    parser.add_argument('--batch', type=int, default=8,
+                        help='batch size')
+    parser.add_argument('--n_hidden', type=int, default=16,
+                        help='size of hidden units')
+    return parser.parse_args()
+
+
+def run_loop(args, use_control, feed):
+    config = argparse.Namespace(**vars(dimm_config))
+    config.n_hidden, config.block_ipt, config.block_stp = args.n_hidden, 1, 1
+    with tf.Graph().as_default() as graph:
+        batch = PlaceholderBatch((n_index, n_medicine))
+        model = DIMM_Model(config, batch, (n_index, n_medicine), logging.getLogger('Medical'))
+        feed_dict = dict(zip(batch.get_next(), feed))
+        control = TrainControl(model) if use_control else None
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if use_control:
+                control.set(sess, lr=1e-3, is_train=True, n_batch=args.batch)
+                graph.finalize()
+            windows, start_t = [], time.time()
+            for step in range(1, args.num_steps + 1):
+                if use_control:
+                    global_step, _ = control.train_step(sess, feed_dict=feed_dict)
+                else:
+                    # 原训练循环：单独取 global_step，每个 checkpoint 新建 assign op
+                    global_step = sess.run(model.global_step) + 1
+                    sess.run([model.loss, model.train_op], feed_dict=feed_dict)
+                if global_step % args.checkpoint == 0:
+                    if use_control:
+                        control.set(sess, is_train=False)
+                        control.set(sess, n_batch=args.batch)
+                        control.set(sess, is_train=True)
+                        control.set(sess, lr=1e-3)
+                    else:
+                        sess.run(tf.assign(model.is_train, tf.constant(False, dtype=tf.bool)))
+                        sess.run(tf.assign(model.n_batch, tf.constant(args.batch, dtype=tf.int32)))
+                        sess.run(tf.assign(model.is_train, tf.constant(True, dtype=tf.bool)))
+                        sess.run(tf.assign(model.lr, tf.constant(1e-3, dtype=tf.float32)))
+                if step % args.window == 0:
+                    windows.append((time.time() - start_t) / args.window * 1000)
+                    start_t = time.time()
+            n_ops = len(graph.get_operations())
+    return windows, n_ops
+
+
+def run():
+    args = parse_args()
+    rng = np.random.RandomState(23333)
+    feed = (np.arange(args.batch), rng.randn(args.batch, args.max_len, n_index).astype(np.float32),
+            (rng.rand(args.batch, args.max_len, n_medicine) < 0.02).astype(np.float32),
+            rng.randint(1, args.max_len + 1, args.batch).astype(np.int32),
+            rng.randint(0, 2, args.batch).astype(np.int32))
+    print('{} steps, T={} N={}, mean step ms per {} steps'.format(args.num_steps, args.max_len, args.batch,
+                                                                 args.window))
+    for use_control in [False, True]:
+        windows, n_ops = run_loop(args, use_control, feed)
+        print('{:>12} ops {:>6}: '.format('control' if use_control else 'tf.assign', n_ops) +
+              ' '.join('{:.2f}'.format(t) for t in windows))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,112 @@
+import os
+import sys
+import argparse
+import logging
+import subprocess
+import tempfile
+import time
+import ujson as json
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from torch_model import TCN
+from torch_main import train_one_epoch
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--nprocs', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='numbers of processes to compare')
+    parser.add_argument('--num_samples', type=int, default=512,
+                        help='number of synthetic patients')
+    parser.add_argument('--max_len', type=int, default=720,
+                        help='max length of sequence')
+    parser.add_argument('--batch_train', type=int, default=16,
+                        help='train batch size per process')
+    parser.add_argument('--n_filter', type=int, default=256,
+                        help='number of hidden units per layer')
+    parser.add_argument('--n_level', type=int, default=8,
+                        help='# of levels')
+    parser.add_argument('--n_kernel', type=int, default=3,
+                        help='kernel size')
+    parser.add_argument('--worker', action='store_true',
+                        help='internal, run as a torchrun worker')
+    parser.add_argument('--out', help='internal, result file written by rank 0')
+    return parser.parse_args()
+
+
+def synthetic_samples(num, max_len, dim, seed=23333):
+    rng = np.random.RandomState(seed)
+    samples = []
+    for _ in range(num):
+        length = rng.randint(24, max_len + 1)
+        samples.append({'index': rng.randn(length, dim[0]).astype(np.float32),
+                        'medicine': (rng.rand(length, dim[1]) < 0.02).astype(np.float32),
+                        'length': length,
+                        'label': rng.randint(0, 2)})
+    return samples
+
+
+def worker(args):
+    dist.init_process_group(backend='gloo', init_method='env://')
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    torch.manual_seed(23333)
+    dim = (205, 241)
+    samples = synthetic_samples(args.num_samples, args.max_len, dim)
+    logger = logging.getLogger('Medical')
+    train_args = argparse.Namespace(device=torch.device('cpu'), batch_train=args.batch_train, is_fc=False,
+                                    n_class=2, clip=-1, period=10 ** 9)
+    model = TCN(input_size=dim[0] + dim[1], output_size=2, n_channel=[args.n_filter] * args.n_level,
+                n_kernel=args.n_kernel, dropout=0.3, logger=logger)
+    model = DistributedDataParallel(model)
+    optimizer = optim.Adam(model.parameters(), lr=5e-4)
+    sampler = DistributedSampler(samples, num_replicas=world_size, rank=rank)
+    sampler.set_epoch(1)
+    epoch_file = [samples[idx] for idx in sampler]
+    dist.barrier()
+    start_t = time.time()
+    train_one_epoch(model, optimizer, epoch_file, dim, train_args, logger)
+    dist.barrier()
+    epoch_t = time.time() - start_t
+    if rank == 0:
+        with open(args.out, 'w') as fh:
+            json.dump({'nprocs': world_size, 'time': epoch_t,
+                       'samples_per_sec': len(epoch_file) * world_size / epoch_t}, fh)
+    dist.destroy_process_group()
+
+
+def run():
+    args = parse_args()
+    if args.worker:
+        worker(args)
+        return
+    results = []
+    for nproc in args.nprocs:
+        with tempfile.NamedTemporaryFile(suffix='.json') as out:
+            subprocess.check_call(['torchrun', '--standalone', '--nproc_per_node', str(nproc), __file__, '--worker',
+                                   '--out', out.name, '--num_samples', str(args.num_samples),
+                                   '--max_len', str(args.max_len), '--batch_train', str(args.batch_train),
+                                   '--n_filter', str(args.n_filter), '--n_level', str(args.n_level),
+                                   '--n_kernel', str(args.n_kernel)],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)) or None)
+            with open(out.name, 'r') as fh:
+                results.append(json.load(fh))
+    base = results[0]['samples_per_sec'] / results[0]['nprocs']
+    print('{:>8} {:>12} {:>14} {:>10}'.format('nprocs', 'epoch s', 'samples/s', 'efficiency'))
+    for result in results:
+        efficiency = result['samples_per_sec'] / (result['nprocs'] * base)
+        print('{:>8} {:>12.1f} {:>14.1f} {:>10.2f}'.format(result['nprocs'], result['time'],
+                                                           result['samples_per_sec'], efficiency))
+    json.dump(results, sys.stdout)
+    print()
+
+
+if __name__ == '__main__':
+    run()
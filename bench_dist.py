@@ -0,0 +1,117 @@
+import os
+import re
+import sys
+import argparse
+import socket
+import subprocess
+import tempfile
+import time
+import ujson as json
+import numpy as np
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='numbers of workers to compare')
+    parser.add_argument('--num_samples', type=int, default=1024,
+                        help='number of synthetic train stays')
+    parser.add_argument('--max_len', type=int, default=96,
+                        help='max length of sequence')
+    parser.add_argument('--train_batch', type=int, default=16,
+                        help='train batch size per worker')
+    parser.add_argument('--n_hidden', type=int, default=64,
+                        help='size of the hidden units')
+    parser.add_argument('--steps_per_worker', type=int, default=50,
+                        help='updates per worker, num_steps grows with the number of workers')
+    return parser.parse_args()
+
+
+def write_records(data_dir, num_samples, max_len, dim=(205, 241), seed=23333):
+    # 合成数据写成 single_main 的预处理格式
+    from single_preprocess import build_features, save
+
+    os.makedirs(data_dir)
+    rng = np.random.RandomState(seed)
+    for data_type, num in [('train', num_samples), ('dev', num_samples // 4)]:
+        samples, eval_samples = [], {}
+        for _ in range(num):
+            patient_id = len(samples) + (0 if data_type == 'train' else num_samples)
+            length = rng.randint(8, max_len + 1)
+            label = rng.randint(0, 2)
+            samples.append({'patient_id': patient_id,
+                            'index': rng.randn(length, dim[0]).astype(np.float32),
+                            'medicine': (rng.rand(length, dim[1]) < 0.02).astype(np.float32),
+                            'label': label})
+            eval_samples[str(patient_id)] = {'score': 0., 'label': label, 'name': str(patient_id)}
+        meta = build_features(samples, data_type, max_len, dim, os.path.join(data_dir, data_type + '.tfrecords'))
+        save(os.path.join(data_dir, data_type + '_eval.json'), eval_samples, message=data_type + ' eval')
+        save(os.path.join(data_dir, data_type + '_meta.json'), meta, message=data_type + ' meta')
+    save(os.path.join(data_dir, 'shape_meta.json'), {'max_len': max_len, 'dim': dim}, message='shape meta')
+
+
+def free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def train_cluster(args, tmp_dir, n_worker):
+    ports = free_ports(n_worker + 1)
+    ps_hosts = 'localhost:{}'.format(ports[0])
+    worker_hosts = ','.join('localhost:{}'.format(port) for port in ports[1:])
+    common = [sys.executable, 'single_main.py', '--train', '--gpu', '', '--task', 'bench',
+              '--raw_dir', os.path.join(tmp_dir, 'raw') + '/', '--preprocessed_dir', tmp_dir + '/',
+              '--outputs_dir', os.path.join(tmp_dir, 'outputs_{}'.format(n_worker)) + '/',
+              '--max_len', str(args.max_len), '--n_hidden', str(args.n_hidden),
+              '--train_batch', str(args.train_batch), '--num_steps', str(args.steps_per_worker * n_worker),
+              '--checkpoint', str(args.steps_per_worker * n_worker), '--period', str(10 ** 9),
+              '--capacity', '1000', '--cudnn_compatible', 'True', '--async_eval', 'True',
+              '--session_threads', str(max(1, os.cpu_count() // n_worker)),
+              '--ps_hosts', ps_hosts, '--worker_hosts', worker_hosts]
+    cwd = os.path.dirname(os.path.abspath(__file__)) or None
+    ps = subprocess.Popen(common + ['--job_name', 'ps', '--task_index', '0',
+                                    '--log_path', os.path.join(tmp_dir, 'ps_{}.log'.format(n_worker))], cwd=cwd)
+    log_paths = [os.path.join(tmp_dir, 'worker_{}_{}.log'.format(n_worker, i)) for i in range(n_worker)]
+    start_t = time.time()
+    workers = [subprocess.Popen(common + ['--job_name', 'worker', '--task_index', str(i), '--log_path', log_path],
+                                cwd=cwd) for i, log_path in enumerate(log_paths)]
+    for worker in workers:
+        worker.wait()
+    wall_t = time.time() - start_t
+    ps.terminate()
+    ps.wait()
+    examples_per_sec = 0.
+    for log_path in log_paths:
+        with open(log_path, 'r') as fh:
+            steps, seconds = re.search(r'Worker \d+ ran (\d+) steps in ([\d.]+) s', fh.read()).groups()
+        examples_per_sec += int(steps) * args.train_batch / float(seconds)
+    return {'workers': n_worker, 'wall_time': wall_t, 'examples_per_sec': examples_per_sec}
+
+
+def run():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_records(os.path.join(tmp_dir, 'bench'), args.num_samples, args.max_len)
+        results = [train_cluster(args, tmp_dir, n_worker) for n_worker in args.workers]
+    base = results[0]['examples_per_sec'] / results[0]['workers']
+    print('DIMM on {} cpus, T={} N={} per worker, {} updates per worker'.format(
+        os.cpu_count(), args.max_len, args.train_batch, args.steps_per_worker))
+    print('{:>8} {:>10} {:>14} {:>10}'.format('workers', 'wall s', 'examples/s', 'efficiency'))
+    for result in results:
+        result['efficiency'] = result['examples_per_sec'] / (result['workers'] * base)
+        print('{:>8} {:>10.1f} {:>14.1f} {:>10.2f}'.format(result['workers'], result['wall_time'],
+                                                           result['examples_per_sec'], result['efficiency']))
+    json.dump(results, sys.stdout)
+    print()
+
+
+if __name__ == '__main__':
+    run()
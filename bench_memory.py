@@ -0,0 +1,136 @@
+import os
+import argparse
+import itertools
+import multiprocessing as mp
+import resource
+import traceback
+from queue import Empty
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--n_hidden', type=int, nargs='+', default=[64, 128],
+                        help='hidden sizes to compare')
+    parser.add_argument('--max_len', type=int, nargs='+', default=[240, 720],
+                        help='sequence lengths to compare')
+    parser.add_argument('--block_ipt', type=int, nargs='+', default=[4],
+                        help='num of blocks of the input attentions to compare')
+    parser.add_argument('--head_stp', type=int, nargs='+', default=[1, 4],
+                        help='num of step attention heads to compare')
+    parser.add_argument('--batches', type=int, nargs='+', default=[4, 16],
+                        help='batch sizes, unused with --budget')
+    parser.add_argument('--budget', type=int, default=0,
+                        help='memory budget in MB, if set every config runs the planned batch sizes')
+    parser.add_argument('--recompute', type=bool, default=False,
+                        help='recompute the attention layers in the backward pass')
+    parser.add_argument('--att_chunk', type=int, default=0,
+                        help='queries per chunk of the attention, 0 for the one-shot softmax')
+    return parser.parse_args()
+
+
+def measure(args, n_hidden, max_len, block_ipt, head_stp, is_train, batch, queue):
+    # 每个配置在独立进程中运行，峰值内存互不影响，父进程不初始化 GPU
+    # 出错时也把结果放入 queue，父进程不会一直等待
+    try:
+        queue.put(_measure(args, n_hidden, max_len, block_ipt, head_stp, is_train, batch))
+    except Exception:
+        queue.put(traceback.format_exc())
+        raise
+
+
+def _measure(args, n_hidden, max_len, block_ipt, head_stp, is_train, batch):
+    import logging
+    import tensorflow as tf
+    from tensorflow.contrib.memory_stats import MaxBytesInUse
+    from models.DIMM import DIMM_Model
+    from models.memory_plan import estimate_memory, plan_batch_size
+    from inference import PlaceholderBatch, dimm_config, n_index, n_medicine
+    from bench_suite import synthetic_batch
+
+    dim = (n_index, n_medicine)
+    config = argparse.Namespace(**vars(dimm_config))
+    # 与 single_main 的默认训练设置一致
+    config.n_hidden, config.max_len, config.block_ipt, config.head_stp = n_hidden, max_len, block_ipt, head_stp
+    config.dropout_keep_prob, config.weight_decay = 0.65, 0.0002
+    config.recompute, config.att_chunk = args.recompute, args.att_chunk
+    if args.budget:
+        batch = plan_batch_size(config, dim, args.budget * 2 ** 20, is_train)[0]
+    estimate = estimate_memory(config, dim, batch, is_train)['total']
+
+    on_gpu = tf.test.is_gpu_available(cuda_only=True)
+    inputs = PlaceholderBatch(dim)
+    model = DIMM_Model(config, inputs, dim, logging.getLogger('Medical'))
+    # 最长的 batch：每个住院记录都有 max_len 步
+    feed_dict = dict(zip(inputs.get_next(), synthetic_batch(batch, max_len, dim)))
+    fetch = model.train_op if is_train else model.loss
+    max_bytes = MaxBytesInUse() if on_gpu else None
+    # cuDNN 的 opaque_kernel 没有静态 shape，变量大小在运行时读取
+    sizes = [tf.size(v) for v in tf.global_variables()]
+    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run([tf.assign(model.lr, 1e-3), tf.assign(model.is_train, is_train), tf.assign(model.n_batch, batch)])
+        base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for _ in range(2):
+            sess.run(fetch, feed_dict=feed_dict)
+        if on_gpu:
+            peak = sess.run(max_bytes)
+        else:
+            # CPU 上以 rss 的增长加上变量本身近似峰值，其中也包含运行时的额外开销
+            n_param = sum(sess.run(sizes))
+            peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) * 2 ** 10 + n_param * 4
+    return batch, estimate, peak, on_gpu
+
+
+def wait_result(proc, queue):
+    # 子进程被系统杀死（如内存不足）时不会放入结果，按退出码返回
+    while True:
+        try:
+            return queue.get(timeout=10)
+        except Empty:
+            if not proc.is_alive():
+                return 'exited with code {}'.format(proc.exitcode)
+
+
+def run():
+    args = parse_args()
+    ctx = mp.get_context('spawn')
+    print('DIMM peak memory, recompute={} att_chunk={}{}'.format(
+        args.recompute, args.att_chunk, ', budget {} MB'.format(args.budget) if args.budget else ''))
+    print('{:>8} {:>8} {:>6} {:>6} {:>6} {:>6} {:>10} {:>12} {:>8}'.format(
+        'n_hidden', 'max_len', 'b_ipt', 'h_stp', 'mode', 'batch', 'est MB', 'measured MB', 'ratio'))
+    ratios, on_gpu = [], False
+    for n_hidden, max_len, block_ipt, head_stp in itertools.product(args.n_hidden, args.max_len, args.block_ipt,
+                                                                    args.head_stp):
+        for is_train in [True, False]:
+            # 给定预算时 batch 由子进程中的 planner 决定
+            for batch in [0] if args.budget else args.batches:
+                queue = ctx.Queue()
+                proc = ctx.Process(target=measure, args=(args, n_hidden, max_len, block_ipt, head_stp, is_train,
+                                                         batch, queue))
+                proc.start()
+                result = wait_result(proc, queue)
+                proc.join()
+                if isinstance(result, str):
+                    print('{:>8} {:>8} {:>6} {:>6} {:>6} {:>6} failed: {}'.format(
+                        n_hidden, max_len, block_ipt, head_stp, 'train' if is_train else 'eval', batch,
+                        result.strip().splitlines()[-1]))
+                    continue
+                batch, estimate, peak, on_gpu = result
+                ratios.append(peak / float(estimate))
+                print('{:>8} {:>8} {:>6} {:>6} {:>6} {:>6} {:>10.1f} {:>12.1f} {:>8.2f}'.format(
+                    n_hidden, max_len, block_ipt, head_stp, 'train' if is_train else 'eval', batch,
+                    estimate / 2 ** 20, peak / 2 ** 20, ratios[-1]))
+    if not ratios:
+        print('No config was measured')
+        return
+    print('Measured / estimated peak on {}: min {:.2f} max {:.2f}, plan with a safety factor below {:.2f}'.format(
+        'gpu' if on_gpu else 'cpu (rss)', min(ratios), max(ratios), 1. / max(ratios)))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,96 @@
+import argparse
+import time
+import numpy as np
+from sklearn.metrics import roc_auc_score
+from inference import Inference, OnlineInference, read_stays, n_index, n_medicine, batch_size
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--causal_dir',
+                        help='checkpoint dir of DIMM_causal, randomly initialized weights are used if not set')
+    parser.add_argument('--bi_dir',
+                        help='checkpoint dir of the bidirectional DIMM, needed for the accuracy comparison')
+    parser.add_argument('--data_dir',
+                        help='dir of stay csv files (0*/1* file names), needed for the accuracy comparison')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[24, 168, 720],
+                        help='stay lengths at which an update is timed')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed updates per length')
+    parser.add_argument('--seed', type=int, default=23333,
+                        help='random seed')
+    return parser.parse_args()
+
+
+def synthetic_stay(rng, length):
+    return rng.randn(length, n_index).astype(np.float32), \
+        (rng.rand(length, n_medicine) < 0.02).astype(np.float32)
+
+
+def stream(online, stay_id, index, medicine):
+    probs = [online.update(stay_id, index[t], medicine[t]) for t in range(len(index))]
+    online.close(stay_id)
+    return np.asarray(probs)
+
+
+def check_consistency(online, rng):
+    index, medicine = synthetic_stay(rng, 48)
+    full = online.score_batch([index], [medicine])[0]
+    step = stream(online, 'check', index, medicine)
+    print('max |online - full causal graph| over 48 rows: {:.2e}'.format(np.abs(full - step).max()))
+
+
+def time_updates(online, rng, args):
+    print('{:>8} {:>18} {:>18}'.format('rows', 'online update ms', 're-encode ms'))
+    for length in args.lengths:
+        index, medicine = synthetic_stay(rng, length + args.repeat)
+        for t in range(length):
+            online.update('timing', index[t], medicine[t])
+        start_t = time.time()
+        for t in range(length, length + args.repeat):
+            online.update('timing', index[t], medicine[t])
+        update_t = (time.time() - start_t) / args.repeat
+        online.close('timing')
+        # 不缓存时，每来一行都要把整个前缀重新编码一遍
+        start_t = time.time()
+        for t in range(length, length + args.repeat):
+            online.score_batch([index[:t + 1]], [medicine[:t + 1]])
+        full_t = (time.time() - start_t) / args.repeat
+        print('{:>8} {:>18.2f} {:>18.2f}'.format(length, update_t * 1000, full_t * 1000))
+
+
+def compare_accuracy(online, args):
+    indexes, medicines, labels, _ = read_stays(args.data_dir)
+    labels = np.asarray(labels)
+    bi = Inference(args.bi_dir)
+    bi_last = []
+    for start in range(0, len(indexes), batch_size):
+        probs = bi.score_batch(indexes[start:start + batch_size], medicines[start:start + batch_size])
+        bi_last.extend([prob[-1] for prob in probs])
+    causal = [stream(online, i, index, medicine) for i, (index, medicine) in enumerate(zip(indexes, medicines))]
+    causal_last = [prob[-1] for prob in causal]
+    row_labels = np.concatenate([np.full(len(prob), label) for prob, label in zip(causal, labels)])
+    print('{} stays, {} dead'.format(len(labels), labels.sum()))
+    print('AUROC at the last row, bidirectional: {:.4f}'.format(roc_auc_score(labels, bi_last)))
+    print('AUROC at the last row, causal online: {:.4f}'.format(roc_auc_score(labels, causal_last)))
+    print('AUROC over every row, causal online: {:.4f}'.format(roc_auc_score(row_labels, np.concatenate(causal))))
+
+
+def run():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    if args.causal_dir:
+        online = OnlineInference(args.causal_dir)
+    else:
+        online = OnlineInference(restore=False)
+    check_consistency(online, rng)
+    time_updates(online, rng, args)
+    if args.bi_dir and args.data_dir:
+        compare_accuracy(online, args)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,103 @@
+import os
+import argparse
+import logging
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from models.DIMM import DIMM_Model
+from inference import PlaceholderBatch, dimm_config, n_index, n_medicine
+from single_util import pack_stays
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--max_len', type=int, default=720,
+                        help='sequence length')
+    parser.add_argument('--min_len', type=int, default=24,
+                        help='shortest stay in the batch')
+    parser.add_argument('--batch', type=int, default=32,
+                        help='batch size')
+    parser.add_argument('--n_stays', type=int, default=256,
+                        help='stays per epoch, packed together for pack_stays')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed iterations')
+    return parser.parse_args()
+
+
+class PackedPlaceholderBatch(PlaceholderBatch):
+    """Placeholders in the layout of get_packed_batch_dataset."""
+
+    def __init__(self, dim):
+        super(PackedPlaceholderBatch, self).__init__(dim)
+        self.inputs = self.inputs[:4] + (tf.placeholder(tf.int32, [None, None], name='labels'),
+                                         tf.placeholder(tf.int32, [None, None], name='segment_ids'))
+
+
+def measure(args, mode, feed, checkpoint):
+    # 所有模式从同一个 checkpoint 恢复权重，loss 在相同的参数上比较
+    config = argparse.Namespace(**vars(dimm_config))
+    config.packed, config.pack_stays = mode != 'padded', mode in ['one_per_row', 'pack_stays']
+    with tf.Graph().as_default():
+        tf.set_random_seed(23333)
+        batch = PackedPlaceholderBatch((n_index, n_medicine)) if config.pack_stays else \
+            PlaceholderBatch((n_index, n_medicine))
+        model = DIMM_Model(config, batch, (n_index, n_medicine), logging.getLogger('Medical'))
+        feed_dict = dict(zip(batch.get_next(), feed))
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            if mode == 'padded':
+                sess.run(tf.global_variables_initializer())
+                sess.run(tf.assign(model.lr, 1e-3))
+                saver.save(sess, checkpoint)
+            else:
+                saver.restore(sess, checkpoint)
+            loss = sess.run(model.label_loss, feed_dict=feed_dict)
+            sess.run(model.train_op, feed_dict=feed_dict)
+            start_t = time.time()
+            for _ in range(args.repeat):
+                sess.run(model.train_op, feed_dict=feed_dict)
+            step_t = (time.time() - start_t) / args.repeat * 1000
+    return loss, step_t
+
+
+def run():
+    args = parse_args()
+    rng = np.random.RandomState(23333)
+    seq_len = rng.randint(args.min_len, args.max_len + 1, args.n_stays).astype(np.int32)
+    seq_len[0] = args.max_len
+    stays = (np.arange(args.n_stays, dtype=np.int64),
+             rng.randn(args.n_stays, args.max_len, n_index).astype(np.float32),
+             (rng.rand(args.n_stays, args.max_len, n_medicine) < 0.02).astype(np.float32), seq_len,
+             rng.randint(0, 2, args.n_stays).astype(np.int32))
+    rows = pack_stays(*stays)
+    # 与 to_segments 相同：每行一个住院记录，逐步的标签
+    segment_ids = (np.arange(args.max_len)[None, :] < seq_len[:, None]).astype(np.int32)
+    one_per_row = stays[:4] + (segment_ids * stays[4][:, None], segment_ids)
+    n_rows = len(rows[0])
+    print('T={} N={} stays={} real steps {:.1%}, packed into {} rows, real steps {:.1%}'.format(
+        args.max_len, args.batch, args.n_stays, seq_len.mean() / args.max_len, n_rows,
+        seq_len.sum() / n_rows / args.max_len))
+    print('{:>12} {:>12} {:>14} {:>10}'.format('mode', 'loss', 'train step ms', 'epoch s'))
+    losses, results = {}, {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint = os.path.join(tmp_dir, 'model')
+        for mode, data in [('padded', stays), ('packed', stays), ('one_per_row', one_per_row),
+                           ('pack_stays', rows)]:
+            losses[mode], step_t = measure(args, mode, [x[:args.batch] for x in data], checkpoint)
+            n_batches = -(-len(data[0]) // args.batch)
+            results[mode] = step_t * n_batches / 1000
+            print('{:>12} {:>12.6f} {:>14.1f} {:>10.1f}'.format(mode, losses[mode], step_t, results[mode]))
+    # padded 的注意力以 mask 为 padding，是另一个模型，其 loss 不应与 packed 相同；
+    # packed 与每行一个住院记录的 pack_stays 是同一个函数
+    print('same weights, packed vs one stay per row: loss diff {:.2e}, padded vs packed (different model): '
+          '{:.2e}'.format(abs(losses['packed'] - losses['one_per_row']), abs(losses['padded'] - losses['packed'])))
+    print('epoch speedup, packed {:.2f}x, pack_stays {:.2f}x'.format(results['padded'] / results['packed'],
+                                                                      results['padded'] / results['pack_stays']))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,100 @@
+import os
+import argparse
+import multiprocessing as mp
+import resource
+import time
+import numpy as np
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--max_len', type=int, default=720,
+                        help='sequence length')
+    parser.add_argument('--batches', type=int, nargs='+', default=[16, 32, 64],
+                        help='batch sizes')
+    parser.add_argument('--n_hidden', type=int, default=128,
+                        help='attention size')
+    parser.add_argument('--n_block', type=int, default=4,
+                        help='num of blocks')
+    parser.add_argument('--n_head', type=int, default=4,
+                        help='num of attention heads')
+    parser.add_argument('--chunk', type=int, default=0,
+                        help='queries per chunk of the attention, 0 for the one-shot softmax')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed iterations')
+    return parser.parse_args()
+
+
+def measure(args, batch, recompute, queue):
+    # 每个配置在独立进程中运行，峰值内存互不影响
+    import tensorflow as tf
+    from tensorflow.contrib.memory_stats import MaxBytesInUse
+    from models.attention_module import self_transformer
+
+    tf.set_random_seed(23333)
+    rng = np.random.RandomState(23333)
+    x = rng.randn(batch, args.max_len, args.n_hidden).astype(np.float32)
+    seq_len = rng.randint(1, args.max_len + 1, batch)
+    seq_len[0] = args.max_len
+    padding = (np.arange(args.max_len)[None, :] >= seq_len[:, None]).astype(np.float32)
+    inputs = tf.placeholder(tf.float32, [None, None, args.n_hidden])
+    inputs_padding = tf.placeholder(tf.float32, [None, None])
+    # 固定 op seed，各进程的初始权重相同；不用 dropout，两种方式的梯度应当一致
+    with tf.variable_scope('stack', initializer=tf.glorot_uniform_initializer(seed=23333)):
+        outputs = self_transformer(inputs, inputs, inputs_padding, args.n_block, args.n_hidden, args.n_head, 1.0,
+                                   True, False, chunk=args.chunk or None, recompute=recompute)
+    loss = tf.reduce_sum(outputs * tf.expand_dims(1. - inputs_padding, 2))
+    variables = sorted(tf.trainable_variables(), key=lambda v: v.name)
+    grads = tf.gradients(loss, [inputs] + variables)
+    train_op = tf.train.GradientDescentOptimizer(1e-3).minimize(loss)
+    on_gpu = tf.test.is_gpu_available(cuda_only=True)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        # ru_maxrss 是最高水位，基线在第一次运行之前取
+        base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        feed_dict = {inputs: x, inputs_padding: padding}
+        reference = sess.run(grads, feed_dict=feed_dict)
+        sess.run(train_op, feed_dict=feed_dict)
+        start_t = time.time()
+        for _ in range(args.repeat):
+            sess.run(train_op, feed_dict=feed_dict)
+        step_t = (time.time() - start_t) / args.repeat
+        if on_gpu:
+            peak = sess.run(MaxBytesInUse()) / 2 ** 20
+        else:
+            peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 2 ** 10
+    queue.put((step_t, peak, reference))
+
+
+def run():
+    args = parse_args()
+    ctx = mp.get_context('spawn')
+    print('T={} units={} blocks={} heads={} chunk={}, train step'.format(
+        args.max_len, args.n_hidden, args.n_block, args.n_head, args.chunk))
+    print('{:>6} {:>10} {:>10} {:>10} {:>12} {:>14}'.format('batch', 'recompute', 'step ms', 'peak MB', 'examples/s',
+                                                           'grad diff'))
+    for batch in args.batches:
+        results = {}
+        for recompute in [False, True]:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=measure, args=(args, batch, recompute, queue))
+            proc.start()
+            results[recompute] = queue.get()
+            proc.join()
+        for recompute in [False, True]:
+            step_t, peak, reference = results[recompute]
+            grad_diff = max(np.abs(g - b).max() for g, b in zip(reference, results[False][2]))
+            print('{:>6} {:>10} {:>10.1f} {:>10.1f} {:>12.1f} {:>14.2e}'.format(
+                batch, str(recompute), step_t * 1000, peak, batch / step_t, grad_diff))
+        (base_t, base_peak, _), (re_t, re_peak, _) = results[False], results[True]
+        print('{:>6} {:>10} {:>9.0f}% {:>9.0f}%'.format('', 'change', (re_t / base_t - 1) * 100,
+                                                       (re_peak / base_peak - 1) * 100))
+
+
+if __name__ == '__main__':
+    run()
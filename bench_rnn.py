@@ -0,0 +1,111 @@
+import os
+import argparse
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from models.rnn_module import cu_rnn, nor_rnn, cu_compatible_rnn
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[48, 168, 360, 720],
+                        help='sequence lengths')
+    parser.add_argument('--batch', type=int, default=32,
+                        help='batch size')
+    parser.add_argument('--n_input', type=int, default=256,
+                        help='input size, DIMM feeds 4 * n_hidden')
+    parser.add_argument('--n_hidden', type=int, default=64,
+                        help='size of rnn hidden units')
+    parser.add_argument('--n_layer', type=int, default=2,
+                        help='num of layers')
+    parser.add_argument('--num_threads', type=int, default=8,
+                        help='intra/inter op threads')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed runs per length')
+    return parser.parse_args()
+
+
+def build(impl, inputs, seq_len, args):
+    with tf.variable_scope('rnn'):
+        if impl == 'cu_rnn':
+            outputs, _ = cu_rnn('bi-gru', inputs, args.n_hidden, tf.shape(inputs)[0], False, args.n_layer)
+        elif impl == 'cudnn_compatible':
+            outputs, _ = cu_compatible_rnn('bi-gru', inputs, args.n_hidden, args.n_layer)
+        else:
+            outputs = nor_rnn('bi-' + impl, inputs, seq_len, args.n_hidden, args.n_layer)
+    return outputs
+
+
+def session(args):
+    return tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=args.num_threads,
+                                            inter_op_parallelism_threads=args.num_threads,
+                                            allow_soft_placement=True))
+
+
+def time_impl(impl, args, batches):
+    device = '/gpu:0' if impl == 'cu_rnn' else '/cpu:0'
+    with tf.Graph().as_default(), tf.device(device):
+        inputs = tf.placeholder(tf.float32, [None, None, args.n_input])
+        seq_len = tf.placeholder(tf.int32, [None])
+        outputs = build(impl, inputs, seq_len, args)
+        with session(args) as sess:
+            sess.run(tf.global_variables_initializer())
+            times = []
+            for x, lengths in batches:
+                feed_dict = {inputs: x, seq_len: lengths}
+                sess.run(outputs, feed_dict=feed_dict)
+                start_t = time.time()
+                for _ in range(args.repeat):
+                    sess.run(outputs, feed_dict=feed_dict)
+                times.append((time.time() - start_t) / args.repeat * 1000)
+    return times
+
+
+def check_compatible(args, x, lengths):
+    # cuDNN 训练出的权重恢复到 CudnnCompatibleGRUCell 上，输出应一致
+    ckpt = os.path.join(tempfile.mkdtemp(), 'cu_rnn.ckpt')
+    results = []
+    for impl in ['cu_rnn', 'cudnn_compatible']:
+        with tf.Graph().as_default():
+            inputs = tf.placeholder(tf.float32, [None, None, args.n_input])
+            seq_len = tf.placeholder(tf.int32, [None])
+            outputs = build(impl, inputs, seq_len, args)
+            saver = tf.train.Saver()
+            with session(args) as sess:
+                if impl == 'cu_rnn':
+                    sess.run(tf.global_variables_initializer())
+                    saver.save(sess, ckpt)
+                else:
+                    saver.restore(sess, ckpt)
+                results.append(sess.run(outputs, feed_dict={inputs: x, seq_len: lengths}))
+    return np.abs(results[0] - results[1]).max()
+
+
+def run():
+    args = parse_args()
+    rng = np.random.RandomState(23333)
+    batches = [(rng.randn(args.batch, length, args.n_input).astype(np.float32),
+                np.full(args.batch, length, dtype=np.int32)) for length in args.lengths]
+    impls = ['cudnn_compatible', 'gru', 'sru']
+    if tf.test.is_gpu_available(cuda_only=True):
+        impls = ['cu_rnn'] + impls
+        print('max |cu_rnn - cudnn_compatible| after restore: {:.2e}'.format(check_compatible(args, *batches[0])))
+    else:
+        print('no GPU, cu_rnn is skipped')
+    print('batch={} n_input={} n_hidden={} n_layer={} threads={}, bidirectional forward ms'.format(
+        args.batch, args.n_input, args.n_hidden, args.n_layer, args.num_threads))
+    print('{:>18} '.format('impl') + ' '.join('{:>8}'.format(length) for length in args.lengths))
+    for impl in impls:
+        times = time_impl(impl, args, batches)
+        print('{:>18} '.format(impl + (' (gpu)' if impl == 'cu_rnn' else '')) +
+              ' '.join('{:>8.1f}'.format(t) for t in times))
+
+
+if __name__ == '__main__':
+    run()
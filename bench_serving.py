@@ -0,0 +1,77 @@
+import argparse
+import threading
+import time
+import numpy as np
+from inference import Inference, BatchScheduler, n_index, n_medicine, max_len
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--model_dir',
+                        help='checkpoint dir, randomly initialized weights are used if not set')
+    parser.add_argument('--clients', type=int, default=32,
+                        help='number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='requests per client')
+    parser.add_argument('--max_batch', type=int, nargs='+', default=[1, 8, 32],
+                        help='max batch sizes to compare')
+    parser.add_argument('--max_wait_ms', type=float, default=5.,
+                        help='batching deadline')
+    parser.add_argument('--seed', type=int, default=23333,
+                        help='random seed')
+    return parser.parse_args()
+
+
+def synthetic_patient(rng):
+    length = rng.randint(6, max_len + 1)
+    return rng.randn(length, n_index).astype(np.float32), \
+        (rng.rand(length, n_medicine) < 0.02).astype(np.float32)
+
+
+def load_test(scheduler, args):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(seed):
+        rng = np.random.RandomState(seed)
+        patients = [synthetic_patient(rng) for _ in range(args.requests)]
+        for index, medicine in patients:
+            start_t = time.time()
+            scheduler.score(index, medicine)
+            with lock:
+                latencies.append(time.time() - start_t)
+
+    clients = [threading.Thread(target=client, args=(args.seed + i,)) for i in range(args.clients)]
+    start_t = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    total_t = time.time() - start_t
+    latencies = np.asarray(latencies) * 1000
+    return np.percentile(latencies, 50), np.percentile(latencies, 99), len(latencies) / total_t
+
+
+def run():
+    args = parse_args()
+    if args.model_dir:
+        infer = Inference(args.model_dir)
+    else:
+        infer = Inference(restore=False)
+    # warm up
+    index, medicine = synthetic_patient(np.random.RandomState(args.seed))
+    infer.score_batch([index], [medicine])
+    print('clients={} requests/client={} max_wait_ms={}'.format(args.clients, args.requests, args.max_wait_ms))
+    print('{:>10} {:>10} {:>10} {:>12}'.format('max_batch', 'p50 ms', 'p99 ms', 'requests/s'))
+    for max_batch in args.max_batch:
+        scheduler = BatchScheduler(infer, max_batch=max_batch, max_wait_ms=args.max_wait_ms)
+        p50, p99, throughput = load_test(scheduler, args)
+        scheduler.close()
+        print('{:>10} {:>10.1f} {:>10.1f} {:>12.1f}'.format(max_batch, p50, p99, throughput))
+
+
+if __name__ == '__main__':
+    run()
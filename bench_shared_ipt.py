@@ -0,0 +1,69 @@
+import argparse
+import logging
+import time
+import numpy as np
+import tensorflow as tf
+from models.DIMM import DIMM_Model
+from inference import PlaceholderBatch, dimm_config, n_index, n_medicine
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--max_len', type=int, default=720,
+                        help='sequence length')
+    parser.add_argument('--batch', type=int, default=32,
+                        help='batch size')
+    parser.add_argument('--n_hidden', type=int, default=64,
+                        help='size of hidden units')
+    parser.add_argument('--block_ipt', type=int, default=4,
+                        help='num of blocks of the input attentions')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed iterations')
+    return parser.parse_args()
+
+
+def measure(args, share_ipt, feed):
+    config = argparse.Namespace(**vars(dimm_config))
+    config.n_hidden, config.block_ipt, config.share_ipt = args.n_hidden, args.block_ipt, share_ipt
+    with tf.Graph().as_default() as graph:
+        batch = PlaceholderBatch((n_index, n_medicine))
+        model = DIMM_Model(config, batch, (n_index, n_medicine), logging.getLogger('Medical'))
+        # 输入编码部分的矩阵乘法数量
+        matmuls = len([op for op in graph.get_operations() if op.name.startswith('input_encoding/') and
+                       op.type in ['MatMul', 'BatchMatMul', 'BatchMatMulV2'] and 'gradients' not in op.name])
+        feed_dict = dict(zip(batch.get_next(), feed))
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            times = []
+            for fetch in [model.input_encodes, model.train_op]:
+                sess.run(fetch, feed_dict=feed_dict)
+                start_t = time.time()
+                for _ in range(args.repeat):
+                    sess.run(fetch, feed_dict=feed_dict)
+                times.append((time.time() - start_t) / args.repeat * 1000)
+    return matmuls, times
+
+
+def run():
+    args = parse_args()
+    rng = np.random.RandomState(23333)
+    seq_len = rng.randint(24, args.max_len + 1, args.batch).astype(np.int32)
+    feed = (np.arange(args.batch), rng.randn(args.batch, args.max_len, n_index).astype(np.float32),
+            (rng.rand(args.batch, args.max_len, n_medicine) < 0.02).astype(np.float32), seq_len,
+            rng.randint(0, 2, args.batch).astype(np.int32))
+    print('T={} N={} n_hidden={} block_ipt={}'.format(args.max_len, args.batch, args.n_hidden, args.block_ipt))
+    print('{:>10} {:>10} {:>16} {:>14}'.format('share_ipt', 'matmuls', 'input encode ms', 'train step ms'))
+    results = {}
+    for share_ipt in [False, True]:
+        matmuls, times = measure(args, share_ipt, feed)
+        results[share_ipt] = times
+        print('{:>10} {:>10} {:>16.1f} {:>14.1f}'.format(str(share_ipt), matmuls, times[0], times[1]))
+    print('input encoding speedup {:.2f}x, train step speedup {:.2f}x'.format(
+        results[False][0] / results[True][0], results[False][1] / results[True][1]))
+
+
+if __name__ == '__main__':
+    run()
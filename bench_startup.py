@@ -0,0 +1,50 @@
+import sys
+import argparse
+import resource
+import subprocess
+import time
+import ujson as json
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='cold starts per mode')
+    parser.add_argument('--mode', choices=['checkpoint', 'frozen'],
+                        help='internal, run one cold start in this process')
+    return parser.parse_args()
+
+
+def cold_start(mode):
+    # 从进程启动（包括 import tensorflow）到第一个预测返回的时间
+    start_t = time.time()
+    import numpy as np
+    from inference import Inference, FrozenInference, n_index, n_medicine
+    infer = FrozenInference() if mode == 'frozen' else Inference()
+    ready_t = time.time()
+    rng = np.random.RandomState(23333)
+    infer.score_batch([rng.randn(48, n_index).astype(np.float32)], [np.zeros((48, n_medicine), np.float32)])
+    first_t = time.time()
+    return {'mode': mode, 'load': ready_t - start_t, 'first_prediction': first_t - start_t,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10}
+
+
+def run():
+    args = parse_args()
+    if args.mode:
+        json.dump(cold_start(args.mode), sys.stdout)
+        return
+    print('{:>12} {:>10} {:>18} {:>14}'.format('mode', 'load s', 'first predict s', 'peak RSS MB'))
+    for mode in ['checkpoint', 'frozen']:
+        for _ in range(args.repeat):
+            output = subprocess.check_output([sys.executable, __file__, '--mode', mode])
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print('{:>12} {:>10.2f} {:>18.2f} {:>14.1f}'.format(mode, result['load'], result['first_prediction'],
+                                                                 result['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,285 @@
+import os
+import argparse
+import multiprocessing as mp
+import platform
+import tempfile
+import time
+import ujson as json
+import numpy as np
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--stages', nargs='+', default=['prepare', 'pipeline', 'model'],
+                        choices=['prepare', 'pipeline', 'model'],
+                        help='stages to time')
+    parser.add_argument('--work_dir',
+                        help='dir of the synthetic cohort and its records, a temporary dir if not set')
+    parser.add_argument('--output', default='bench_results.json',
+                        help='machine readable results')
+    parser.add_argument('--num_train', type=int, default=400,
+                        help='num of synthetic train stays')
+    parser.add_argument('--num_test', type=int, default=100,
+                        help='num of synthetic test stays')
+    parser.add_argument('--max_len', type=int, default=720,
+                        help='padded length of the records')
+    parser.add_argument('--pipeline_batches', type=int, nargs='+', default=[32, 128],
+                        help='batch sizes of the input pipeline')
+    parser.add_argument('--models', nargs='+', default=['DIMM', 'BIGRU', 'SAND', 'TCN', 'torch_TCN'],
+                        help='models to time')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[72, 240, 720],
+                        help='sequence lengths of the model stage')
+    parser.add_argument('--batches', type=int, nargs='+', default=[16, 32],
+                        help='batch sizes of the model stage')
+    parser.add_argument('--n_hidden', type=int, default=64,
+                        help='size of the hidden units')
+    parser.add_argument('--inter_M', type=int, default=12,
+                        help='dense interpolation factor of SAND')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed iterations')
+    return parser.parse_args()
+
+
+def file_paths(work_dir):
+    preprocessed_dir = os.path.join(work_dir, 'preprocessed')
+    return argparse.Namespace(**{
+        'train_record_file': os.path.join(preprocessed_dir, 'train.tfrecords'),
+        'dev_record_file': os.path.join(preprocessed_dir, 'dev.tfrecords'),
+        'train_eval_file': os.path.join(preprocessed_dir, 'train_eval.json'),
+        'dev_eval_file': os.path.join(preprocessed_dir, 'dev_eval.json'),
+        'train_meta': os.path.join(preprocessed_dir, 'train_meta.json'),
+        'dev_meta': os.path.join(preprocessed_dir, 'dev_meta.json'),
+        'shape_meta': os.path.join(preprocessed_dir, 'shape_meta.json')})
+
+
+def bench_prepare(args, work_dir, queue):
+    # 生成合成的病人 csv，再计时 single_preprocess 的预处理
+    from synthetic_data import generate, parse_args as synthetic_args
+    from single_preprocess import run_prepare
+
+    config = synthetic_args([])
+    config.raw_dir, config.task = os.path.join(work_dir, 'raw'), 'bench'
+    config.num_train, config.num_test, config.max_len = args.num_train, args.num_test, args.max_len
+    start_t = time.time()
+    train_lengths, test_lengths = generate(config)
+    generate_t = time.time() - start_t
+    n_stay = len(train_lengths) + len(test_lengths)
+    n_step = int(train_lengths.sum() + test_lengths.sum())
+
+    paths = file_paths(work_dir)
+    os.makedirs(os.path.dirname(paths.shape_meta), exist_ok=True)
+    prepare_config = argparse.Namespace(raw_dir=os.path.join(config.raw_dir, config.task), max_len=args.max_len)
+    start_t = time.time()
+    _, dim = run_prepare(prepare_config, paths)
+    prepare_t = time.time() - start_t
+    with open(paths.shape_meta, 'w') as fh:
+        json.dump({'max_len': args.max_len, 'dim': dim}, fh)
+    queue.put([{'stage': 'generate', 'seconds': generate_t, 'stays': n_stay, 'steps': n_step},
+               {'stage': 'prepare', 'seconds': prepare_t, 'stays': n_stay, 'steps': n_step,
+                'stays_per_sec': n_stay / prepare_t, 'steps_per_sec': n_step / prepare_t}])
+
+
+def bench_pipeline(args, work_dir, batch, queue):
+    import tensorflow as tf
+    from single_util import get_record_parser, get_batch_dataset
+
+    paths = file_paths(work_dir)
+    with open(paths.shape_meta, 'r') as fh:
+        shape_meta = json.load(fh)
+    config = argparse.Namespace(num_threads=8, capacity=1000, train_batch=batch)
+    parser = get_record_parser(shape_meta['max_len'], shape_meta['dim'])
+    next_batch = get_batch_dataset(paths.train_record_file, parser, config).make_one_shot_iterator().get_next()
+    n_batch = max(args.repeat, args.num_train // batch)
+    with tf.Session() as sess:
+        sess.run(next_batch)
+        n_step = 0
+        start_t = time.time()
+        for _ in range(n_batch):
+            n_step += sess.run(next_batch)[3].sum()
+        seconds = time.time() - start_t
+    queue.put([{'stage': 'pipeline', 'batch': batch, 'batches': n_batch, 'seconds': seconds,
+                'examples_per_sec': n_batch * batch / seconds, 'steps_per_sec': int(n_step) / seconds,
+                'padding_ratio': 1. - n_step / float(n_batch * batch * shape_meta['max_len'])}])
+
+
+class TCNPlaceholderBatch(object):
+    """Inputs of the TF TCN, which also takes the original length of every stay."""
+
+    def __init__(self, dim):
+        import tensorflow as tf
+
+        self.inputs = (tf.placeholder(tf.int64, [None], name='id'),
+                       tf.placeholder(tf.float32, [None, None, dim[0]], name='index'),
+                       tf.placeholder(tf.float32, [None, None, dim[1]], name='medicine'),
+                       tf.placeholder(tf.int32, [None], name='seq_len'),
+                       tf.placeholder(tf.int32, [None], name='org_len'),
+                       tf.placeholder(tf.int32, [None], name='labels'))
+
+    def get_next(self):
+        return self.inputs
+
+
+def synthetic_batch(batch, length, dim, seed=23333):
+    rng = np.random.RandomState(seed)
+    return (np.arange(batch), rng.randn(batch, length, dim[0]).astype(np.float32),
+            (rng.rand(batch, length, dim[1]) < 0.02).astype(np.float32), np.full(batch, length, dtype=np.int32),
+            rng.randint(0, 2, batch).astype(np.int32))
+
+
+def time_runs(run_fn, repeat):
+    run_fn()
+    start_t = time.time()
+    for _ in range(repeat):
+        run_fn()
+    return (time.time() - start_t) / repeat * 1000
+
+
+def bench_tf_model(args, model_name, length, batch):
+    import logging
+    import tensorflow as tf
+    from models.DIMM import DIMM_Model
+    from models.bi_RNN import bi_RNN_Model
+    from models.SAnD import SAND
+    from models.TCN import TCN
+    from inference import PlaceholderBatch, dimm_config, n_index, n_medicine
+
+    dim = (n_index, n_medicine)
+    on_gpu = tf.test.is_gpu_available(cuda_only=True)
+    config = argparse.Namespace(**vars(dimm_config))
+    config.n_hidden, config.max_len = args.n_hidden, length
+    config.use_cudnn = on_gpu or model_name == 'DIMM'
+    # TCN 的结构参数与 single_main 的默认值一致
+    config.ksize, config.levels, config.fsize, config.atten, config.highway, config.gated = 3, 11, 256, False, \
+        False, False
+    logger = logging.getLogger('Medical')
+    if model_name == 'TCN':
+        inputs = TCNPlaceholderBatch(dim)
+        model = TCN(config, inputs, dim, logger)
+    else:
+        inputs = PlaceholderBatch(dim)
+        if model_name == 'DIMM':
+            model = DIMM_Model(config, inputs, dim, logger)
+        elif model_name == 'BIGRU':
+            model = bi_RNN_Model(config, inputs, dim, logger)
+        else:
+            T, M = args.max_len, args.inter_M
+            W = np.zeros((T, M), dtype=np.float32)
+            for t in range(1, T + 1):
+                s = M * t / T
+                for m in range(1, M + 1):
+                    W[t - 1, m - 1] = (1 - abs(s - m) / M) ** 2
+            model = SAND(config, inputs, dim, logger, W, M)
+
+    values = synthetic_batch(batch, length, dim)
+    if model_name == 'TCN':
+        values = values[:4] + (values[3],) + values[4:]
+    feed_dict = dict(zip(inputs.get_next(), values))
+    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run([tf.assign(model.lr, 1e-3), tf.assign(model.is_train, True), tf.assign(model.n_batch, batch)])
+        forward_t = time_runs(lambda: sess.run(model.loss, feed_dict=feed_dict), args.repeat)
+        train_t = time_runs(lambda: sess.run(model.train_op, feed_dict=feed_dict), args.repeat)
+    return forward_t, train_t
+
+
+def bench_torch_tcn(args, length, batch):
+    import logging
+    import torch
+    from torch_model import TCN
+
+    dim = (205, 241)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = TCN(input_size=dim[0] + dim[1], output_size=2, n_channel=[args.n_hidden] * 8, n_kernel=3, dropout=0.3,
+                logger=logging.getLogger('Medical')).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    criterion = torch.nn.CrossEntropyLoss()
+    _, index, medicine, _, labels = synthetic_batch(batch, length, dim)
+    index, medicine = torch.from_numpy(index).to(device), torch.from_numpy(medicine).to(device)
+    labels = torch.from_numpy(np.repeat(labels[:, None], length, axis=1).astype(np.int64)).to(device)
+
+    def forward():
+        with torch.no_grad():
+            model(index, medicine)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    def train_step():
+        optimizer.zero_grad()
+        loss = criterion(model(index, medicine).view(-1, 2), labels.view(-1))
+        loss.backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    model.train()
+    return time_runs(forward, args.repeat), time_runs(train_step, args.repeat)
+
+
+def bench_model(args, model_name, length, batch, queue):
+    # 每个配置在独立进程中运行，图与显存互不影响
+    if model_name == 'torch_TCN':
+        forward_t, train_t = bench_torch_tcn(args, length, batch)
+    else:
+        forward_t, train_t = bench_tf_model(args, model_name, length, batch)
+    queue.put([{'stage': 'model', 'model': model_name, 'length': length, 'batch': batch, 'forward_ms': forward_t,
+                'train_ms': train_t, 'examples_per_sec': batch / train_t * 1000,
+                'steps_per_sec': batch * length / train_t * 1000}])
+
+
+def run_isolated(target, *args):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=target, args=args + (queue,))
+    proc.start()
+    results = queue.get()
+    proc.join()
+    return results
+
+
+def run():
+    args = parse_args()
+    tmp_dir = None
+    if args.work_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        args.work_dir = tmp_dir.name
+    results = []
+    if 'prepare' in args.stages:
+        results += run_isolated(bench_prepare, args, args.work_dir)
+        for result in results[-2:]:
+            print('{:>10} {:>10.1f} s for {} stays, {} steps'.format(result['stage'], result['seconds'],
+                                                                   result['stays'], result['steps']))
+    if 'pipeline' in args.stages:
+        print('{:>10} {:>8} {:>14} {:>14} {:>10}'.format('pipeline', 'batch', 'examples/s', 'steps/s', 'padding'))
+        for batch in args.pipeline_batches:
+            results += run_isolated(bench_pipeline, args, args.work_dir, batch)
+            result = results[-1]
+            print('{:>10} {:>8} {:>14.1f} {:>14.1f} {:>10.2f}'.format('', batch, result['examples_per_sec'],
+                                                                      result['steps_per_sec'],
+                                                                      result['padding_ratio']))
+    if 'model' in args.stages:
+        print('{:>10} {:>8} {:>8} {:>12} {:>12} {:>14}'.format('model', 'length', 'batch', 'forward ms', 'train ms',
+                                                               'examples/s'))
+        for model_name in args.models:
+            for length in args.lengths:
+                for batch in args.batches:
+                    results += run_isolated(bench_model, args, model_name, length, batch)
+                    result = results[-1]
+                    print('{:>10} {:>8} {:>8} {:>12.1f} {:>12.1f} {:>14.1f}'.format(
+                        model_name, length, batch, result['forward_ms'], result['train_ms'],
+                        result['examples_per_sec']))
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+    env = {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+           'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with open(args.output, 'w') as fh:
+        json.dump({'env': env, 'args': vars(args), 'results': results}, fh, indent=2)
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,77 @@
+import argparse
+import time
+import torch
+from torch_tcn import TemporalConvNet
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[90, 180, 360, 720],
+                        help='sequence lengths to benchmark')
+    parser.add_argument('--batch', type=int, default=32,
+                        help='batch size')
+    parser.add_argument('--n_input', type=int, default=205 + 241,
+                        help='input channels')
+    parser.add_argument('--n_filter', type=int, default=256,
+                        help='number of hidden units per layer')
+    parser.add_argument('--n_level', type=int, default=8,
+                        help='# of levels')
+    parser.add_argument('--n_kernel', type=int, default=3,
+                        help='kernel size')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='timed iterations per length')
+    parser.add_argument('--disable_cuda', action='store_true',
+                        help='Disable CUDA')
+    return parser.parse_args()
+
+
+def time_model(model, x, repeat, device):
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    # warm up
+    model(x).sum().backward()
+    sync()
+    if device.type == 'cuda':
+        torch.cuda.reset_max_memory_allocated()
+    start_t = time.time()
+    for _ in range(repeat):
+        model.zero_grad()
+        model(x).sum().backward()
+    sync()
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return (time.time() - start_t) / repeat * 1000, peak
+
+
+def run():
+    args = parse_args()
+    if torch.cuda.is_available() and not args.disable_cuda:
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+    channels = [args.n_filter] * args.n_level
+    chomp = TemporalConvNet(args.n_input, channels, kernel_size=args.n_kernel, dropout=0.0, left_pad=False)
+    causal = TemporalConvNet(args.n_input, channels, kernel_size=args.n_kernel, dropout=0.0, left_pad=True)
+    # 两种实现的参数名相同，直接严格加载
+    causal.load_state_dict(chomp.state_dict())
+    chomp.to(device).train()
+    causal.to(device).train()
+
+    print('{:>6} {:>12} {:>12} {:>8} {:>12} {:>12} {:>10}'.format('T', 'chomp ms', 'causal ms', 'speedup',
+                                                                   'chomp MB', 'causal MB', 'max diff'))
+    for length in args.lengths:
+        x = torch.randn(args.batch, args.n_input, length, device=device)
+        with torch.no_grad():
+            diff = (chomp(x) - causal(x)).abs().max().item()
+        chomp_ms, chomp_mb = time_model(chomp, x, args.repeat, device)
+        causal_ms, causal_mb = time_model(causal, x, args.repeat, device)
+        print('{:>6} {:>12.2f} {:>12.2f} {:>8.2f} {:>12.1f} {:>12.1f} {:>10.2e}'.format(
+            length, chomp_ms, causal_ms, chomp_ms / causal_ms, chomp_mb, causal_mb, diff))
+
+
+if __name__ == '__main__':
+    run()
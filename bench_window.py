@@ -0,0 +1,97 @@
+import os
+import argparse
+import multiprocessing as mp
+import resource
+import time
+import numpy as np
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[180, 360, 720, 1440],
+                        help='sequence lengths')
+    parser.add_argument('--window', type=int, default=24,
+                        help='sliding window in steps')
+    parser.add_argument('--batch', type=int, default=32,
+                        help='batch size')
+    parser.add_argument('--n_hidden', type=int, default=128,
+                        help='attention size, the step attention of DIMM sees 2 * n_hidden')
+    parser.add_argument('--n_block', type=int, default=4,
+                        help='num of blocks')
+    parser.add_argument('--n_head', type=int, default=4,
+                        help='num of attention heads')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed iterations')
+    return parser.parse_args()
+
+
+def measure(args, length, window, queue):
+    # 每个配置在独立进程中运行，峰值内存互不影响
+    import tensorflow as tf
+    from tensorflow.contrib.memory_stats import MaxBytesInUse
+    from models.attention_module import self_transformer
+
+    rng = np.random.RandomState(23333)
+    x = rng.randn(args.batch, length, args.n_hidden).astype(np.float32)
+    seq_len = rng.randint(1, length + 1, args.batch)
+    seq_len[0] = length
+    padding = (np.arange(length)[None, :] >= seq_len[:, None]).astype(np.float32)
+    inputs = tf.placeholder(tf.float32, [None, None, args.n_hidden])
+    inputs_padding = tf.placeholder(tf.float32, [None, None])
+    with tf.variable_scope('stack'):
+        outputs = self_transformer(inputs, inputs, inputs_padding, args.n_block, args.n_hidden, args.n_head, 1.0,
+                                   True, False, window=window)
+    outputs *= tf.expand_dims(1. - inputs_padding, 2)
+    train_op = tf.train.GradientDescentOptimizer(1e-3).minimize(tf.reduce_sum(outputs))
+    on_gpu = tf.test.is_gpu_available(cuda_only=True)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        # ru_maxrss 是最高水位，基线在第一次运行之前取
+        base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        feed_dict = {inputs: x, inputs_padding: padding}
+        reference = sess.run(outputs, feed_dict=feed_dict)
+        sess.run(train_op, feed_dict=feed_dict)
+        start_t = time.time()
+        for _ in range(args.repeat):
+            sess.run(train_op, feed_dict=feed_dict)
+        step_t = (time.time() - start_t) / args.repeat * 1000
+        if on_gpu:
+            peak = sess.run(MaxBytesInUse()) / 2 ** 20
+        else:
+            peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 2 ** 10
+    queue.put((step_t, peak, reference))
+
+
+def run_one(ctx, args, length, window):
+    queue = ctx.Queue()
+    proc = ctx.Process(target=measure, args=(args, length, window, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def run():
+    args = parse_args()
+    ctx = mp.get_context('spawn')
+    # window 不小于长度时，滑窗注意力应与全注意力一致
+    length = min(args.lengths)
+    full = run_one(ctx, args, length, None)[2]
+    local = run_one(ctx, args, length, length)[2]
+    print('max |full - window={}| at T={}: {:.2e}'.format(length, length, np.abs(full - local).max()))
+    print('N={} units={} blocks={} heads={}, train step'.format(args.batch, args.n_hidden, args.n_block,
+                                                                args.n_head))
+    print('{:>8} {:>14} {:>14} {:>14} {:>14}'.format('T', 'full ms', 'full MB', 'window ms', 'window MB'))
+    for length in args.lengths:
+        full_t, full_mem, _ = run_one(ctx, args, length, None)
+        local_t, local_mem, _ = run_one(ctx, args, length, args.window)
+        print('{:>8} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.1f}'.format(length, full_t, full_mem, local_t, local_mem))
+
+
+if __name__ == '__main__':
+    run()
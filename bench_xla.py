@@ -0,0 +1,117 @@
+import os
+import argparse
+import multiprocessing as mp
+import time
+import numpy as np
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--models', nargs='+', default=['DIMM', 'BIGRU', 'SAND'],
+                        help='models to time')
+    parser.add_argument('--modes', nargs='+', default=['none', 'auto', 'scope'],
+                        help='xla modes')
+    parser.add_argument('--len_bucket', type=int, default=72,
+                        help='length bucket in steps, 0 for the batch max length. DIMM runs --packed and BIGRU '
+                             'without cuDNN to use it, SAND ignores it')
+    parser.add_argument('--max_len', type=int, default=720,
+                        help='padded length of the records')
+    parser.add_argument('--batch', type=int, default=16,
+                        help='batch size')
+    parser.add_argument('--n_batches', type=int, default=40,
+                        help='batches of random lengths per pass')
+    parser.add_argument('--n_hidden', type=int, default=32,
+                        help='size of hidden units')
+    parser.add_argument('--inter_M', type=int, default=12,
+                        help='dense interpolation factor of SAND')
+    return parser.parse_args()
+
+
+def measure(args, model_name, mode, queue):
+    # 每个配置在独立进程中运行，XLA 编译缓存互不影响
+    import logging
+    import tensorflow as tf
+    from models.DIMM import DIMM_Model
+    from models.bi_RNN import bi_RNN_Model
+    from models.SAnD import SAND
+    from inference import PlaceholderBatch, dimm_config, n_index, n_medicine
+
+    on_gpu = tf.test.is_gpu_available(cuda_only=True)
+    config = argparse.Namespace(**vars(dimm_config))
+    config.n_hidden, config.xla, config.len_bucket = args.n_hidden, mode, args.len_bucket
+    config.use_cudnn = on_gpu or model_name == 'DIMM'
+    if args.len_bucket:
+        # 只在屏蔽 padding 的路径上使用 bucket，其余路径补齐的时间步会改变输出
+        if model_name == 'DIMM':
+            config.packed = True
+        elif model_name == 'BIGRU':
+            config.use_cudnn = False
+        else:
+            config.len_bucket = 0
+    batch = PlaceholderBatch((n_index, n_medicine))
+    logger = logging.getLogger('Medical')
+    if model_name == 'DIMM':
+        model = DIMM_Model(config, batch, (n_index, n_medicine), logger)
+    elif model_name == 'BIGRU':
+        model = bi_RNN_Model(config, batch, (n_index, n_medicine), logger)
+    else:
+        T, M = args.max_len, args.inter_M
+        W = np.zeros((T, M), dtype=np.float32)
+        for t in range(1, T + 1):
+            s = M * t / T
+            for m in range(1, M + 1):
+                W[t - 1, m - 1] = (1 - abs(s - m) / M) ** 2
+        model = SAND(config, batch, (n_index, n_medicine), logger, W, M)
+
+    rng = np.random.RandomState(23333)
+    batches = []
+    for _ in range(args.n_batches):
+        seq_len = rng.randint(1, args.max_len + 1, args.batch).astype(np.int32)
+        batches.append((np.arange(args.batch), rng.randn(args.batch, args.max_len, n_index).astype(np.float32),
+                        (rng.rand(args.batch, args.max_len, n_medicine) < 0.02).astype(np.float32), seq_len,
+                        rng.randint(0, 2, args.batch).astype(np.int32)))
+    sess_config = tf.ConfigProto(allow_soft_placement=True)
+    if mode == 'auto':
+        sess_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    with tf.Session(config=sess_config) as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.assign(model.lr, 1e-3))
+        sess.run(tf.assign(model.is_train, True))
+        sess.run(tf.assign(model.n_batch, args.batch))
+        lengths, times = set(), []
+        # 第一遍包含各长度 bucket 的编译时间，第二遍为稳定的 step 时间
+        for _ in range(2):
+            start_t = time.time()
+            for feed in batches:
+                lengths.add(sess.run(model.max_len, feed_dict=dict(zip(batch.get_next(), feed))))
+                sess.run(model.train_op, feed_dict=dict(zip(batch.get_next(), feed)))
+            times.append((time.time() - start_t) / args.n_batches * 1000)
+    queue.put((len(lengths), times[0], times[1]))
+
+
+def run():
+    args = parse_args()
+    ctx = mp.get_context('spawn')
+    print('N={} n_hidden={} len_bucket={}, {} batches of random lengths up to {}'.format(
+        args.batch, args.n_hidden, args.len_bucket, args.n_batches, args.max_len))
+    print('{:>8} {:>8} {:>8} {:>16} {:>14}'.format('model', 'xla', 'shapes', 'first pass ms', 'step ms'))
+    for model_name in args.models:
+        base = None
+        for mode in args.modes:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=measure, args=(args, model_name, mode, queue))
+            proc.start()
+            shapes, first_t, step_t = queue.get()
+            proc.join()
+            base = base or step_t
+            print('{:>8} {:>8} {:>8} {:>16.1f} {:>14.1f} ({:.2f}x)'.format(model_name, mode, shapes, first_t, step_t,
+                                                                          base / step_t))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,64 @@
+import argparse
+import time
+import numpy as np
+from sklearn.metrics import roc_auc_score
+from inference import Inference, read_stays, pad_batch, model_dir, batch_size, steps_per_hour
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--model_dir', default=model_dir,
+                        help='checkpoint dir of the bidirectional DIMM')
+    parser.add_argument('--data_dir', required=True,
+                        help='dir of stay csv files (0*/1* file names)')
+    parser.add_argument('--lookbacks', type=int, nargs='+', default=[0, 72, 48, 24, 12, 6],
+                        help='lookback windows K in hours, 0 means the full history')
+    parser.add_argument('--hours', type=int, nargs='+', default=[1, 6, 12, 24, 48, 72],
+                        help='prediction horizons in hours since admission')
+    return parser.parse_args()
+
+
+def score_at(infer, indexes, medicines, hour, window):
+    """Death probability of every stay longer than hour, predicted at that hour from the last window rows."""
+    step = hour * steps_per_hour
+    stays = [i for i, index in enumerate(indexes) if len(index) >= step]
+    scores, run_t = [], 0.
+    for start in range(0, len(stays), batch_size):
+        chunk = stays[start:start + batch_size]
+        start_t = time.time()
+        ids, b_index, b_medicine, b_seq_len = pad_batch([indexes[i][:step] for i in chunk],
+                                                        [medicines[i][:step] for i in chunk], window)
+        probs = infer.sess.run(infer.model.soft_outputs,
+                               feed_dict={infer.model.id: ids, infer.model.index: b_index,
+                                          infer.model.medicine: b_medicine, infer.model.seq_len: b_seq_len})
+        run_t += time.time() - start_t
+        scores.extend([prob[seq_len - 1, 1] for prob, seq_len in zip(probs, b_seq_len)])
+    return stays, scores, run_t / max(len(stays), 1)
+
+
+def run():
+    args = parse_args()
+    indexes, medicines, labels, _ = read_stays(args.data_dir)
+    labels = np.asarray(labels)
+    infer = Inference(args.model_dir)
+    print('{} stays, {} dead'.format(len(labels), labels.sum()))
+    print('{:>10} '.format('K hours') + ' '.join('{:>8}'.format('{}h'.format(hour)) for hour in args.hours) +
+          ' {:>14}'.format('ms/stay @{}h'.format(args.hours[-1])))
+    for lookback in args.lookbacks:
+        rocs, latency = [], 0.
+        for hour in args.hours:
+            stays, scores, latency = score_at(infer, indexes, medicines, hour,
+                                              lookback * steps_per_hour if lookback else None)
+            if len(set(labels[stays])) < 2:
+                rocs.append('{:>8}'.format('-'))
+            else:
+                rocs.append('{:>8.4f}'.format(roc_auc_score(labels[stays], scores)))
+        print('{:>10} '.format(lookback if lookback else 'full') + ' '.join(rocs) +
+              ' {:>14.2f}'.format(latency * 1000))
+
+
+if __name__ == '__main__':
+    run()
@@ -5,10 +5,15 @@ import pandas as pd
 import warnings
 import time
 import os
+import argparse
 import logging
-from models.rnn_module import cu_rnn
+import threading
+from concurrent.futures import Future
+from queue import Queue, Empty
+from models.rnn_module import cu_rnn, cu_compatible_rnn, default_cudnn_compatible
 from models.nn_module import dense, seq_loss
 from models.attention_module import self_transformer
+from models.DIMM import DIMM_Model
 
 warnings.filterwarnings(action='ignore', category=UserWarning, module='tensorflow')
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
@@ -27,13 +32,28 @@ n_index = 205
 n_medicine = 241
 batch_size = 8
 max_len = 720
+# 每小时3条记录
+steps_per_hour = 3
+frozen_path = os.path.join(model_dir, 'frozen_dimm.pb')
+causal_model_dir = 'multi_task/DIMM_causal/models'
+# DIMM 超参数，与 InfModel 中的网络结构一致；cudnn_compatible 为 None 时在建图时检测 GPU，没有 GPU 时用与cuDNN权重兼容的GRU
+dimm_config = argparse.Namespace(n_hidden=64, use_cudnn=True, n_layer=2, n_class=2, is_map=True, ipt_att=True,
+                                 inter_att=True, intra_att=True, block_ipt=4, head_ipt=1, step_att=True,
+                                 block_stp=4, head_stp=4, is_bi=True, is_point=False, is_fc=False, optim='adam',
+                                 dropout_keep_prob=1.0, weight_decay=0., cudnn_compatible=None,
+                                 window_ipt=0, window_stp=0, att_chunk=0, recompute=False,
+                                 share_ipt=False, packed=False, pack_stays=False,
+                                 xla='none', len_bucket=0, accum_steps=1, lr=0.001)
+input_names = ['id', 'index', 'medicine', 'seq_len']
+output_names = ['probs', 'pre_labels']
 
 
 class InfModel(object):
     def __init__(self):
         self.id = tf.placeholder(tf.int32, [None])
-        self.index = tf.placeholder(tf.float32, [batch_size, max_len, n_index])
-        self.medicine = tf.placeholder(tf.float32, [batch_size, max_len, n_medicine])
+        # batch 与时间维度都不固定，每个 batch 只需 padding 到其中最长的住院记录
+        self.index = tf.placeholder(tf.float32, [None, None, n_index])
+        self.medicine = tf.placeholder(tf.float32, [None, None, n_medicine])
         self.seq_len = tf.placeholder(tf.int32, [None])
         self.labels = tf.placeholder(tf.int32, [None])
 
@@ -80,7 +100,11 @@ class InfModel(object):
 
     def _rnn(self):
         with tf.variable_scope('rnn', reuse=tf.AUTO_REUSE):
-            self.seq_encodes, _ = cu_rnn('bi-gru', self.input_encodes, self.n_hidden, batch_size, False, self.n_layer)
+            if default_cudnn_compatible():
+                self.seq_encodes, _ = cu_compatible_rnn('bi-gru', self.input_encodes, self.n_hidden, self.n_layer)
+            else:
+                self.seq_encodes, _ = cu_rnn('bi-gru', self.input_encodes, self.n_hidden, batch_size, False,
+                                             self.n_layer)
         self.n_hidden *= self.n_layer
         self.seq_encodes = tf.nn.dropout(self.seq_encodes, 1.0)
 
@@ -107,52 +131,295 @@ class InfModel(object):
 
 
 class Inference(object):
-    def __init__(self):
+    def __init__(self, model_path=model_dir, restore=True, lookback=None):
+        # 只用最近 lookback 小时的记录做预测，None 表示用全部记录
+        self.window = lookback * steps_per_hour if lookback else None
         self.model = InfModel()
         sess_config = tf.ConfigProto(allow_soft_placement=True)
         sess_config.gpu_options.allow_growth = True
         self.sess = tf.Session(config=sess_config)
-        saver = tf.train.Saver()
-        saver.restore(self.sess, tf.train.latest_checkpoint(model_dir))
+        if restore:
+            saver = tf.train.Saver()
+            saver.restore(self.sess, tf.train.latest_checkpoint(model_path))
+        else:
+            self.sess.run(tf.global_variables_initializer())
 
     def response(self, file_path):
         sess = self.sess
         model = self.model
-        ids, indexes, medicines, seq_lens, labels, names = self.prepro(file_path)
+        ids, indexes, medicines, seq_lens, labels, names = self.prepro(file_path, self.window)
         pre_labels, probs = sess.run([model.pre_labels, model.soft_outputs],
                                      feed_dict={model.id: ids, model.index: indexes, model.medicine: medicines,
-                                                model.seq_len: seq_lens, model.labels: labels})
+                                                model.seq_len: seq_lens})
 
         return pre_labels, probs
 
-    def prepro(self, data_path):
-        b_ids = np.zeros(batch_size, dtype=np.int64)
-        b_index = np.zeros((batch_size, n_index), dtype=np.float32)
-        b_medicine = np.zeros((batch_size, n_medicine), dtype=np.float32)
-        b_seq_len = np.zeros(batch_size, dtype=np.int64)
-        b_labels = np.zeros(batch_size, dtype=np.int64)
-        b_names = []
-        for i, file in enumerate(os.listdir(data_path)):
-            if file.startswith('0'):
-                dead = 0
+    def score_batch(self, indexes, medicines):
+        """Scores a list of patients with one sess.run.
+
+        Args:
+          indexes: list of [seq_len, n_index] arrays
+          medicines: list of [seq_len, n_medicine] arrays
+
+        Returns:
+          list of [seq_len] arrays with the death probability at every step, only the steps inside the
+          lookback window when one is set
+        """
+        ids, b_index, b_medicine, b_seq_len = pad_batch(indexes, medicines, self.window)
+        probs = self.sess.run(self.model.soft_outputs,
+                              feed_dict={self.model.id: ids, self.model.index: b_index,
+                                         self.model.medicine: b_medicine, self.model.seq_len: b_seq_len})
+        return [prob[:seq_len, 1] for prob, seq_len in zip(probs, b_seq_len)]
+
+    def prepro(self, data_path, window=None):
+        b_indexes, b_medicines, b_labels, b_names = read_stays(data_path)
+        b_ids, b_index, b_medicine, b_seq_len = pad_batch(b_indexes, b_medicines, window)
+
+        return b_ids, b_index, b_medicine, b_seq_len, np.asarray(b_labels, dtype=np.int64), b_names
+
+
+def read_stays(data_path):
+    """Reads every stay csv in data_path, file names starting with 0 are survivors."""
+    b_indexes, b_medicines, b_names, b_labels = [], [], [], []
+    for file in os.listdir(data_path):
+        if file.startswith('0'):
+            dead = 0
+        else:
+            dead = 1
+        raw_sample = pd.read_csv(os.path.join(data_path, file), sep=',')
+        raw_sample = raw_sample.fillna(0)
+        b_medicines.append(raw_sample.iloc[:, 209:].as_matrix())
+        b_indexes.append(raw_sample.iloc[:, 3:208].as_matrix())
+        b_labels.append(dead)
+        b_names.append(file)
+    return b_indexes, b_medicines, b_labels, b_names
+
+
+def pad_batch(indexes, medicines, window=None):
+    """Pads a list of stays to the longest one in the list, truncated at max_len.
+
+    With a window only the last window rows of every stay are kept.
+    """
+    if window:
+        indexes = [index[-window:] for index in indexes]
+        medicines = [medicine[-window:] for medicine in medicines]
+    b_seq_len = np.asarray([min(len(index), max_len) for index in indexes], dtype=np.int64)
+    n, length = len(indexes), b_seq_len.max()
+    b_ids = np.arange(n, dtype=np.int64)
+    b_index = np.zeros((n, length, n_index), dtype=np.float32)
+    b_medicine = np.zeros((n, length, n_medicine), dtype=np.float32)
+    for i, (index, medicine, seq_len) in enumerate(zip(indexes, medicines, b_seq_len)):
+        b_index[i, :seq_len] = index[:seq_len]
+        b_medicine[i, :seq_len] = medicine[:seq_len]
+    return b_ids, b_index, b_medicine, b_seq_len
+
+
+class FrozenInference(Inference):
+    """Serves a graph written by export_frozen_graph, nothing is rebuilt in Python."""
+
+    def __init__(self, graph_path=frozen_path, lookback=None):
+        start_t = time.time()
+        self.window = lookback * steps_per_hour if lookback else None
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(graph_path, 'rb') as fh:
+            graph_def.ParseFromString(fh.read())
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.model = argparse.Namespace(**{name: graph.get_tensor_by_name(name + ':0') for name in input_names})
+        self.model.soft_outputs = graph.get_tensor_by_name('probs:0')
+        self.model.pre_labels = graph.get_tensor_by_name('pre_labels:0')
+        sess_config = tf.ConfigProto(allow_soft_placement=True)
+        sess_config.gpu_options.allow_growth = True
+        self.sess = tf.Session(graph=graph, config=sess_config)
+        logger.info('Time to load frozen graph: {} s'.format(time.time() - start_t))
+
+
+class PlaceholderBatch(object):
+    """Stands in for the tf.data iterator so that a model can be built on named placeholders."""
+
+    def __init__(self, dim):
+        self.inputs = (tf.placeholder(tf.int64, [None], name='id'),
+                       tf.placeholder(tf.float32, [None, None, dim[0]], name='index'),
+                       tf.placeholder(tf.float32, [None, None, dim[1]], name='medicine'),
+                       tf.placeholder(tf.int32, [None], name='seq_len'),
+                       tf.placeholder(tf.int32, [None], name='labels'))
+
+    def get_next(self):
+        return self.inputs
+
+
+def export_frozen_graph(checkpoint_dir=model_dir, graph_path=frozen_path, config=dimm_config):
+    """Freezes a trained DIMM checkpoint into an inference-only GraphDef.
+
+    The graph is built with DIMM_Model(trainable=False), so it has no dropout, l2 or optimizer ops. Only the
+    subgraph feeding the outputs is kept, variables become constants and constant subexpressions are folded.
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    graph = tf.Graph()
+    with graph.as_default():
+        model = DIMM_Model(config, PlaceholderBatch((n_index, n_medicine)), (n_index, n_medicine), logger,
+                           trainable=False)
+        tf.identity(model.soft_outputs, name='probs')
+        tf.identity(model.pre_labels, name='pre_labels')
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, tf.train.latest_checkpoint(checkpoint_dir))
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), output_names)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=input_names + output_names)
+    graph_def = TransformGraph(graph_def, input_names, output_names,
+                               ['fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+    with tf.gfile.GFile(graph_path, 'wb') as fh:
+        fh.write(graph_def.SerializeToString())
+    logger.info('Exported {} nodes to {}'.format(len(graph_def.node), graph_path))
+
+
+class OnlineInference(object):
+    """Streaming scorer for the causal DIMM (DIMM_Model(causal=True)).
+
+    Every open stay keeps its GRU state and the attention keys/values of its rows, so a new row is scored
+    with one sess.run in O(T) instead of re-encoding the whole stay.
+    """
+
+    def __init__(self, model_path=causal_model_dir, config=dimm_config, restore=True):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.batch = PlaceholderBatch((n_index, n_medicine))
+            self.model = DIMM_Model(config, self.batch, (n_index, n_medicine), logger, trainable=False,
+                                    causal=True)
+            sess_config = tf.ConfigProto(allow_soft_placement=True)
+            sess_config.gpu_options.allow_growth = True
+            self.sess = tf.Session(config=sess_config)
+            if restore:
+                tf.train.Saver().restore(self.sess, tf.train.latest_checkpoint(model_path))
             else:
-                dead = 1
-            raw_sample = pd.read_csv(os.path.join(data_path, file), sep=',')
-            raw_sample = raw_sample.fillna(0)
-            medicine = raw_sample.iloc[:, 209:].as_matrix()
-            index = raw_sample.iloc[:, 3:208].as_matrix()
-            b_ids[i] = i
-            b_index[i] = index
-            b_medicine[i] = medicine
-            b_seq_len[i] = index.shape[0]
-            b_labels[i] = dead
-            b_names.append(file)
+                self.sess.run(tf.global_variables_initializer())
+        self.caches = [placeholder for placeholder, _ in self.model.step_caches]
+        self.fetches = [self.model.step_scores, self.model.step_new_state] + [row for _, row in
+                                                                              self.model.step_caches]
+        self.stays = {}
+
+    def open(self, stay_id):
+        state = np.zeros((self.model.n_layer, 1, self.model.n_hidden), dtype=np.float32)
+        # 预分配 max_len 行，超出时再扩容
+        cache = [np.zeros((1, max_len, placeholder.get_shape().as_list()[-1]), dtype=np.float32)
+                 for placeholder in self.caches]
+        self.stays[stay_id] = {'length': 0, 'state': state, 'cache': cache}
+
+    def close(self, stay_id):
+        self.stays.pop(stay_id, None)
+
+    def update(self, stay_id, index, medicine):
+        """Appends one row to a stay and returns the death probability after it.
+
+        Args:
+          stay_id: key of the stay, opened on its first row
+          index: [n_index] array
+          medicine: [n_medicine] array
+        """
+        if stay_id not in self.stays:
+            self.open(stay_id)
+        stay = self.stays[stay_id]
+        length = stay['length']
+        if length == stay['cache'][0].shape[1]:
+            stay['cache'] = [np.concatenate([cache, np.zeros_like(cache)], axis=1) for cache in stay['cache']]
+        feed_dict = {self.model.step_index: np.reshape(index, (1, 1, n_index)),
+                     self.model.step_medicine: np.reshape(medicine, (1, 1, n_medicine)),
+                     self.model.step_state: stay['state']}
+        for placeholder, cache in zip(self.caches, stay['cache']):
+            feed_dict[placeholder] = cache[:, :length]
+        outputs = self.sess.run(self.fetches, feed_dict=feed_dict)
+        stay['state'] = outputs[1]
+        for cache, row in zip(stay['cache'], outputs[2:]):
+            cache[:, length] = row[:, 0]
+        stay['length'] = length + 1
+        return float(outputs[0][0])
+
+    def score_batch(self, indexes, medicines):
+        """Scores whole stays with the full causal graph, see Inference.score_batch."""
+        ids, b_index, b_medicine, b_seq_len = pad_batch(indexes, medicines)
+        b_id, b_index_ph, b_medicine_ph, b_seq_len_ph, _ = self.batch.get_next()
+        probs = self.sess.run(self.model.soft_outputs,
+                              feed_dict={b_id: ids, b_index_ph: b_index, b_medicine_ph: b_medicine,
+                                         b_seq_len_ph: b_seq_len})
+        return [prob[:seq_len, 1] for prob, seq_len in zip(probs, b_seq_len)]
+
+
+class BatchScheduler(object):
+    """Dynamic micro-batching in front of an Inference.
+
+    Single-patient requests are queued and a worker thread groups them into one batch until it holds
+    max_batch requests or the oldest request has waited max_wait_ms, then scores the batch with one
+    sess.run and resolves each request's Future with its own [seq_len] probabilities.
+    """
+
+    def __init__(self, inference, max_batch=batch_size, max_wait_ms=5.):
+        self.inference = inference
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.requests = Queue()
+        self.worker = threading.Thread(target=self._loop, name='batch_scheduler')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, index, medicine):
+        future = Future()
+        self.requests.put((time.time(), index, medicine, future))
+        return future
+
+    def score(self, index, medicine, timeout=None):
+        return self.submit(index, medicine).result(timeout)
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def _next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[0] + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                request = self.requests.get(timeout=max(deadline - time.time(), 0.))
+            except Empty:
+                break
+            if request is None:
+                # 处理完当前 batch 后再退出
+                self.requests.put(None)
+                break
+            batch.append(request)
+        return batch
 
-        return b_ids, b_index, b_medicine, b_seq_len, b_labels, b_names
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                probs = self.inference.score_batch([r[1] for r in batch], [r[2] for r in batch])
+            except Exception as e:
+                for r in batch:
+                    r[3].set_exception(e)
+                continue
+            for r, prob in zip(batch, probs):
+                r[3].set_result(prob)
 
 
 if __name__ == "__main__":
-    infer = Inference()
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--export', action='store_true',
+                        help='freeze the checkpoint in model_dir into an inference-only graph')
+    parser.add_argument('--frozen', action='store_true',
+                        help='serve from the frozen graph instead of rebuilding the model')
+    parser.add_argument('--lookback', type=int,
+                        help='only score the last K hours of every stay')
+    args = parser.parse_args()
+    if args.export:
+        export_frozen_graph()
+        exit(0)
+    infer = FrozenInference(lookback=args.lookback) if args.frozen else Inference(lookback=args.lookback)
 
     labels, probs = infer.response(data_dir)
     print('Labels')
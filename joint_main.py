@@ -6,7 +6,9 @@ import numpy as np
 import tensorflow as tf
 from joint_preprocess import run_prepare
 from models.joint_DIMM import Joint_DIMM_Model
-from joint_util import get_record_parser, get_batch_dataset, get_dataset, evaluate_batch
+from models.control import TrainControl
+from models.timing import StepTimer
+from joint_util import get_record_parser, get_batch_dataset, get_dataset, evaluate_batch, get_train_eval_dataset
 import warnings
 
 warnings.filterwarnings(action='ignore', category=UserWarning, module='tensorflow')
@@ -36,6 +38,11 @@ def parse_args():
                                 help='num of step')
     train_settings.add_argument('--period', type=int, default=80,
                                 help='period to save batch loss')
+    train_settings.add_argument('--step_timing', type=bool, default=False,
+                                help='time the input wait and session run of the train steps, logged every period')
+    train_settings.add_argument('--trace_steps', type=int, nargs='*', default=[],
+                                help='train steps at which a FULL_TRACE chrome trace timeline is written to '
+                                     'summary_dir')
     train_settings.add_argument('--checkpoint', type=int, default=320,
                                 help='checkpoint for evaluation')
     train_settings.add_argument('--eval_num_batches', type=int, default=78,
@@ -51,6 +58,8 @@ def parse_args():
                                 help='dropout keep rate')
     train_settings.add_argument('--train_batch', type=int, default=32,
                                 help='train batch size')
+    train_settings.add_argument('--accum_steps', type=int, default=1,
+                                help='micro-batches accumulated per update, num_steps counts updates')
     train_settings.add_argument('--dev_batch', type=int, default=15,
                                 help='dev batch size')
     train_settings.add_argument('--epochs', type=int, default=30,
@@ -148,12 +157,16 @@ def train(args, file_paths, dim):
     parser = get_record_parser(args.max_len, dim)
     train_dataset = get_batch_dataset(file_paths.train_record_file, parser, args)
     dev_dataset = get_dataset(file_paths.dev_record_file, parser, args)
+    train_eval_dataset = get_train_eval_dataset(file_paths.train_record_file, parser, args)
     handle = tf.placeholder(tf.string, shape=[])
     iterator = tf.data.Iterator.from_string_handle(handle, train_dataset.output_types, train_dataset.output_shapes)
     train_iterator = train_dataset.make_one_shot_iterator()
     dev_iterator = dev_dataset.make_one_shot_iterator()
+    train_eval_iterator = train_eval_dataset.make_one_shot_iterator()
     logger.info('Initialize the model...')
     model = Joint_DIMM_Model(args, iterator, dim, logger)
+    control = TrainControl(model)
+
     sess_config = tf.ConfigProto(intra_op_parallelism_threads=8,
                                  inter_op_parallelism_threads=8,
                                  allow_soft_placement=True)
@@ -161,10 +174,16 @@ def train(args, file_paths, dim):
 
     with tf.Session(config=sess_config) as sess:
         writer = tf.summary.FileWriter(args.summary_dir)
+        timer = None
+        if args.step_timing or args.trace_steps:
+            timer = StepTimer(model, writer, args.summary_dir, args.trace_steps)
         sess.run(tf.global_variables_initializer())
+        # 梯度累加的变量
+        sess.run(tf.local_variables_initializer())
         # saver = tf.train.Saver()
         train_handle = sess.run(train_iterator.string_handle())
         dev_handle = sess.run(dev_iterator.string_handle())
+        train_eval_handle = sess.run(train_eval_iterator.string_handle())
         max_sum, max_epoch, task_sum = 0, 0, 0
         train_roc = 0
         roc_save, patience = 0, 0
@@ -172,23 +191,31 @@ def train(args, file_paths, dim):
         if args.is_map:
             index_W = tf.get_default_graph().get_tensor_by_name('input_encoding/index/dense/W:0')
             medicine_W = tf.get_default_graph().get_tensor_by_name('input_encoding/medicine/dense/W:0')
-        sess.run(tf.assign(model.lr, tf.constant(lr, dtype=tf.float32)))
-        sess.run(tf.assign(model.is_train, tf.constant(True, dtype=tf.bool)))
-        sess.run(tf.assign(model.n_batch, tf.constant(args.train_batch, dtype=tf.int32)))
+        control.set(sess, lr=lr, is_train=True, n_batch=args.train_batch)
+        # 之后的训练与评估不再向图中添加 op
+        tf.get_default_graph().finalize()
 
-        for global_step in range(1, args.num_steps + 1):
-            sess.run(tf.assign(model.global_step, tf.constant(global_step + 1, dtype=tf.int32)))
-            loss, train_op = sess.run([model.loss, model.train_op], feed_dict={handle: train_handle})
+        for step in range(1, args.num_steps + 1):
+            if timer is not None:
+                global_step, loss = timer.train_step(control, sess, step, feed_dict={handle: train_handle})
+            else:
+                global_step, loss = control.train_step(sess, feed_dict={handle: train_handle})
             if global_step % args.period == 0:
                 logger.info('Period point {} Loss {}'.format(global_step, loss))
                 loss_sum = tf.Summary(value=[tf.Summary.Value(tag='model/loss', simple_value=loss), ])
                 writer.add_summary(loss_sum, global_step)
+                if timer is not None:
+                    stats, summ = timer.summaries()
+                    logger.info('Input wait {input_wait_ms:.1f} ms Run {run_ms:.1f} ms Examples/s '
+                                '{examples_per_sec:.1f} Timesteps/s {timesteps_per_sec:.1f} '
+                                'Padding {padding_ratio:.2f}'.format(**stats))
+                    writer.add_summary(summ, global_step)
 
             if global_step % args.checkpoint == 0:
                 logger.info('Evaluating the model for epoch {}'.format(global_step // args.checkpoint))
-                sess.run(tf.assign(model.is_train, tf.constant(False, dtype=tf.bool)))
+                control.set(sess, is_train=False)
                 train_loss, metrics, summ = evaluate_batch(model, args.eval_num_batches, train_eval_file,
-                                                           sess, 'train', handle, train_handle, logger)
+                                                           sess, 'train', handle, train_eval_handle, logger)
                 logger.info('Train Metrics')
                 logger.info('Loss - {}'.format(train_loss))
                 roc = 0
@@ -201,10 +228,10 @@ def train(args, file_paths, dim):
                 if roc > train_roc:
                     train_roc = roc
 
-                sess.run(tf.assign(model.n_batch, tf.constant(args.dev_batch, dtype=tf.int32)))
+                control.set(sess, n_batch=args.dev_batch)
                 dev_loss, metrics, summ = evaluate_batch(model, dev_total // args.dev_batch, dev_eval_file, sess,
                                                          'dev', handle, dev_handle, logger)
-                sess.run(tf.assign(model.is_train, tf.constant(True, dtype=tf.bool)))
+                control.set(sess, is_train=True)
                 for s in summ:
                     writer.add_summary(s, global_step)
                 writer.flush()
@@ -236,7 +263,7 @@ def train(args, file_paths, dim):
                     roc_save = roc
                     patience = 0
                     logger.info('Learning rate reduced to {}'.format(lr))
-                sess.run(tf.assign(model.lr, tf.constant(lr, dtype=tf.float32)))
+                control.set(sess, lr=lr)
 
                 if task_sum > max_sum:
                     max_sum = task_sum
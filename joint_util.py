@@ -33,6 +33,19 @@ def get_batch_dataset(record_file, parser, config):
     return dataset
 
 
+def get_train_eval_dataset(record_file, parser, config):
+    """
+    A fixed random subset of eval_num_batches train batches for the train metrics. It is parsed once, then
+    served from the cache on every evaluation, and never draws from the training stream.
+    """
+    num_threads = tf.constant(config.num_threads, dtype=tf.int32)
+    dataset = tf.data.TFRecordDataset(record_file).shuffle(config.capacity, seed=23333).take(
+        config.eval_num_batches * config.train_batch).map(parser, num_parallel_calls=num_threads).cache().batch(
+        config.train_batch).repeat()
+
+    return dataset
+
+
 def get_dataset(record_file, parser, config):
     num_threads = tf.constant(config.num_threads, dtype=tf.int32)
     dataset = tf.data.TFRecordDataset(record_file).map(
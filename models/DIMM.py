@@ -1,21 +1,29 @@
 import tensorflow as tf
 import tensorflow.contrib as tc
 import time
-from .rnn_module import cu_rnn, nor_rnn
-from .nn_module import dense, seq_loss, focal_loss, point_loss, label_smoothing
-from .attention_module import self_transformer
+from .rnn_module import cu_rnn, nor_rnn, cu_compatible_rnn, get_cu_cell, get_nor_cell, get_cu_compatible_cell, \
+    default_cudnn_compatible
+from .nn_module import dense, seq_loss, focal_loss, point_loss, label_smoothing, pack, unpack, \
+    segment_rows, bucket_length, jit_scope, accumulate_gradients
+from .attention_module import self_transformer, shared_input_transformer, transformer_step, EncoderStack
 
 
 class DIMM_Model(object):
-    def __init__(self, args, batch, dim, logger, trainable=True):
+    def __init__(self, args, batch, dim, logger, trainable=True, causal=False):
         # logging
         self.logger = logger
         self.trainable = trainable
+        # causal variant: every step only sees the past, so it can be updated online row by row
+        self.causal = causal
         # basic config
         self.n_index = dim[0]
         self.n_medicine = dim[1]
         self.n_hidden = args.n_hidden
         self.use_cudnn = args.use_cudnn
+        # 在CPU上运行cuDNN训练得到的GRU权重，None 表示没有 GPU 时使用
+        self.cudnn_compatible = args.cudnn_compatible
+        if self.cudnn_compatible is None:
+            self.cudnn_compatible = default_cudnn_compatible()
         self.n_batch = tf.get_variable('n_batch', shape=[], dtype=tf.int32, trainable=False)
         self.n_layer = args.n_layer
         self.n_label = args.n_class
@@ -24,31 +32,93 @@ class DIMM_Model(object):
         self.inter_att = args.inter_att
         self.intra_att = args.intra_att
         self.block_ipt = args.block_ipt
+        # i2m, m2i, i2i, m2m 共用每个输入的 layer norm 与 key/value 映射
+        self.share_ipt = args.share_ipt
         self.head_ipt = args.head_ipt
         self.step_att = args.step_att
         self.block_stp = args.block_stp
         self.head_stp = args.head_stp
-        self.is_bi = args.is_bi
+        # sliding window sizes, None for full attention
+        self.window_ipt = args.window_ipt or None
+        self.window_stp = args.window_stp or None
+        # queries per chunk of the exact chunked attention, None for the one-shot softmax
+        self.att_chunk = args.att_chunk or None
+        # 注意力层的激活不保留，反向时重新计算
+        self.recompute = args.recompute
+        if self.share_ipt and self.recompute:
+            raise NotImplementedError('Recomputation is not supported by the shared input attention')
+        if self.share_ipt and (self.causal or not self.is_map):
+            raise NotImplementedError('Shared input attention needs is_map and is not supported by the causal variant')
+        if self.causal and (self.window_ipt or self.window_stp):
+            raise NotImplementedError('Sliding window attention is not supported by the causal variant')
+        # packed 模式：逐步计算的层只处理真实的时间步，注意力屏蔽 padding 的 key。
+        # 原有的全注意力以 self.mask 为 padding（屏蔽的是真实的时间步），因此 packed 是另一个模型，
+        # 与 padded 的 checkpoint 不能互换
+        # pack_stays：输入流水线将多个住院记录拼接为一行，每行附带 segment id 与逐步的标签
+        self.pack_stays = args.pack_stays
+        self.packed = args.packed or self.pack_stays
+        if self.packed and (self.window_ipt or self.window_stp):
+            raise NotImplementedError('Sliding window attention is not supported in packed mode')
+        if self.pack_stays and (self.causal or args.is_point):
+            raise NotImplementedError('Packed stays are only supported by the bidirectional sequence model')
+        self.is_bi = args.is_bi and not self.causal
         self.is_point = args.is_point
         self.is_fc = args.is_fc
         self.opt_type = args.optim
         self.dropout_keep_prob = args.dropout_keep_prob
         self.weight_decay = args.weight_decay
+        self.xla = args.xla
+        # 梯度在 accum_steps 个小批次上累加后更新一次
+        self.accum_steps = args.accum_steps
+        self.accum_op = None
 
-        self.id, self.index, self.medicine, self.seq_len, self.labels = batch.get_next()
+        if self.pack_stays:
+            self.id, self.index, self.medicine, self.seq_len, self.labels, self.segment_ids = batch.get_next()
+        else:
+            self.id, self.index, self.medicine, self.seq_len, self.labels = batch.get_next()
         self.N = tf.shape(self.id)[0]
-        self.max_len = tf.reduce_max(self.seq_len)
+        # 按 bucket 补齐的时间步只有在注意力屏蔽 padding、RNN 跳过 padding 时才不改变输出
+        masks_padding = self.causal or self.packed or ((self.window_ipt or not self.ipt_att) and
+                                                       (self.window_stp or not self.step_att))
+        rnn_skips_padding = self.causal or self.packed or not self.use_cudnn
+        if args.len_bucket and not (masks_padding and rnn_skips_padding):
+            raise NotImplementedError('Length buckets change the outputs of the padded DIMM, use them with '
+                                      '--packed or the causal variant')
+        # 点预测取最后一个时间步，bucket 补齐后它不再是 max_len 的最后一步
+        if args.len_bucket and self.is_point:
+            raise NotImplementedError('Length buckets change the point predictions of DIMM')
+        self.max_len = bucket_length(self.seq_len, args.len_bucket, tf.shape(self.index)[1])
         self.mask = tf.sequence_mask(self.seq_len, self.max_len, dtype=tf.float32, name='masks')
         self.padding = tf.sequence_mask(self.seq_len, self.max_len, dtype=tf.int32, name='padding')
         self.index = tf.slice(self.index, [0, 0, 0], tf.stack([self.N, self.max_len, self.n_index]))
         self.medicine = tf.slice(self.medicine, [0, 0, 0], tf.stack([self.N, self.max_len, self.n_medicine]))
-        self.lr = tf.get_variable('lr', shape=[], dtype=tf.float32, trainable=False)
-        self.is_train = tf.get_variable('is_train', shape=[], dtype=tf.bool, trainable=False)
+        if self.pack_stays:
+            self.segment_ids = tf.slice(self.segment_ids, [0, 0], tf.stack([self.N, self.max_len]))
+            self.labels = tf.slice(self.labels, [0, 0], tf.stack([self.N, self.max_len]))
+        elif self.packed:
+            # one segment per row, 0 at padding
+            self.segment_ids = self.padding
+        else:
+            self.segment_ids = None
+        if self.packed:
+            self.nonpad_ids = tf.to_int32(tf.where(self.segment_ids > 0))
+        # 每行只有一个 segment 时用 [B, 1, 1, T] 的 padding bias（由 1 - mask 得到），不构造 [B, 1, T, T] 的 segment bias
+        self.att_segment_ids = self.segment_ids if self.pack_stays else None
+        # 初始值即为 args.lr：分布式训练中非 chief 的 worker 可能在 chief 设置学习率之前就开始更新
+        self.lr = tf.get_variable('lr', shape=[], dtype=tf.float32, trainable=False,
+                                  initializer=tf.constant_initializer(args.lr))
+        if self.trainable:
+            self.is_train = tf.get_variable('is_train', shape=[], dtype=tf.bool, trainable=False)
+        else:
+            # inference-only graph, no dropout ops are built
+            self.is_train = False
         self.global_step = tf.get_variable('global_step', shape=[], dtype=tf.int32,
                                            initializer=tf.constant_initializer(0), trainable=False)
         # self.lr = tf.train.exponential_decay(args.lr, global_step=self.global_step, decay_steps=args.checkpoint,
         #                                      decay_rate=0.96)
         self.initializer = tc.layers.xavier_initializer()
+        # encoder stacks of the causal variant, reused by the online step graph
+        self.stacks = {}
 
         self._build_graph()
         # if self.is_train:
@@ -62,29 +132,48 @@ class DIMM_Model(object):
 
     def _build_graph(self):
         start_t = time.time()
-        self._encode()
-        self._rnn()
-        if self.step_att:
-            self._step_attention()
-        if self.is_point:
-            self._point_label()
-        else:
-            self._seq_label()
-        self._compute_loss()
+        with jit_scope(self.xla == 'scope'):
+            self._encode()
+            self._rnn()
+            if self.step_att:
+                self._step_attention()
+            if self.is_point:
+                self._point_label()
+            else:
+                self._seq_label()
+            self._compute_loss()
         if self.trainable:
             self._create_train_op()
+        elif self.causal and not self.is_point:
+            self._build_step()
         self.logger.info('Time to build graph: {} s'.format(time.time() - start_t))
 
     def _encode(self):
         with tf.variable_scope('input_encoding', reuse=tf.AUTO_REUSE):
-            if self.is_map:
+            if self.is_map and self.packed:
+                with tf.variable_scope('index', reuse=tf.AUTO_REUSE):
+                    self.index = dense(pack(self.index, self.nonpad_ids), hidden=self.n_hidden,
+                                       initializer=self.initializer)
+                    self.index = unpack(self.index, self.nonpad_ids, self.N, self.max_len)
+                with tf.variable_scope('medicine', reuse=tf.AUTO_REUSE):
+                    self.medicine = dense(pack(self.medicine, self.nonpad_ids), hidden=self.n_hidden,
+                                          initializer=self.initializer)
+                    self.medicine = unpack(self.medicine, self.nonpad_ids, self.N, self.max_len)
+            elif self.is_map:
                 with tf.variable_scope('index', reuse=tf.AUTO_REUSE):
                     self.index = dense(self.index, hidden=self.n_hidden, initializer=self.initializer)
                     self.index = tf.reshape(self.index, [-1, self.max_len, self.n_hidden], name='2_3D')
                 with tf.variable_scope('medicine', reuse=tf.AUTO_REUSE):
                     self.medicine = dense(self.medicine, hidden=self.n_hidden, initializer=self.initializer)
                     self.medicine = tf.reshape(self.medicine, [-1, self.max_len, self.n_hidden], name='2_3D')
-            if self.ipt_att:
+            if self.ipt_att and self.share_ipt and self.inter_att and self.intra_att:
+                with tf.variable_scope('shared_attention', reuse=tf.AUTO_REUSE):
+                    self.i2m, self.m2i, self.index, self.medicine = shared_input_transformer(
+                        self.index, self.medicine, self._stack_padding(self.window_ipt), self.block_ipt,
+                        self.n_hidden, self.head_ipt, self.dropout_keep_prob, self.is_train, window=self.window_ipt,
+                        chunk=self.att_chunk, segment_ids=self.att_segment_ids)
+                self.input_encodes = tf.concat([self.index, self.medicine, self.i2m, self.m2i], 2)
+            elif self.ipt_att:
                 if self.inter_att:
                     self.i2m = self._input_attention(self.index, self.medicine,
                                                      self.n_hidden if self.is_map else self.n_index,
@@ -112,20 +201,61 @@ class DIMM_Model(object):
 
     def _input_attention(self, input_x, input_y, n_unit, scope):
         with tf.variable_scope(scope, reuse=tf.AUTO_REUSE):
-            input_encodes = self_transformer(input_x, input_y, self.mask, self.block_ipt, n_unit, self.head_ipt,
-                                             self.dropout_keep_prob, False, self.is_train)
+            if self.causal:
+                self.stacks[scope] = EncoderStack(self.block_ipt, n_unit, self.head_ipt, self.dropout_keep_prob,
+                                                  self.is_train, False, chunk=self.att_chunk,
+                                                  recompute=self.recompute)
+            input_encodes = self_transformer(input_x, input_y, self._stack_padding(self.window_ipt), self.block_ipt,
+                                             n_unit, self.head_ipt, self.dropout_keep_prob, False, self.is_train,
+                                             causal=self.causal, encoder_stack=self.stacks.get(scope),
+                                             window=self.window_ipt, chunk=self.att_chunk,
+                                             segment_ids=self.att_segment_ids, recompute=self.recompute)
             return input_encodes
 
+    def _stack_padding(self, window):
+        # 原有的全注意力沿用 self.mask，causal、滑窗与 packed 模式的 padding 为 1 - mask
+        if self.causal or window or self.packed:
+            return 1. - self.mask
+        return self.mask
+
     def _rnn(self):
+        inputs, seq_len, n_batch = self.input_encodes, self.seq_len, self.n_batch
+        if self.pack_stays:
+            # 每个住院记录单独成行，GRU 状态在 segment 边界处重置
+            stay_ids, seq_len = segment_rows(self.segment_ids, self.nonpad_ids)
+            n_batch = tf.size(seq_len)
+            inputs = unpack(pack(inputs, self.nonpad_ids), stay_ids, n_batch, tf.reduce_max(seq_len))
         with tf.variable_scope('rnn', reuse=tf.AUTO_REUSE):
-            if self.use_cudnn:
-                self.seq_encodes, _ = cu_rnn('bi-gru', self.input_encodes, self.n_hidden, self.n_batch,
-                                             self.is_train, self.n_layer)
+            if self.causal:
+                # 单向GRU，保留cell以便在线预测时从缓存的状态继续
+                if self.use_cudnn and not self.cudnn_compatible:
+                    self.rnn_cell = get_cu_cell('gru', self.n_hidden, self.n_layer, 'unidirectional')
+                    self.seq_encodes, _ = self.rnn_cell(tf.transpose(self.input_encodes, [1, 0, 2]))
+                    self.seq_encodes = tf.transpose(self.seq_encodes, [1, 0, 2])
+                elif self.use_cudnn:
+                    with tf.variable_scope('cudnn_gru'):
+                        self.rnn_cell = get_cu_compatible_cell(self.n_hidden, self.n_layer)
+                        self.seq_encodes, _ = tf.nn.dynamic_rnn(self.rnn_cell, self.input_encodes,
+                                                                sequence_length=self.seq_len, dtype=tf.float32)
+                else:
+                    self.rnn_cell = tc.rnn.MultiRNNCell([get_nor_cell('gru', self.n_hidden)
+                                                         for _ in range(self.n_layer)])
+                    self.seq_encodes, _ = tf.nn.dynamic_rnn(self.rnn_cell, self.input_encodes,
+                                                            sequence_length=self.seq_len, dtype=tf.float32)
+            elif self.use_cudnn and self.cudnn_compatible:
+                self.seq_encodes, _ = cu_compatible_rnn('bi-gru', inputs, self.n_hidden, self.n_layer,
+                                                        seq_len if self.packed else None)
+            elif self.use_cudnn:
+                self.seq_encodes, _ = cu_rnn('bi-gru', inputs, self.n_hidden, n_batch, self.is_train, self.n_layer,
+                                             seq_len if self.packed else None)
             else:
-                self.seq_encodes = nor_rnn('bi-sru', self.input_encodes, self.seq_len, self.n_hidden,
-                                           self.n_layer, self.dropout_keep_prob)
+                self.seq_encodes = nor_rnn('bi-sru', inputs, seq_len, self.n_hidden, self.n_layer,
+                                           self.dropout_keep_prob)
+        if self.pack_stays:
+            self.seq_encodes = unpack(pack(self.seq_encodes, stay_ids), self.nonpad_ids, self.N, self.max_len)
         if self.is_bi:
-            self.n_hidden *= self.n_layer
+            # forward and backward outputs are concatenated
+            self.n_hidden *= 2
         if self.is_train:
             self.seq_encodes = tf.nn.dropout(self.seq_encodes, rate=1 - self.dropout_keep_prob)
 
@@ -135,11 +265,22 @@ class DIMM_Model(object):
             # self.seq_encodes = self_transformer(self.input_encodes, self.input_encodes, self.mask, self.block_stp,
             #                                     self.n_hidden, self.head_stp, self.dropout_keep_prob,
             #                                     True, self.is_train)
-            self.seq_encodes = self_transformer(self.seq_encodes, self.seq_encodes, self.mask, self.block_stp,
-                                                self.n_hidden, self.head_stp, self.dropout_keep_prob,
-                                                True, self.is_train)
+            if self.causal:
+                self.stacks['step_attention'] = EncoderStack(self.block_stp, self.n_hidden, self.head_stp,
+                                                             self.dropout_keep_prob, self.is_train, True,
+                                                             chunk=self.att_chunk, recompute=self.recompute)
+            self.seq_encodes = self_transformer(self.seq_encodes, self.seq_encodes,
+                                                self._stack_padding(self.window_stp), self.block_stp, self.n_hidden,
+                                                self.head_stp, self.dropout_keep_prob, True, self.is_train,
+                                                causal=self.causal,
+                                                encoder_stack=self.stacks.get('step_attention'),
+                                                window=self.window_stp, chunk=self.att_chunk,
+                                                segment_ids=self.att_segment_ids, recompute=self.recompute)
 
     def _seq_label(self):
+        if self.packed:
+            self._packed_seq_label()
+            return
         with tf.variable_scope('seq_labels', reuse=tf.AUTO_REUSE):
             self.seq_encodes = tf.reshape(self.seq_encodes, [-1, self.n_hidden])
             self.outputs = dense(self.seq_encodes, hidden=self.n_label, scope='output_labels',
@@ -152,6 +293,22 @@ class DIMM_Model(object):
             else:
                 self.label_loss = seq_loss(self.outputs, self.labels, self.mask)
 
+    def _packed_seq_label(self):
+        with tf.variable_scope('seq_labels', reuse=tf.AUTO_REUSE):
+            # 输出层与loss只在真实的时间步上计算
+            packed_outputs = dense(pack(self.seq_encodes, self.nonpad_ids), hidden=self.n_label,
+                                   scope='output_labels', initializer=self.initializer)
+            self.outputs = unpack(packed_outputs, self.nonpad_ids, self.N, self.max_len)
+            if not self.pack_stays:
+                self.labels = tf.tile(tf.expand_dims(self.labels, axis=1), tf.stack([1, self.max_len]))
+            packed_labels = tf.expand_dims(pack(self.labels, self.nonpad_ids), 0)
+            packed_outputs = tf.expand_dims(packed_outputs, 0)
+            packed_mask = tf.ones_like(packed_labels, dtype=tf.float32)
+            if self.is_fc:
+                self.label_loss = focal_loss(packed_outputs, packed_labels, packed_mask)
+            else:
+                self.label_loss = seq_loss(packed_outputs, packed_labels, packed_mask)
+
     def _point_label(self):
         with tf.variable_scope('point_labels', reuse=tf.AUTO_REUSE):
             # self.seq_encodes = tf.squeeze(tf.gather_nd(self.seq_encodes, tf.stack(
@@ -166,6 +323,73 @@ class DIMM_Model(object):
 
             self.label_loss = point_loss(self.outputs, self.labels)
 
+    def _build_step(self):
+        """
+        Online graph of the causal variant: scores one new row of a stay from the cached GRU state and the
+        cached attention keys/values of the previous rows, so each update costs O(T) instead of re-encoding
+        the whole stay. Shares all variables with the full graph.
+        """
+        self.step_index = tf.placeholder(tf.float32, [None, 1, self.n_index], name='step_index')
+        self.step_medicine = tf.placeholder(tf.float32, [None, 1, self.n_medicine], name='step_medicine')
+        self.step_state = tf.placeholder(tf.float32, [self.n_layer, None, self.n_hidden], name='step_state')
+        # (placeholder of the cached rows, key/value of the new row)
+        self.step_caches = []
+        index, medicine = self.step_index, self.step_medicine
+        with tf.variable_scope('input_encoding', reuse=tf.AUTO_REUSE):
+            if self.is_map:
+                with tf.variable_scope('index', reuse=tf.AUTO_REUSE):
+                    index = dense(index, hidden=self.n_hidden, initializer=self.initializer)
+                with tf.variable_scope('medicine', reuse=tf.AUTO_REUSE):
+                    medicine = dense(medicine, hidden=self.n_hidden, initializer=self.initializer)
+            if self.ipt_att:
+                if self.inter_att:
+                    i2m = self._attention_step(index, medicine, self.n_hidden if self.is_map else self.n_index,
+                                               'i2m_attention')
+                    m2i = self._attention_step(medicine, index, self.n_hidden if self.is_map else self.n_medicine,
+                                               'm2i_attention')
+                if self.intra_att:
+                    index = self._attention_step(index, index, self.n_hidden if self.is_map else self.n_index,
+                                                 'i2i_attention')
+                    medicine = self._attention_step(medicine, medicine,
+                                                    self.n_hidden if self.is_map else self.n_medicine,
+                                                    'm2m_attention')
+                if self.intra_att and self.inter_att:
+                    input_encodes = tf.concat([index, medicine, i2m, m2i], 2)
+                elif self.inter_att:
+                    input_encodes = tf.concat([index, medicine], 2)
+                else:
+                    input_encodes = tf.concat([i2m, m2i], 2)
+            else:
+                input_encodes = tf.concat([index, medicine], 2)
+        with tf.variable_scope('rnn', reuse=tf.AUTO_REUSE):
+            if self.use_cudnn and not self.cudnn_compatible:
+                seq_encodes, (self.step_new_state,) = self.rnn_cell(tf.transpose(input_encodes, [1, 0, 2]),
+                                                                    initial_state=(self.step_state,))
+                seq_encodes = tf.transpose(seq_encodes, [1, 0, 2])
+            else:
+                seq_encodes, new_state = self.rnn_cell(input_encodes[:, 0], tuple(tf.unstack(self.step_state)))
+                self.step_new_state = tf.stack(new_state)
+                seq_encodes = tf.expand_dims(seq_encodes, 1)
+        if self.step_att:
+            with tf.variable_scope('step_attention', reuse=tf.AUTO_REUSE):
+                seq_encodes = self._attention_step(seq_encodes, seq_encodes, self.n_hidden, 'step_attention')
+        with tf.variable_scope('seq_labels', reuse=tf.AUTO_REUSE):
+            step_outputs = dense(tf.reshape(seq_encodes, [-1, self.n_hidden]), hidden=self.n_label,
+                                 scope='output_labels', initializer=self.initializer)
+            self.step_scores = tf.nn.softmax(step_outputs)[:, 1]
+
+    def _attention_step(self, step_x, step_y, n_unit, scope):
+        stack = self.stacks[scope]
+        with tf.variable_scope(scope, reuse=tf.AUTO_REUSE):
+            cache = {'layer_%d' % n: {'k': tf.placeholder(tf.float32, [None, None, n_unit], name='layer_%d_k' % n),
+                                      'v': tf.placeholder(tf.float32, [None, None, n_unit], name='layer_%d_v' % n)}
+                     for n in range(len(stack.layers))}
+            cached = [(cache[layer][key], layer, key) for layer in sorted(cache) for key in ['k', 'v']]
+            step_encodes = transformer_step(stack, step_x, step_y, cache)
+            # transformer_step 会把新的一行拼接进cache
+            self.step_caches.extend([(placeholder, cache[layer][key][:, -1:]) for placeholder, layer, key in cached])
+            return step_encodes
+
     def _compute_loss(self):
         self.all_params = tf.trainable_variables()
         self.soft_outputs = tf.stop_gradient(tf.nn.softmax(self.outputs))
@@ -176,7 +400,7 @@ class DIMM_Model(object):
         else:
             self.pre_scores = self.soft_outputs[:, :, 1]
         self.loss = self.label_loss
-        if self.weight_decay > 0:
+        if self.weight_decay > 0 and self.trainable:
             with tf.variable_scope('l2_loss'):
                 l2_loss = tf.add_n([tf.nn.l2_loss(v) for v in self.all_params])
             self.loss += self.weight_decay * l2_loss
@@ -200,8 +424,12 @@ class DIMM_Model(object):
             else:
                 raise NotImplementedError('Unsupported optimizer: {}'.format(self.opt_type))
             # self.grads, _ = tf.clip_by_global_norm(tf.gradients(self.loss, self.all_params), 25)
-            grads = self.optimizer.compute_gradients(self.loss)
-            gradients, variables = zip(*grads)
-            capped_grads, _ = tf.clip_by_global_norm(gradients, 25)
-            self.train_op = self.optimizer.apply_gradients(zip(capped_grads, variables),
-                                                           global_step=self.global_step)
+            if self.accum_steps > 1:
+                self.accum_op, self.train_op = accumulate_gradients(self.optimizer, self.loss, self.accum_steps, 25,
+                                                                    self.global_step)
+            else:
+                grads = self.optimizer.compute_gradients(self.loss)
+                gradients, variables = zip(*grads)
+                capped_grads, _ = tf.clip_by_global_norm(gradients, 25)
+                self.train_op = self.optimizer.apply_gradients(zip(capped_grads, variables),
+                                                               global_step=self.global_step)
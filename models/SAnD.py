@@ -1,7 +1,7 @@
 import tensorflow as tf
 import tensorflow.contrib as tc
 import time
-from .nn_module import dense, seq_loss, focal_loss, point_loss
+from .nn_module import dense, seq_loss, focal_loss, point_loss, jit_scope, accumulate_gradients
 from .attention_module import self_transformer
 
 
@@ -28,9 +28,16 @@ class SAND(object):
         self.opt_type = args.optim
         self.dropout_keep_prob = args.dropout_keep_prob
         self.weight_decay = args.weight_decay
+        self.xla = args.xla
+        # 梯度在 accum_steps 个小批次上累加后更新一次
+        self.accum_steps = args.accum_steps
+        self.accum_op = None
 
         self.id, self.index, self.medicine, self.seq_len, self.labels = batch.get_next()
         self.N = tf.shape(self.id)[0]
+        if args.len_bucket:
+            # 注意力以 mask 为 padding，补齐的时间步会改变输出
+            raise NotImplementedError('Length buckets change the outputs of SAND')
         self.max_len = tf.reduce_max(self.seq_len)
         self.mask = tf.sequence_mask(self.seq_len, self.max_len, dtype=tf.float32, name='masks')
         self.index = tf.slice(self.index, [0, 0, 0], tf.stack([self.N, self.max_len, self.n_index]))
@@ -40,7 +47,9 @@ class SAND(object):
         self.position = tf.tile(tf.expand_dims(tf.range(start=0, limit=self.max_len), 0), [self.N, 1])
         self.pos_embeddings = tf.Variable(tf.random_normal([720, self.n_hidden], 0.0, self.n_hidden ** -0.5),
                                           trainable=True)
-        self.lr = tf.get_variable('lr', shape=[], dtype=tf.float32, trainable=False)
+        # 初始值即为 args.lr：分布式训练中非 chief 的 worker 可能在 chief 设置学习率之前就开始更新
+        self.lr = tf.get_variable('lr', shape=[], dtype=tf.float32, trainable=False,
+                                  initializer=tf.constant_initializer(args.lr))
         self.is_train = tf.get_variable('is_train', shape=[], dtype=tf.bool, trainable=False)
         self.global_step = tf.get_variable('global_step', shape=[], dtype=tf.int32,
                                            initializer=tf.constant_initializer(0), trainable=False)
@@ -60,14 +69,15 @@ class SAND(object):
 
     def _build_graph(self):
         start_t = time.time()
-        self._embedding()
-        self._self_attention()
-        self._interpolation()
-        if self.is_point:
-            self._point_label()
-        else:
-            self._seq_label()
-        self._compute_loss()
+        with jit_scope(self.xla == 'scope'):
+            self._embedding()
+            self._self_attention()
+            self._interpolation()
+            if self.is_point:
+                self._point_label()
+            else:
+                self._seq_label()
+            self._compute_loss()
         self._create_train_op()
         self.logger.info('Time to build graph: {} s'.format(time.time() - start_t))
 
@@ -156,7 +166,12 @@ class SAND(object):
             # self.train_op = self.optimizer.apply_gradients(zip(self.grads, self.all_params),
             #                                                global_step=self.global_step)
             # self.train_op = self.optimizer.minimize(self.loss, global_step=self.global_step)
-            grads = self.optimizer.compute_gradients(self.loss)
-            gradients, variables = zip(*grads)
-            capped_grads, _ = tf.clip_by_global_norm(gradients, 25)
-            self.train_op = self.optimizer.apply_gradients(zip(capped_grads, variables), global_step=self.global_step)
+            if self.accum_steps > 1:
+                self.accum_op, self.train_op = accumulate_gradients(self.optimizer, self.loss, self.accum_steps, 25,
+                                                                    self.global_step)
+            else:
+                grads = self.optimizer.compute_gradients(self.loss)
+                gradients, variables = zip(*grads)
+                capped_grads, _ = tf.clip_by_global_norm(gradients, 25)
+                self.train_op = self.optimizer.apply_gradients(zip(capped_grads, variables),
+                                                               global_step=self.global_step)
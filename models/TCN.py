@@ -2,7 +2,7 @@ import tensorflow as tf
 import tensorflow.contrib as tc
 import time
 from .cnn_module import TemporalConvNet
-from .nn_module import seq_loss, focal_loss, point_loss
+from .nn_module import seq_loss, focal_loss, point_loss, jit_scope
 
 
 class TCN(object):
@@ -20,6 +20,7 @@ class TCN(object):
         self.opt_type = args.optim
         self.dropout_keep_prob = args.dropout_keep_prob
         self.weight_decay = args.weight_decay
+        self.xla = args.xla
 
         self.id, self.index, self.medicine, self.seq_len, self.org_len, self.labels = batch.get_next()
         self.N = tf.shape(self.id)[0]
@@ -49,13 +50,15 @@ class TCN(object):
 
     def _build_graph(self, args):
         start_t = time.time()
-        self._map(args)
-        self._tcn(args)
-        if self.is_point:
-            self._point_label()
-        else:
-            self._seq_label()
-        self._compute_loss()
+        # 输入在 _map 中被 reshape 到 args.max_len，长度本就是静态的
+        with jit_scope(self.xla == 'scope'):
+            self._map(args)
+            self._tcn(args)
+            if self.is_point:
+                self._point_label()
+            else:
+                self._seq_label()
+            self._compute_loss()
         # 选择优化算法
         self._create_train_op()
         self.logger.info('Time to build graph: {} s'.format(time.time() - start_t))
@@ -6,16 +6,45 @@ import numpy as np
 _NEG_INF = -1e9
 
 
-def self_transformer(embedded_x, embedded_y, inputs_padding, n_block, n_hidden, n_head, keep_prob, is_ff, is_train):
-    attention_bias = get_padding_bias(inputs_padding)
+def self_transformer(embedded_x, embedded_y, inputs_padding, n_block, n_hidden, n_head, keep_prob, is_ff, is_train,
+                     causal=False, encoder_stack=None, window=None, chunk=None, segment_ids=None, recompute=False):
+    if causal and window:
+        raise NotImplementedError('Sliding window attention is not supported for causal stacks')
+    if segment_ids is not None and window:
+        raise NotImplementedError('Sliding window attention is not supported for segment ids')
+    if segment_ids is not None:
+        attention_bias = get_segment_bias(segment_ids)
+    else:
+        attention_bias = get_padding_bias(inputs_padding, window)
+    if causal:
+        attention_bias += get_causal_bias(tf.shape(inputs_padding)[1])
     if is_train:
         embedded_x = tf.nn.dropout(embedded_x, rate=1 - keep_prob)
         embedded_y = tf.nn.dropout(embedded_y, rate=1 - keep_prob)
-    encoder_stack = EncoderStack(n_block, n_hidden, n_head, keep_prob, is_train, is_ff)
+    if encoder_stack is None:
+        encoder_stack = EncoderStack(n_block, n_hidden, n_head, keep_prob, is_train, is_ff, window=window,
+                                     chunk=chunk, recompute=recompute)
     encoder_outputs = encoder_stack(embedded_x, embedded_y, attention_bias, inputs_padding)
     return encoder_outputs
 
 
+def transformer_step(encoder_stack, step_x, step_y, cache):
+    """Runs an already built encoder stack on the newest step only.
+
+    Args:
+      encoder_stack: EncoderStack that has been called on full sequences with a causal bias
+      step_x: tensor with shape [batch_size, 1, hidden_size]
+      step_y: tensor with shape [batch_size, 1, hidden_size]
+      cache: dictionary {"layer_n": {"k": tensor, "v": tensor}} holding the keys and values of the previous
+        steps, with shape [batch_size, i, hidden_size]. The new step is appended in place.
+
+    Returns:
+      Output of the stack for the new step, float32 tensor with shape [batch_size, 1, hidden_size]
+    """
+    # The new step may attend to every cached step, so only padding has to be masked and there is none
+    return encoder_stack(step_x, step_y, 0., None, cache=cache)
+
+
 class EncoderStack(tf.layers.Layer):
     """Transformer encoder stack.
 
@@ -23,17 +52,24 @@ class EncoderStack(tf.layers.Layer):
     of the sublayers:
       1. Self-attention layer
       2. Feedforward network (which is 2 fully-connected layers)
+
+    With recompute, the activations inside a layer are not kept for the backward pass but
+    recomputed from the layer inputs (tf.contrib.layers.recompute_grad), which trades one
+    more forward pass of the stack for memory. Its variables are then resource variables,
+    as recompute_grad requires, with the same names, so checkpoints stay compatible.
     """
 
-    def __init__(self, n_block, n_hidden, n_head, keep_prob, is_train, is_ffn_pad=True, is_ff=True):
+    def __init__(self, n_block, n_hidden, n_head, keep_prob, is_train, is_ffn_pad=True, is_ff=True, window=None,
+                 chunk=None, recompute=False):
         super(EncoderStack, self).__init__()
         self.layers = []
         self.is_ff = is_ff
+        self.recompute = recompute
         dropout = 1 - keep_prob
         for _ in range(n_block):
             # Create sublayers for each layer.
             # self_attention_layer = SelfAttention(n_hidden, n_head, keep_prob, is_train)
-            self_attention_layer = Attention(n_hidden, n_head, dropout, is_train)
+            self_attention_layer = Attention(n_hidden, n_head, dropout, is_train, window, chunk)
             if self.is_ff:
                 feed_forward_network = FeedFowardNetwork(n_hidden, 2 * n_hidden, dropout, is_train, is_ffn_pad)
 
@@ -45,7 +81,7 @@ class EncoderStack(tf.layers.Layer):
         # Create final layer normalization layer.
         self.output_normalization = LayerNormalization(n_hidden)
 
-    def call(self, inputs_x, inputs_y, attention_bias, inputs_padding):
+    def call(self, inputs_x, inputs_y, attention_bias, inputs_padding, cache=None):
         """Return the output of the encoder layer stacks.
 
         Args:
@@ -53,31 +89,136 @@ class EncoderStack(tf.layers.Layer):
           attention_bias: bias for the encoder self-attention layer.
             [batch_size, 1, 1, input_length]
           inputs_padding: P
+          cache: (Used during online prediction) dictionary of per-layer attention caches,
+            {"layer_n": {"k": ..., "v": ...}}, see Attention.call
 
         Returns:
           Output of encoder layer stack.
           float32 tensor with shape [batch_size, input_length, hidden_size]
         """
-        for n, layer in enumerate(self.layers):
-            # Run inputs through the sublayers.
-            self_attention_layer = layer[0]
-            if self.is_ff:
-                feed_forward_network = layer[1]
-
+        if self.recompute and cache is None:
+            return self._recompute_call(inputs_x, inputs_y, attention_bias, inputs_padding)
+        for n in range(len(self.layers)):
             with tf.variable_scope("layer_%d" % n):
-                with tf.variable_scope("self_attention"):
-                    encoder_outputs = self_attention_layer(inputs_x, inputs_y, attention_bias)
-                if self.is_ff:
-                    with tf.variable_scope("ffn"):
-                        encoder_outputs = feed_forward_network(encoder_outputs, inputs_padding)
+                layer_cache = cache["layer_%d" % n] if cache is not None else None
+                encoder_outputs = self._layer(n, inputs_x, inputs_y, attention_bias, inputs_padding, cache=layer_cache)
 
         return self.output_normalization(encoder_outputs)
 
+    def _layer(self, n, inputs_x, inputs_y, attention_bias, inputs_padding, cache=None, seed=None):
+        # Run inputs through the sublayers.
+        layer = self.layers[n]
+        with tf.variable_scope("self_attention"):
+            encoder_outputs = layer[0](inputs_x, inputs_y, attention_bias, cache=cache, seed=seed)
+        if self.is_ff:
+            with tf.variable_scope("ffn"):
+                encoder_outputs = layer[1](encoder_outputs, inputs_padding,
+                                           seed=None if seed is None else seed + [0, 2])
+        return encoder_outputs
+
+    def _recompute_call(self, inputs_x, inputs_y, attention_bias, inputs_padding):
+        # 反向时会再跑一遍每层的前向，dropout 用同一个 seed 的 stateless mask，保证两次前向一致
+        seed = tf.random.uniform([2], maxval=2 ** 31 - 1, dtype=tf.int64)
+        attention_bias = tf.convert_to_tensor(attention_bias)
+        inputs_padding = tf.convert_to_tensor(inputs_padding)
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+            for n in range(len(self.layers)):
+                def layer_fn(x, y, bias, padding, layer_seed, n=n):
+                    return self._layer(n, x, y, bias, padding, seed=layer_seed)
+
+                with tf.variable_scope("layer_%d" % n):
+                    # every layer has four dropouts, see _layer and PrePostProcessingWrapper
+                    encoder_outputs = tc.layers.recompute_grad(layer_fn)(inputs_x, inputs_y, attention_bias,
+                                                                         inputs_padding, seed + [0, 4 * n])
+
+            return self.output_normalization(encoder_outputs)
+
+
+def shared_input_transformer(embedded_index, embedded_medicine, inputs_padding, n_block, n_hidden, n_head, keep_prob,
+                             is_train, window=None, chunk=None, segment_ids=None):
+    """The i2m, m2i, i2i and m2m input attentions of DIMM built on shared per-stream projections.
+
+    Returns:
+      Tuple of the i2m, m2i, i2i and m2m encodings, each [batch_size, length, hidden_size]
+    """
+    if segment_ids is not None and window:
+        raise NotImplementedError('Sliding window attention is not supported for segment ids')
+    if segment_ids is not None:
+        attention_bias = get_segment_bias(segment_ids)
+    else:
+        attention_bias = get_padding_bias(inputs_padding, window)
+    if is_train:
+        embedded_index = tf.nn.dropout(embedded_index, rate=1 - keep_prob)
+        embedded_medicine = tf.nn.dropout(embedded_medicine, rate=1 - keep_prob)
+    shared_stacks = SharedInputStacks(n_block, n_hidden, n_head, keep_prob, is_train, window=window, chunk=chunk)
+    return shared_stacks(embedded_index, embedded_medicine, attention_bias)
+
+
+class SharedInputStacks(tf.layers.Layer):
+    """Input attention stacks of the index and medicine streams with shared projections.
+
+    Same layout as four EncoderStacks (i2m, m2i, i2i, m2m) without FFN padding removal, except that in
+    every layer each stream is layer-normalized and projected to keys and values once. i2m and i2i share
+    the normalized index as query input and m2i and i2i share the index keys and values, likewise for
+    medicine. Each attention keeps its own query and output projections and feed forward network.
+    """
+    pairs = [('i2m', 'index', 'medicine'), ('m2i', 'medicine', 'index'),
+             ('i2i', 'index', 'index'), ('m2m', 'medicine', 'medicine')]
+
+    def __init__(self, n_block, n_hidden, n_head, keep_prob, is_train, window=None, chunk=None):
+        super(SharedInputStacks, self).__init__()
+        self.train = is_train
+        self.dropout = 1 - keep_prob
+        self.layers = []
+        for _ in range(n_block):
+            self.layers.append({
+                'norm': {stream: LayerNormalization(n_hidden) for stream in ['index', 'medicine']},
+                'k': {stream: tf.layers.Dense(n_hidden, use_bias=False, name="k_" + stream)
+                      for stream in ['index', 'medicine']},
+                'v': {stream: tf.layers.Dense(n_hidden, use_bias=False, name="v_" + stream)
+                      for stream in ['index', 'medicine']},
+                'attention': {pair: Attention(n_hidden, n_head, self.dropout, is_train, window, chunk)
+                              for pair, _, _ in self.pairs},
+                'ffn': {pair: PrePostProcessingWrapper(
+                    FeedFowardNetwork(n_hidden, 2 * n_hidden, self.dropout, is_train, False), n_hidden, self.dropout,
+                    is_train) for pair, _, _ in self.pairs}})
+        self.output_normalization = {pair: LayerNormalization(n_hidden) for pair, _, _ in self.pairs}
+
+    def call(self, inputs_index, inputs_medicine, attention_bias):
+        """Return the i2m, m2i, i2i and m2m encodings.
+
+        Args:
+          inputs_index: tensor with shape [batch_size, input_length, hidden_size]
+          inputs_medicine: tensor with shape [batch_size, input_length, hidden_size]
+          attention_bias: bias for the attention layers, see get_padding_bias
+
+        Returns:
+          Tuple of four tensors with shape [batch_size, input_length, hidden_size]
+        """
+        inputs = {'index': inputs_index, 'medicine': inputs_medicine}
+        outputs = {}
+        for n, layer in enumerate(self.layers):
+            with tf.variable_scope("layer_%d" % n):
+                with tf.variable_scope("shared"):
+                    norm = {stream: layer['norm'][stream](x) for stream, x in inputs.items()}
+                    kv = {stream: (layer['k'][stream](x), layer['v'][stream](x)) for stream, x in inputs.items()}
+                for pair, x, y in self.pairs:
+                    with tf.variable_scope(pair):
+                        with tf.variable_scope("self_attention"):
+                            encoder_outputs = layer['attention'][pair](norm[x], None, attention_bias, kv=kv[y])
+                            if self.train:
+                                encoder_outputs = tf.nn.dropout(encoder_outputs, rate=self.dropout)
+                            encoder_outputs += inputs[x]
+                        with tf.variable_scope("ffn"):
+                            outputs[pair] = layer['ffn'][pair](encoder_outputs)
+
+        return tuple(self.output_normalization[pair](outputs[pair]) for pair, _, _ in self.pairs)
+
 
 class Attention(tf.layers.Layer):
     """Multi-headed attention layer."""
 
-    def __init__(self, hidden_size, num_heads, attention_dropout, train):
+    def __init__(self, hidden_size, num_heads, attention_dropout, train, window=None, chunk=None):
         if hidden_size % num_heads != 0:
             raise ValueError("Hidden size must be evenly divisible by the number of heads.")
 
@@ -86,6 +227,10 @@ class Attention(tf.layers.Layer):
         self.num_heads = num_heads
         self.attention_dropout = attention_dropout
         self.train = train
+        # If set, every query only attends to the keys at most window steps away
+        self.window = window
+        # If set, full attention is computed chunk queries at a time, see chunked_attention
+        self.chunk = chunk
 
         # Layers for linearly projecting the queries, keys, and values.
         self.q_dense_layer = tf.layers.Dense(hidden_size, use_bias=False, name="q")
@@ -134,7 +279,45 @@ class Attention(tf.layers.Layer):
             x = tf.transpose(x, [0, 2, 1, 3])  # --> [batch, length, num_heads, depth]
             return tf.reshape(x, [batch_size, length, self.hidden_size])
 
-    def call(self, x, y, bias, cache=None):
+    def local_attention(self, q, k, v, bias, seed=None):
+        """Sliding window attention computed block by block.
+
+        Queries are cut into blocks of window steps and every block only attends to its own and the two
+        neighbouring key blocks, so memory and time grow linearly with the length.
+
+        Args:
+          q: a tensor with shape [batch_size, num_heads, length, depth]
+          k: a tensor with shape [batch_size, num_heads, length, depth]
+          v: a tensor with shape [batch_size, num_heads, length, depth]
+          bias: attention bias from get_padding_bias(x, window),
+            [batch_size, 1, n_block, window, 3 * window]
+          seed: (optional) seed of a stateless dropout mask, see dropout
+
+        Returns:
+          A tensor with shape [batch_size, num_heads, length, depth]
+        """
+        with tf.name_scope("local_attention"):
+            batch_size = tf.shape(q)[0]
+            length = tf.shape(q)[2]
+            depth = (self.hidden_size // self.num_heads)
+            n_block = (length + self.window - 1) // self.window
+            pad = n_block * self.window - length
+
+            q = tf.pad(q, [[0, 0], [0, 0], [0, pad], [0, 0]])
+            q = tf.reshape(q, [batch_size, self.num_heads, n_block, self.window, depth])
+            k = _neighbour_blocks(k, self.window, n_block, pad)
+            v = _neighbour_blocks(v, self.window, n_block, pad)
+
+            logits = tf.matmul(q, k, transpose_b=True)
+            logits += bias
+            weights = tf.nn.softmax(logits, name="attention_weights")
+            if self.train:
+                weights = dropout(weights, self.attention_dropout, seed)
+            attention_output = tf.matmul(weights, v)
+            attention_output = tf.reshape(attention_output, [batch_size, self.num_heads, n_block * self.window, depth])
+            return attention_output[:, :, :length]
+
+    def call(self, x, y, bias, cache=None, kv=None, seed=None):
         """Apply attention mechanism to x and y.
 
         Args:
@@ -146,6 +329,9 @@ class Attention(tf.layers.Layer):
                 {"k": tensor with shape [batch_size, i, key_channels],
                  "v": tensor with shape [batch_size, i, value_channels]}
             where i is the current decoded length.
+          kv: (Used by SharedInputStacks) tuple of keys and values of y that were
+            already projected, the k and v layers of this attention are not used.
+          seed: (Used by recomputed stacks) seed of stateless dropout masks, see dropout
 
         Returns:
           Attention layer output with shape [batch_size, length_x, hidden_size]
@@ -155,8 +341,11 @@ class Attention(tf.layers.Layer):
         # multiple heads. Multi-head attention uses multiple queries, keys, and
         # values rather than regular attention (which uses a single q, k, v).
         q = self.q_dense_layer(x)
-        k = self.k_dense_layer(y)
-        v = self.v_dense_layer(y)
+        if kv is not None:
+            k, v = kv
+        else:
+            k = self.k_dense_layer(y)
+            v = self.v_dense_layer(y)
 
         if cache is not None:
             # Combine cached keys and values with new keys and values.
@@ -176,13 +365,19 @@ class Attention(tf.layers.Layer):
         depth = (self.hidden_size // self.num_heads)
         q *= depth ** -0.5
 
-        # Calculate dot product attention
-        logits = tf.matmul(q, k, transpose_b=True)
-        logits += bias
-        weights = tf.nn.softmax(logits, name="attention_weights")
-        if self.train:
-            weights = tf.nn.dropout(weights, rate=self.attention_dropout)
-        attention_output = tf.matmul(weights, v)
+        if self.window and cache is None:
+            attention_output = self.local_attention(q, k, v, bias, seed)
+        elif self.chunk and cache is None:
+            attention_output = chunked_attention(q, k, v, bias, self.chunk,
+                                                 self.attention_dropout if self.train else 0., seed)
+        else:
+            # Calculate dot product attention
+            logits = tf.matmul(q, k, transpose_b=True)
+            logits += bias
+            weights = tf.nn.softmax(logits, name="attention_weights")
+            if self.train:
+                weights = dropout(weights, self.attention_dropout, seed)
+            attention_output = tf.matmul(weights, v)
 
         # Recombine heads --> [batch_size, length, hidden_size]
         attention_output = self.combine_heads(attention_output)
@@ -192,6 +387,103 @@ class Attention(tf.layers.Layer):
         return attention_output
 
 
+def chunked_attention(q, k, v, bias, chunk, dropout=0., seed=None):
+    """Exact dot product attention computed chunk queries at a time.
+
+    Only one [batch_size, num_heads, chunk, length_k] block of logits is alive at a time. The forward pass
+    keeps the log-sum-exp of every query row and the backward pass recomputes the weights of each chunk
+    from it instead of storing them, so peak memory is O(length * chunk) in training as well. The softmax
+    of a chunk spans all keys, so no rescaling between chunks is needed. Dropout masks are drawn from a
+    stateless generator seeded per call and chunk, so the backward pass sees the same masks.
+
+    Args:
+      q: a tensor with shape [batch_size, num_heads, length_q, depth], already scaled
+      k: a tensor with shape [batch_size, num_heads, length_k, depth]
+      v: a tensor with shape [batch_size, num_heads, length_k, depth]
+      bias: attention bias, [batch_size, 1, 1, length_k] or [batch_size, 1, length_q, length_k]
+      chunk: int, number of queries per chunk
+      dropout: dropout rate of the attention weights
+      seed: (optional) int64 tensor with shape [2] the masks are drawn from, a new one per run by default
+
+    Returns:
+      A tensor with shape [batch_size, num_heads, length_q, depth]
+    """
+    length = tf.shape(q)[2]
+    n_chunk = (length + chunk - 1) // chunk
+    pad = n_chunk * chunk - length
+    per_query = bias.get_shape().as_list()[2] != 1
+    if seed is None:
+        seed = tf.random.uniform([2], maxval=2 ** 31 - 1, dtype=tf.int64)
+
+    def stack_chunks(tensor_array):
+        x = tensor_array.stack()
+        shape = tf.shape(x)
+        x = tf.transpose(x, [1, 2, 0, 3, 4])
+        return tf.reshape(x, [shape[1], shape[2], n_chunk * chunk, shape[4]])
+
+    @tf.custom_gradient
+    def attention(q, k, v, bias):
+        q = tf.pad(q, [[0, 0], [0, 0], [0, pad], [0, 0]])
+        if per_query:
+            bias = tf.pad(bias, [[0, 0], [0, 0], [0, pad], [0, 0]])
+
+        def chunk_logits(i):
+            q_i = q[:, :, i * chunk:(i + 1) * chunk]
+            logits = tf.matmul(q_i, k, transpose_b=True)
+            logits += bias[:, :, i * chunk:(i + 1) * chunk] if per_query else bias
+            return q_i, logits
+
+        def dropout_mask(i, shape):
+            chunk_seed = tf.stack([seed[0], seed[1] + tf.to_int64(i)])
+            keep = tc.stateless.stateless_random_uniform(shape, chunk_seed) >= dropout
+            return tf.to_float(keep) / (1. - dropout)
+
+        def forward(i, outputs, lses):
+            _, logits = chunk_logits(i)
+            lse = tf.reduce_logsumexp(logits, axis=-1, keepdims=True)
+            weights = tf.exp(logits - lse)
+            if dropout:
+                weights *= dropout_mask(i, tf.shape(weights))
+            return i + 1, outputs.write(i, tf.matmul(weights, v)), lses.write(i, lse)
+
+        _, outputs, lses = tf.while_loop(lambda i, *_: i < n_chunk, forward,
+                                         [0, tf.TensorArray(tf.float32, n_chunk), tf.TensorArray(tf.float32, n_chunk)],
+                                         parallel_iterations=1)
+        outputs, lses = stack_chunks(outputs), stack_chunks(lses)
+
+        def grad(d_outputs):
+            d_outputs = tf.pad(d_outputs, [[0, 0], [0, 0], [0, pad], [0, 0]])
+            delta = tf.reduce_sum(d_outputs * outputs, axis=-1, keepdims=True)
+
+            def backward(i, d_q, d_k, d_v):
+                q_i, logits = chunk_logits(i)
+                rows = slice(i * chunk, (i + 1) * chunk)
+                weights = tf.exp(logits - lses[:, :, rows])
+                d_o = d_outputs[:, :, rows]
+                d_weights = tf.matmul(d_o, v, transpose_b=True)
+                if dropout:
+                    mask = dropout_mask(i, tf.shape(weights))
+                    d_v += tf.matmul(weights * mask, d_o, transpose_a=True)
+                    d_weights *= mask
+                else:
+                    d_v += tf.matmul(weights, d_o, transpose_a=True)
+                d_logits = weights * (d_weights - delta[:, :, rows])
+                d_k += tf.matmul(d_logits, q_i, transpose_a=True)
+                return i + 1, d_q.write(i, tf.matmul(d_logits, k)), d_k, d_v
+
+            _, d_q, d_k, d_v = tf.while_loop(lambda i, *_: i < n_chunk, backward,
+                                             [0, tf.TensorArray(tf.float32, n_chunk), tf.zeros_like(k),
+                                              tf.zeros_like(v)],
+                                             parallel_iterations=1)
+            # the bias only comes from the padding, it gets no gradient
+            return stack_chunks(d_q)[:, :, :length], d_k, d_v, None
+
+        return outputs[:, :, :length], grad
+
+    with tf.name_scope("chunked_attention"):
+        return attention(q, k, v, bias)
+
+
 class SelfAttention(Attention):
     """Multiheaded self-attention layer."""
 
@@ -215,7 +507,7 @@ class FeedFowardNetwork(tf.layers.Layer):
         self.output_dense_layer = tf.layers.Dense(
             hidden_size, use_bias=True, name="output_layer")
 
-    def call(self, x, padding=None):
+    def call(self, x, padding=None, seed=None):
         """Return outputs of the feedforward network.
 
         Args:
@@ -224,6 +516,7 @@ class FeedFowardNetwork(tf.layers.Layer):
             from x (provided self.allow_pad is set). The padding values are placed
             back in the output tensor in the same locations.
             shape [batch_size, length]
+          seed: (optional) seed of a stateless dropout mask, see dropout
 
         Returns:
           Output of the feedforward network.
@@ -252,7 +545,7 @@ class FeedFowardNetwork(tf.layers.Layer):
 
         output = self.filter_dense_layer(x)
         if self.train:
-            output = tf.nn.dropout(output, rate=self.relu_dropout)
+            output = dropout(output, self.relu_dropout, seed)
         output = self.output_dense_layer(output)
 
         if padding is not None:
@@ -298,18 +591,36 @@ class PrePostProcessingWrapper(object):
         self.layer_norm = LayerNormalization(n_hidden)
 
     def __call__(self, x, *args, **kwargs):
+        # The wrapped layer draws its masks from seed + [0, 1]
+        seed = kwargs.pop('seed', None)
+
         # Pre_processing: apply layer normalization
         y = self.layer_norm(x)
 
         # Get layer output
-        y = self.layer(y, *args, **kwargs)
+        y = self.layer(y, *args, seed=None if seed is None else seed + [0, 1], **kwargs)
 
         # Postprocessing: apply dropout and residual connection
         if self.train:
-            y = tf.nn.dropout(y, rate=self.process_dropout)
+            y = dropout(y, self.process_dropout, seed)
         return x + y
 
 
+def dropout(x, rate, seed=None):
+    """tf.nn.dropout, or with a seed, dropout with a mask from the stateless generator, so that running
+    the same ops again, as a recomputed layer does, drops the same units.
+
+    Args:
+      x: a float tensor
+      rate: dropout rate
+      seed: (optional) int64 tensor with shape [2]
+    """
+    if seed is None:
+        return tf.nn.dropout(x, rate=rate)
+    keep = tc.stateless.stateless_random_uniform(tf.shape(x), seed) >= rate
+    return x * tf.to_float(keep) / (1. - rate)
+
+
 def get_padding(x, padding_value=0):
     """Return float tensor representing the padding values in x.
 
@@ -325,7 +636,7 @@ def get_padding(x, padding_value=0):
         return tf.to_float(tf.equal(x, padding_value))
 
 
-def get_padding_bias(x):
+def get_padding_bias(x, window=None):
     """Calculate bias tensor from padding values in tensor.
 
     Bias tensor that is added to the pre-softmax multi-headed attention logits,
@@ -334,11 +645,77 @@ def get_padding_bias(x):
 
     Args:
       x: int tensor with shape [batch_size, length]
+      window: (Used by sliding window attention) the bias is laid out in query blocks
+        of window steps, see Attention.local_attention, and keys more than window steps
+        away from the query are masked as well.
 
     Returns:
-      Attention bias tensor of shape [batch_size, 1, 1, length].
+      Attention bias tensor of shape [batch_size, 1, 1, length], or
+      [batch_size, 1, n_block, window, 3 * window] when window is set.
     """
     with tf.name_scope("attention_bias"):
+        if window:
+            return _get_local_bias(x, window)
         attention_bias = x * _NEG_INF
         attention_bias = tf.expand_dims(tf.expand_dims(attention_bias, axis=1), axis=1)
     return attention_bias
+
+
+def _get_local_bias(x, window):
+    length = tf.shape(x)[1]
+    n_block = (length + window - 1) // window
+    pad = n_block * window - length
+    # Steps outside the sequence count as padding
+    x = tf.pad(tf.to_float(x), [[0, 0], [window, pad + window]], constant_values=1)
+    x = tf.reshape(x, [-1, n_block + 2, window])
+    x = tf.concat([x[:, :-2], x[:, 1:-1], x[:, 2:]], axis=2)
+    key_bias = tf.expand_dims(tf.expand_dims(x * _NEG_INF, axis=1), axis=3)
+
+    # Query r of a block sits at step r + window of its 3 * window keys
+    query_pos = tf.expand_dims(tf.range(window) + window, axis=1)
+    key_pos = tf.expand_dims(tf.range(3 * window), axis=0)
+    band_bias = tf.to_float(tf.abs(query_pos - key_pos) > window) * _NEG_INF
+    return key_bias + band_bias
+
+
+def _neighbour_blocks(x, window, n_block, pad):
+    """Frames [batch_size, num_heads, length, depth] into [batch_size, num_heads, n_block, 3 * window, depth],
+    block b holding steps (b - 1) * window to (b + 2) * window."""
+    shape = tf.shape(x)
+    x = tf.pad(x, [[0, 0], [0, 0], [window, pad + window], [0, 0]])
+    x = tf.reshape(x, [shape[0], shape[1], n_block + 2, window, shape[3]])
+    return tf.concat([x[:, :, :-2], x[:, :, 1:-1], x[:, :, 2:]], axis=3)
+
+
+def get_segment_bias(segment_ids):
+    """Calculate bias that restricts attention to the steps of the same segment.
+
+    Args:
+      segment_ids: int tensor with shape [batch_size, length], 0 at padding and the
+        same positive id at every step of one sequence
+
+    Returns:
+      Attention bias tensor of shape [batch_size, 1, length, length].
+    """
+    with tf.name_scope("segment_bias"):
+        same_segment = tf.equal(tf.expand_dims(segment_ids, 2), tf.expand_dims(segment_ids, 1))
+        valid_locs = tf.logical_and(same_segment, tf.expand_dims(tf.not_equal(segment_ids, 0), 1))
+        segment_bias = _NEG_INF * (1.0 - tf.to_float(valid_locs))
+        segment_bias = tf.expand_dims(segment_bias, axis=1)
+    return segment_bias
+
+
+def get_causal_bias(length):
+    """Calculate bias that masks attention to future positions.
+
+    Args:
+      length: int scalar, the sequence length
+
+    Returns:
+      Attention bias tensor of shape [1, 1, length, length], -1e9 above the diagonal.
+    """
+    with tf.name_scope("causal_bias"):
+        valid_locs = tf.matrix_band_part(tf.ones([length, length]), -1, 0)
+        causal_bias = _NEG_INF * (1.0 - valid_locs)
+        causal_bias = tf.reshape(causal_bias, [1, 1, length, length])
+    return causal_bias
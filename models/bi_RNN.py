@@ -2,7 +2,8 @@ import tensorflow as tf
 import tensorflow.contrib as tc
 import time
 from .rnn_module import cu_rnn, nor_rnn
-from .nn_module import dense, seq_loss, focal_loss, point_loss, multihead_attention, feedforward, label_smoothing
+from .nn_module import dense, seq_loss, focal_loss, point_loss, multihead_attention, feedforward, label_smoothing, \
+    bucket_length, jit_scope, accumulate_gradients
 from .attention_module import self_transformer
 
 
@@ -26,15 +27,27 @@ class bi_RNN_Model(object):
         self.opt_type = args.optim
         self.dropout_keep_prob = args.dropout_keep_prob
         self.weight_decay = args.weight_decay
+        self.xla = args.xla
+        # 梯度在 accum_steps 个小批次上累加后更新一次
+        self.accum_steps = args.accum_steps
+        self.accum_op = None
 
         self.id, self.index, self.medicine, self.seq_len, self.labels = batch.get_next()
         self.N = tf.shape(self.id)[0]
-        self.max_len = tf.reduce_max(self.seq_len)
+        if args.len_bucket and self.use_cudnn:
+            # cu_rnn 不跳过 padding，补齐的时间步会改变反向 RNN 的输出
+            raise NotImplementedError('Length buckets change the outputs of cu_rnn, set --use_cudnn False')
+        # 点预测取最后一个时间步，bucket 补齐后它不再是 max_len 的最后一步
+        if args.len_bucket and self.is_point:
+            raise NotImplementedError('Length buckets change the point predictions of BIGRU')
+        self.max_len = bucket_length(self.seq_len, args.len_bucket, tf.shape(self.index)[1])
         self.mask = tf.sequence_mask(self.seq_len, self.max_len, dtype=tf.float32, name='masks')
         self.padding = tf.sequence_mask(self.seq_len, self.max_len, dtype=tf.int32, name='padding')
         self.index = tf.slice(self.index, [0, 0, 0], tf.stack([self.N, self.max_len, self.n_index]))
         self.medicine = tf.slice(self.medicine, [0, 0, 0], tf.stack([self.N, self.max_len, self.n_medicine]))
-        self.lr = tf.get_variable('lr', shape=[], dtype=tf.float32, trainable=False)
+        # 初始值即为 args.lr：分布式训练中非 chief 的 worker 可能在 chief 设置学习率之前就开始更新
+        self.lr = tf.get_variable('lr', shape=[], dtype=tf.float32, trainable=False,
+                                  initializer=tf.constant_initializer(args.lr))
         self.is_train = tf.get_variable('is_train', shape=[], dtype=tf.bool, trainable=False)
         self.global_step = tf.get_variable('global_step', shape=[], dtype=tf.int32,
                                            initializer=tf.constant_initializer(0), trainable=False)
@@ -54,13 +67,14 @@ class bi_RNN_Model(object):
 
     def _build_graph(self):
         start_t = time.time()
-        self._encode()
-        self._rnn()
-        if self.is_point:
-            self._point_label()
-        else:
-            self._seq_label()
-        self._compute_loss()
+        with jit_scope(self.xla == 'scope'):
+            self._encode()
+            self._rnn()
+            if self.is_point:
+                self._point_label()
+            else:
+                self._seq_label()
+            self._compute_loss()
         if self.trainable:
             self._create_train_op()
         self.logger.info('Time to build graph: {} s'.format(time.time() - start_t))
@@ -151,8 +165,12 @@ class bi_RNN_Model(object):
             else:
                 raise NotImplementedError('Unsupported optimizer: {}'.format(self.opt_type))
             # self.grads, _ = tf.clip_by_global_norm(tf.gradients(self.loss, self.all_params), 25)
-            grads = self.optimizer.compute_gradients(self.loss)
-            gradients, variables = zip(*grads)
-            capped_grads, _ = tf.clip_by_global_norm(gradients, 25)
-            self.train_op = self.optimizer.apply_gradients(zip(capped_grads, variables),
-                                                           global_step=self.global_step)
+            if self.accum_steps > 1:
+                self.accum_op, self.train_op = accumulate_gradients(self.optimizer, self.loss, self.accum_steps, 25,
+                                                                    self.global_step)
+            else:
+                grads = self.optimizer.compute_gradients(self.loss)
+                gradients, variables = zip(*grads)
+                capped_grads, _ = tf.clip_by_global_norm(gradients, 25)
+                self.train_op = self.optimizer.apply_gradients(zip(capped_grads, variables),
+                                                               global_step=self.global_step)
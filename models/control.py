@@ -0,0 +1,51 @@
+import tensorflow as tf
+
+
+class TrainControl(object):
+    """
+    Feeds the lr, is_train and n_batch variables of a model through assign ops that are built once, so the
+    training loop does not add ops to the graph, which can then be finalized. Also fetches the global step
+    together with the train op, instead of in a separate run.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.values = {}
+        self.assigns = {}
+        for name in ['lr', 'is_train', 'n_batch']:
+            variable = getattr(model, name)
+            value = tf.placeholder(variable.dtype.base_dtype, shape=[], name='{}_value'.format(name))
+            self.values[name] = value
+            self.assigns[name] = tf.assign(variable, value)
+        with tf.control_dependencies([model.train_op]):
+            # global step after the update of this run
+            self.global_step = tf.identity(model.global_step.read_value())
+
+    def set(self, sess, **values):
+        """Assigns any of lr, is_train and n_batch in one run."""
+        sess.run([self.assigns[name] for name in values],
+                 feed_dict={self.values[name]: value for name, value in values.items()})
+
+    def train_step(self, sess, feed_dict=None, fetches=(), options=None, run_metadata=None, micro_metadata=None):
+        """
+        Runs the train op, returns the new global step and the loss, followed by any extra fetches. With
+        gradient accumulation the first accum_steps - 1 micro-batches only accumulate, the loss is their mean
+        and the extra fetches and run metadata are those of the last micro-batch. If micro_metadata is a list,
+        the other micro-batches also run with options and their run metadata are appended to it.
+        """
+        if self.model.accum_op is None:
+            return sess.run([self.global_step, self.model.loss] + list(fetches), feed_dict=feed_dict,
+                            options=options, run_metadata=run_metadata)
+        losses = []
+        for _ in range(self.model.accum_steps - 1):
+            if micro_metadata is None:
+                loss = sess.run([self.model.accum_op, self.model.loss], feed_dict=feed_dict)[1]
+            else:
+                micro_metadata.append(tf.RunMetadata())
+                loss = sess.run([self.model.accum_op, self.model.loss], feed_dict=feed_dict, options=options,
+                                run_metadata=micro_metadata[-1])[1]
+            losses.append(loss)
+        results = sess.run([self.global_step, self.model.loss] + list(fetches), feed_dict=feed_dict,
+                           options=options, run_metadata=run_metadata)
+        results[1] = sum(losses + [results[1]]) / self.model.accum_steps
+        return results
@@ -2,7 +2,7 @@ import tensorflow as tf
 import tensorflow.contrib as tc
 import time
 from .rnn_module import cu_rnn, nor_rnn
-from .nn_module import dense, seq_loss, focal_loss, point_loss, label_smoothing
+from .nn_module import dense, seq_loss, focal_loss, point_loss, label_smoothing, accumulate_gradients
 from .attention_module import self_transformer
 
 
@@ -33,6 +33,9 @@ class Joint_DIMM_Model(object):
         self.opt_type = args.optim
         self.dropout_keep_prob = args.dropout_keep_prob
         self.weight_decay = args.weight_decay
+        # 梯度在 accum_steps 个小批次上累加后更新一次
+        self.accum_steps = args.accum_steps
+        self.accum_op = None
 
         self.id, self.index, self.medicine, self.seq_len, self.mor_labels, self.dis_labels = batch.get_next()
         self.N = tf.shape(self.id)[0]
@@ -184,6 +187,10 @@ class Joint_DIMM_Model(object):
                 self.optimizer = tf.train.GradientDescentOptimizer(self.lr)
             else:
                 raise NotImplementedError('Unsupported optimizer: {}'.format(self.opt_type))
-            self.grads, _ = tf.clip_by_global_norm(tf.gradients(self.loss, self.all_params), 25)
-            self.train_op = self.optimizer.apply_gradients(zip(self.grads, self.all_params),
-                                                           global_step=self.global_step)
+            if self.accum_steps > 1:
+                self.accum_op, self.train_op = accumulate_gradients(self.optimizer, self.loss, self.accum_steps, 25,
+                                                                    self.global_step, self.all_params)
+            else:
+                self.grads, _ = tf.clip_by_global_norm(tf.gradients(self.loss, self.all_params), 25)
+                self.train_op = self.optimizer.apply_gradients(zip(self.grads, self.all_params),
+                                                               global_step=self.global_step)
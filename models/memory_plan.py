@@ -0,0 +1,163 @@
+"""
+Peak memory estimates of DIMM_Model and the batch sizes that fit in a memory budget. Only the config is
+needed, no graph is built, so the batch sizes can be planned before the input pipeline is. The estimates
+count the float32 tensors of the longest batch, [batch, max_len]. The copy counts below are read off the graph,
+not fitted; bench_memory.py reports the measured / estimated ratio to calibrate them against.
+"""
+
+_FLOAT = 4
+# copies of the [batch, heads, length_q, length_k] attention tensors a layer keeps for the backward pass:
+# softmax weights, dropout mask and dropped weights
+_SCORES_KEPT = 3
+# copies alive while a layer computes its scores, or back-propagates through them
+_SCORES_TRANSIENT = 3
+# copies of the [batch, length, units] tensors a layer keeps for the backward pass: two layer norms, q/k/v
+# and their split heads, attention and projection outputs, the 2 * units filter layer of the FFN, dropout
+# masks and residuals
+_STEPS_KEPT = 30
+_STEPS_TRANSIENT = 6
+# dropout of the two stack inputs and the output layer norm
+_STACK_KEPT = 8
+# per step and unit of the GRU: transposed inputs and outputs, the cuDNN reserve space with the gates
+_RNN_KEPT = 8
+# slot variables of the optimizers, see DIMM_Model._create_train_op
+_OPTIM_SLOTS = {'adam': 2, 'rprop': 2, 'adagrad': 1, 'sgd': 0}
+
+
+def stack_params(n_block, n_unit):
+    # q, k, v and output projections, the two FFN layers with biases, two layer norms per layer, output norm
+    return n_block * (8 * n_unit ** 2 + 7 * n_unit) + 2 * n_unit
+
+
+def stack_bytes(batch, length, n_block, n_unit, n_head, train, window=None, chunk=None, recompute=False):
+    """
+    Activation memory of an EncoderStack.
+    Returns:
+        bytes kept for the backward pass, 0 if not train, and the peak bytes one layer adds on top while it
+        runs forward or backward
+    """
+    if window:
+        n_query, n_key = -(-length // window) * window, 3 * window
+    else:
+        n_query, n_key = length, length
+    scores = batch * n_head * n_query * n_key * _FLOAT
+    if chunk and not window:
+        # 只有一个 chunk 的 logits 同时存在，反向时由 log-sum-exp 重算
+        scores_kept, scores_transient = 0, scores * min(chunk, n_query) // n_query * _SCORES_TRANSIENT
+    else:
+        scores_kept, scores_transient = scores * _SCORES_KEPT, scores * _SCORES_TRANSIENT
+    steps = batch * length * n_unit * _FLOAT
+    layer_kept = scores_kept + steps * _STEPS_KEPT
+    transient = scores_transient + steps * _STEPS_TRANSIENT
+    if not train:
+        return 0, transient
+    if recompute:
+        # 只保留每层的两个输入，反向时一层的激活被重新计算出来
+        return steps * (_STACK_KEPT + 2 * n_block), layer_kept + transient
+    return steps * _STACK_KEPT + n_block * layer_kept, transient
+
+
+def estimate_memory(config, dim, batch, train=True, causal=False):
+    """
+    Estimated peak memory of a DIMM_Model train step on batch stays of config.max_len steps, or with train
+    False of an evaluation batch run in the same session as the training.
+    Args:
+        config: the single_main arguments of the model
+        dim: the index and medicine dims of the records
+        batch: the batch size
+        train: whether the batch is a train step or an evaluation
+        causal: the DIMM_causal variant
+    Returns:
+        dict of bytes: params (variables with their gradients and optimizer slots), inputs, input_attention,
+        rnn and step_attention (activations kept for the backward pass, or alive between the parts in an
+        evaluation), peak_layer (the largest layer running on top of them) and total
+    """
+    n_index, n_medicine = dim
+    length, n_hidden = config.max_len, config.n_hidden
+    n_dir = 1 if causal or not config.is_bi else 2
+    steps = batch * length * _FLOAT
+    # attention bias of every stack: [batch, 1, T, T] with packed stays or a causal mask, else [batch, 1, 1, T]
+    bias = steps * length if causal or config.pack_stays else steps
+
+    n_param = 0
+    if config.is_map:
+        n_param += (n_index + 1) * n_hidden + (n_medicine + 1) * n_hidden
+        units = [n_hidden, n_hidden]
+    else:
+        units = [n_index, n_medicine]
+    inputs_kept = steps * (n_index + n_medicine) * 2 + steps * sum(units) * 2
+
+    stacks = []
+    if config.ipt_att:
+        # i2m 与 i2i 的宽度为 index 的宽度，m2i 与 m2m 为 medicine 的宽度
+        if config.inter_att:
+            stacks += units
+        if config.intra_att:
+            stacks += units
+    ipt_kept, transients = 0, [0]
+    for n_unit in stacks:
+        n_param += stack_params(config.block_ipt, n_unit)
+        kept, transient = stack_bytes(batch, length, config.block_ipt, n_unit, config.head_ipt, train,
+                                      config.window_ipt, config.att_chunk, config.recompute)
+        ipt_kept += kept + bias
+        transients.append(transient)
+    if config.ipt_att and config.inter_att and config.intra_att:
+        n_input = 2 * sum(units)
+    else:
+        n_input = sum(units)
+    # 拼接后的输入及其 dropout
+    ipt_kept += steps * n_input * 3
+
+    n_in = n_input
+    for _ in range(config.n_layer):
+        n_param += n_dir * 3 * ((n_in + n_hidden + 2) * n_hidden)
+        n_in = n_dir * n_hidden
+    rnn_kept = steps * n_dir * n_hidden * (_RNN_KEPT * config.n_layer + 3)
+    transients.append(steps * n_dir * n_hidden * _RNN_KEPT)
+
+    n_unit = n_dir * n_hidden
+    stp_kept = 0
+    if config.step_att:
+        n_param += stack_params(config.block_stp, n_unit)
+        kept, transient = stack_bytes(batch, length, config.block_stp, n_unit, config.head_stp, train,
+                                      config.window_stp, config.att_chunk, config.recompute)
+        stp_kept = kept + bias
+        transients.append(transient)
+    n_param += (n_unit + 1) * config.n_class
+    # 输出层、softmax 与 loss
+    stp_kept += steps * (n_unit + 4 * config.n_class)
+
+    # 评估时各部分的激活用完即释放，只有相邻两部分之间的输出同时存在
+    if not train:
+        inputs_kept = steps * (n_index + n_medicine) * 2
+        ipt_kept = steps * n_input
+        rnn_kept = steps * n_unit
+        stp_kept = steps * n_unit
+    slots = _OPTIM_SLOTS.get(config.optim, 2) + (1 if config.accum_steps > 1 else 0)
+    # 评估时变量与优化器的 slot 仍在同一个 session 中，训练时还有梯度
+    params = n_param * _FLOAT * (1 + slots + (1 if train else 0))
+    memory = {'params': params, 'inputs': inputs_kept, 'input_attention': ipt_kept, 'rnn': rnn_kept,
+              'step_attention': stp_kept, 'peak_layer': max(transients)}
+    memory['total'] = sum(memory.values())
+    return memory
+
+
+def plan_batch_size(config, dim, budget, train=True, causal=False, safety=0.85, limit=4096):
+    """
+    Largest batch size whose estimated peak memory stays below safety * budget, rounded down to a multiple
+    of 8 from 8 on. The estimate grows linearly with the batch size, so it is solved for directly.
+    Args:
+        budget: memory budget in bytes
+        safety: the fraction of the budget to plan for, the rest is left for the allocator's fragmentation
+            and the cuDNN workspaces
+        limit: the largest batch size returned
+    Returns:
+        the batch size, 0 if not even one stay fits, and its estimated peak memory in bytes
+    """
+    fixed = estimate_memory(config, dim, 0, train, causal)['total']
+    per_stay = estimate_memory(config, dim, 1, train, causal)['total'] - fixed
+    batch = int(max(safety * budget - fixed, 0) // per_stay)
+    batch = min(batch, limit)
+    if batch >= 8:
+        batch -= batch % 8
+    return batch, estimate_memory(config, dim, batch, train, causal)['total']
@@ -1,3 +1,4 @@
+import contextlib
 import tensorflow as tf
 import tensorflow.contrib as tc
 from tensorflow.python.ops import array_ops
@@ -26,6 +27,75 @@ def seq_loss(logits, targets, mask):
     return loss
 
 
+def pack(inputs, nonpad_ids):
+    """Gathers the real steps of a padded [batch, length, ...] tensor into [n_real, ...]."""
+    return tf.gather_nd(inputs, nonpad_ids)
+
+
+def unpack(inputs, nonpad_ids, batch_size, length):
+    """Scatters packed steps back to [batch, length, ...], padded steps are zeros."""
+    shape = tf.concat([tf.stack([batch_size, length]), tf.shape(inputs)[1:]], axis=0)
+    outputs = tf.scatter_nd(nonpad_ids, inputs, shape)
+    outputs.set_shape([None, None] + inputs.get_shape().as_list()[1:])
+    return outputs
+
+
+def segment_rows(segment_ids, nonpad_ids):
+    """Positions of the packed steps when every segment is put in a row of its own.
+
+    Args:
+      segment_ids: int tensor [batch, length], 0 at padding and 1..k for the contiguous segments of a row
+      nonpad_ids: [n_real, 2] positions of the real steps, as used by pack
+    Returns:
+      [n_real, 2] (segment, step) positions for unpack, and the length of every segment
+    """
+    seg = tf.gather_nd(segment_ids, nonpad_ids)
+    n_per_row = tf.reduce_max(segment_ids, axis=1)
+    n_segment = tf.reduce_sum(n_per_row)
+    seg_idx = tf.gather(tf.cumsum(n_per_row, exclusive=True), nonpad_ids[:, 0]) + seg - 1
+    starts = tf.unsorted_segment_min(nonpad_ids[:, 1], seg_idx, n_segment)
+    step_idx = nonpad_ids[:, 1] - tf.gather(starts, seg_idx)
+    seg_len = tf.unsorted_segment_sum(tf.ones_like(seg_idx), seg_idx, n_segment)
+    return tf.stack([seg_idx, step_idx], axis=1), seg_len
+
+
+def bucket_length(seq_len, bucket, limit):
+    """Rounds the batch length up to a multiple of bucket, so at most limit / bucket distinct shapes occur."""
+    length = tf.reduce_max(seq_len)
+    if not bucket:
+        return length
+    return tf.minimum((length + bucket - 1) // bucket * bucket, limit)
+
+
+def jit_scope(enabled):
+    """XLA compiles the ops built in this scope and their gradients if enabled, a no-op context otherwise."""
+    return tc.compiler.jit.experimental_jit_scope() if enabled else contextlib.ExitStack()
+
+
+def accumulate_gradients(optimizer, loss, accum_steps, clip_norm, global_step, var_list=None):
+    """
+    Gradient accumulation over accum_steps micro-batches. The accumulators are local variables, they are not
+    saved with the model and need tf.local_variables_initializer.
+    Returns:
+        accum_op, which adds the gradients of loss to the accumulators, and train_op, which adds those of the
+        last micro-batch, applies the mean of the accumulated gradients clipped by global norm, and resets
+        the accumulators
+    """
+    grads_and_vars = [(g, v) for g, v in optimizer.compute_gradients(loss, var_list) if g is not None]
+    # cuDNN GRU 的 opaque_kernel 没有静态 shape，累加器按运行时的 shape 创建
+    accums = [tf.Variable(tf.zeros_like(v.initialized_value(), dtype=v.dtype.base_dtype), trainable=False,
+                          validate_shape=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                          name=v.op.name.replace('/', '_') + '_accum')
+              for _, v in grads_and_vars]
+    accum_op = tf.group(*[tf.assign_add(a, tf.convert_to_tensor(g)) for a, (g, _) in zip(accums, grads_and_vars)])
+    summed = [tf.assign_add(a, tf.convert_to_tensor(g)) for a, (g, _) in zip(accums, grads_and_vars)]
+    capped_grads, _ = tf.clip_by_global_norm([s / accum_steps for s in summed], clip_norm)
+    apply_op = optimizer.apply_gradients(zip(capped_grads, [v for _, v in grads_and_vars]), global_step=global_step)
+    with tf.control_dependencies([apply_op]):
+        train_op = tf.group(*[tf.assign(a, tf.zeros_like(a)) for a in accums])
+    return accum_op, train_op
+
+
 def focal_loss(logits, targets, mask):
     def focal(labels, logits):
         alpha, gamma = 0.75, 4
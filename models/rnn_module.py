@@ -3,21 +3,36 @@ import tensorflow.contrib as tc
 # from tensorflow.contrib.cudnn_rnn.python.layers import cudnn_rnn
 # from tensorflow.contrib import cudnn_rnn
 
+_gpu_available = None
 
-def cu_rnn(rnn_type, inputs, hidden_size, batch_size, training, layer_num=1):
+
+def default_cudnn_compatible():
+    """
+    Whether cuDNN GRU weights have to run on cu_compatible_rnn, i.e. there is no CUDA GPU. The GPU is probed
+    once, when the first graph needs it, instead of on import.
+    """
+    global _gpu_available
+    if _gpu_available is None:
+        _gpu_available = tf.test.is_gpu_available(cuda_only=True)
+    return not _gpu_available
+
+
+def cu_rnn(rnn_type, inputs, hidden_size, batch_size, training, layer_num=1, sequence_lengths=None):
+    # 给定 sequence_lengths 时 cuDNN 跳过 padding，反向也从真实的最后一步开始
+    kwargs = {} if sequence_lengths is None else {'sequence_lengths': sequence_lengths}
     if not rnn_type.startswith('bi'):
         cell = get_cu_cell(rnn_type, hidden_size, layer_num, 'unidirectional')
         inputs = tf.transpose(inputs, [1, 0, 2])
         c = tf.zeros([layer_num, batch_size, hidden_size], tf.float32)
         h = tf.zeros([layer_num, batch_size, hidden_size], tf.float32)
-        outputs, state = cell(inputs)
+        outputs, state = cell(inputs, **kwargs)
         if rnn_type.endswith('lstm'):
             c, h = state
             state = h
     else:
         cell = get_cu_cell(rnn_type, hidden_size, layer_num, 'bidirectional')
         inputs = tf.transpose(inputs, [1, 0, 2])
-        outputs, state = cell(inputs)
+        outputs, state = cell(inputs, **kwargs)
         # if concat:
         #     state = tf.concat([state_fw, state_bw], 1)
         # else:
@@ -26,6 +41,41 @@ def cu_rnn(rnn_type, inputs, hidden_size, batch_size, training, layer_num=1):
     return outputs, state
 
 
+def cu_compatible_rnn(rnn_type, inputs, hidden_size, layer_num=1, sequence_length=None):
+    """
+    CPU version of cu_rnn for GRU. CudnnCompatibleGRUCell follows the cuDNN GRU equations and its variables
+    are created under the canonical names a CudnnGRU layer writes to checkpoints, so weights trained with
+    cu_rnn restore into it. Call it in the variable scope cu_rnn was called in. As in cu_rnn the padded steps
+    are run as well, which keeps the outputs identical to the cuDNN graph.
+    Args:
+        rnn_type: 'gru' or 'bi-gru'
+        inputs: padded inputs into rnn, batch major
+        hidden_size: the size of hidden units
+        layer_num: multiple rnn layer are stacked if layer_num > 1
+        sequence_length: if set, padded steps are skipped as in cu_rnn with sequence_lengths
+    Returns:
+        RNN outputs, forward and backward outputs are concatenated, and final state
+    """
+    if not rnn_type.endswith('gru'):
+        raise NotImplementedError('Unsuported rnn type: {}'.format(rnn_type))
+    with tf.variable_scope('cudnn_gru'):
+        if not rnn_type.startswith('bi'):
+            cell = get_cu_compatible_cell(hidden_size, layer_num)
+            outputs, state = tf.nn.dynamic_rnn(cell, inputs, sequence_length=sequence_length, dtype=tf.float32)
+        else:
+            cells_fw = [tc.cudnn_rnn.CudnnCompatibleGRUCell(hidden_size) for _ in range(layer_num)]
+            cells_bw = [tc.cudnn_rnn.CudnnCompatibleGRUCell(hidden_size) for _ in range(layer_num)]
+            outputs, state_fw, state_bw = tc.rnn.stack_bidirectional_dynamic_rnn(
+                cells_fw, cells_bw, inputs, sequence_length=sequence_length, dtype=tf.float32)
+            state = (state_fw, state_bw)
+    return outputs, state
+
+
+def get_cu_compatible_cell(hidden_size, layer_num=1):
+    # 变量名需要与 CudnnGRU 的 canonical 名称一致，单层也要包一层 MultiRNNCell
+    return tc.rnn.MultiRNNCell([tc.cudnn_rnn.CudnnCompatibleGRUCell(hidden_size) for _ in range(layer_num)])
+
+
 def get_cu_cell(rnn_type, hidden_size, layer_num=1, direction='bidirectional'):
     if rnn_type.endswith('lstm'):
         cudnn_cell = tc.cudnn_rnn.CudnnLSTM(num_layers=layer_num, num_units=hidden_size, direction=direction,
@@ -76,6 +126,8 @@ def nor_rnn(rnn_type, inputs, length, hidden_size, layer_num=1, dropout_keep_pro
             outputs, state = tf.nn.bidirectional_dynamic_rnn(
                 cell_fw, cell_bw, inputs, sequence_length=length, dtype=tf.float32
             )
+            # stack_bidirectional_dynamic_rnn already concatenates, keep both branches returning one tensor
+            outputs = tf.concat(outputs, 2) if concat else outputs[0] + outputs[1]
         # state_fw, state_bw = state
         # if rnn_type.endswith('lstm'):
         #     c_fw, h_fw = state_fw
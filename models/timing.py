@@ -0,0 +1,74 @@
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class StepTimer(object):
+    """
+    Times the train steps run through a TrainControl. The input wait of a step is the time of the iterator op
+    that feeds the model, taken from the step stats of a SOFTWARE_TRACE run, the rest of the wall time is
+    session run time. At trace_steps the run is a FULL_TRACE, its chrome trace timeline is written to
+    trace_dir and its run metadata to the writer. With gradient accumulation the input wait is summed over the
+    micro-batches of a step, only the last one is written as the trace and its lengths are counted for all.
+    """
+
+    def __init__(self, model, writer, trace_dir, trace_steps=()):
+        self.model = model
+        self.writer = writer
+        self.trace_dir = trace_dir
+        self.trace_steps = set(trace_steps)
+        # IteratorGetNext，所有输入张量来自同一个 op
+        self.input_op = model.id.op.name
+        self.fetches = (model.seq_len, model.max_len)
+        self._reset()
+
+    def _reset(self):
+        self.n_step, self.n_example, self.n_timestep, self.n_padded = 0, 0, 0, 0
+        self.input_wait, self.run_time, self.wall_time = [], [], []
+
+    def train_step(self, control, sess, step, feed_dict=None):
+        """Runs control.train_step, returns the global step and the loss."""
+        trace = step in self.trace_steps
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE if trace else tf.RunOptions.SOFTWARE_TRACE)
+        run_metadata = tf.RunMetadata()
+        # 累加梯度的小批次各有自己的 run metadata，wall time 包含它们的输入等待
+        micro_metadata = []
+        start_t = time.time()
+        global_step, loss, seq_len, max_len = control.train_step(sess, feed_dict, self.fetches, options=options,
+                                                                 run_metadata=run_metadata,
+                                                                 micro_metadata=micro_metadata)
+        wall_t = time.time() - start_t
+        input_wait = sum(node.all_end_rel_micros for metadata in micro_metadata + [run_metadata]
+                         for dev_stats in metadata.step_stats.dev_stats
+                         for node in dev_stats.node_stats if node.node_name == self.input_op) / 1e6
+        self.input_wait.append(input_wait)
+        self.run_time.append(wall_t - input_wait)
+        self.wall_time.append(wall_t)
+        self.n_step += 1
+        self.n_example += len(seq_len) * self.model.accum_steps
+        self.n_timestep += int(np.sum(seq_len)) * self.model.accum_steps
+        self.n_padded += len(seq_len) * int(max_len) * self.model.accum_steps
+        if trace:
+            self.writer.add_run_metadata(run_metadata, 'step_{}'.format(global_step), global_step)
+            trace_file = os.path.join(self.trace_dir, 'timeline_{}.json'.format(global_step))
+            with open(trace_file, 'w') as fh:
+                fh.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        return global_step, loss
+
+    def summaries(self):
+        """
+        Averages over the steps since the last call, as a dict and as summaries for the FileWriter. Rates are
+        per second of train step, the time spent in evaluation between steps is not counted.
+        """
+        seconds = max(np.sum(self.wall_time), 1e-9)
+        stats = {'examples_per_sec': self.n_example / seconds,
+                 'timesteps_per_sec': self.n_timestep / seconds,
+                 'padding_ratio': 1. - self.n_timestep / float(max(self.n_padded, 1)),
+                 'input_wait_ms': np.mean(self.input_wait) * 1000 if self.n_step else 0.,
+                 'run_ms': np.mean(self.run_time) * 1000 if self.n_step else 0.}
+        self._reset()
+        summ = tf.Summary(value=[tf.Summary.Value(tag='timing/' + name, simple_value=value)
+                                 for name, value in stats.items()])
+        return stats, summ
@@ -10,7 +10,9 @@ from models.sep_RNN import sep_RNN_Model
 from models.TCN import TCN
 from models.SAnD import SAND
 from models.DIMM import DIMM_Model
-from multi_util import get_record_parser, multi_evaluate, get_batch_dataset, get_dataset, evaluate_batch
+from models.control import TrainControl
+from multi_util import get_record_parser, multi_evaluate, get_batch_dataset, get_dataset, evaluate_batch, \
+    get_packed_batch_dataset, to_segments, get_train_eval_dataset
 import warnings
 
 warnings.filterwarnings(action='ignore', category=UserWarning, module='tensorflow')
@@ -54,6 +56,8 @@ def parse_args():
                                 help='dropout keep rate')
     train_settings.add_argument('--train_batch', type=int, default=64,
                                 help='train batch size')
+    train_settings.add_argument('--accum_steps', type=int, default=1,
+                                help='micro-batches accumulated per update, num_steps counts updates')
     train_settings.add_argument('--dev_batch', type=int, default=9,
                                 help='dev batch size')
     train_settings.add_argument('--epochs', type=int, default=30,
@@ -70,6 +74,8 @@ def parse_args():
                                 help='size of LSTM hidden units')
     model_settings.add_argument('--use_cudnn', type=bool, default=True,
                                 help='whether to use cudnn rnn')
+    model_settings.add_argument('--cudnn_compatible', type=bool, default=False,
+                                help='run the cudnn gru weights with CudnnCompatibleGRUCell, e.g. on cpu')
     model_settings.add_argument('--n_layer', type=int, default=2,
                                 help='num of layers')
     model_settings.add_argument('--num_threads', type=int, default=8,
@@ -100,6 +106,29 @@ def parse_args():
                                 help='num of block for step attention')
     model_settings.add_argument('--head_stp', type=int, default=4,
                                 help='num of step attention head')
+    model_settings.add_argument('--window_ipt', type=int, default=0,
+                                help='sliding window of the input attentions in steps, 0 for full attention')
+    model_settings.add_argument('--window_stp', type=int, default=0,
+                                help='sliding window of the step attention in steps, 0 for full attention')
+    model_settings.add_argument('--att_chunk', type=int, default=0,
+                                help='compute full attention this many queries at a time to save memory, 0 to disable')
+    model_settings.add_argument('--recompute', type=bool, default=False,
+                                help='recompute the attention layers in the backward pass instead of storing them')
+    model_settings.add_argument('--share_ipt', type=bool, default=False,
+                                help='share layer norms and key/value projections across the input attentions')
+    model_settings.add_argument('--packed', type=bool, default=False,
+                                help='run the position-wise layers and the loss on the real steps only and mask padded '
+                                     'keys, a different model from the padded one, checkpoints are not interchangeable')
+    model_settings.add_argument('--pack_stays', type=bool, default=False,
+                                help='pack several short stays into one training row, DIMM only')
+    model_settings.add_argument('--pack_window', type=int, default=128,
+                                help='num of shuffled stays packed together')
+    model_settings.add_argument('--xla', default='none', choices=['none', 'auto', 'scope'],
+                                help='XLA auto-clustering of the whole graph, or jit scope on the model body')
+    model_settings.add_argument('--len_bucket', type=int, default=0,
+                                help='round batch lengths up to a multiple of this, bounds the XLA recompilations. '
+                                     'Only where padding does not change the outputs: DIMM with --packed or causal, '
+                                     'BIGRU without cuDNN, and not with --is_point')
 
     path_settings = parser.add_argument_group('path settings')
     path_settings.add_argument('--task', default='multi',
@@ -150,31 +179,50 @@ def train(args, file_paths, dim):
                           'max_epoch': 0}
 
     parser = get_record_parser(args.max_len, dim)
-    train_dataset = get_batch_dataset(file_paths.train_record_file, parser, args)
-    dev_dataset = get_dataset(file_paths.dev_record_file, parser, args)
+    if args.pack_stays:
+        if args.model != 'DIMM':
+            raise NotImplementedError('Packed stays are only supported by DIMM')
+        # 训练集的指标按住院记录统计，使用未拼接的训练数据
+        train_dataset = get_packed_batch_dataset(file_paths.train_record_file, parser, args)
+        dev_dataset = get_dataset(file_paths.dev_record_file, parser, args).map(to_segments)
+        train_eval_dataset = get_train_eval_dataset(file_paths.train_record_file, parser, args).map(to_segments)
+    else:
+        train_dataset = get_batch_dataset(file_paths.train_record_file, parser, args)
+        dev_dataset = get_dataset(file_paths.dev_record_file, parser, args)
+        train_eval_dataset = get_train_eval_dataset(file_paths.train_record_file, parser, args)
     handle = tf.placeholder(tf.string, shape=[])
     iterator = tf.data.Iterator.from_string_handle(handle, train_dataset.output_types, train_dataset.output_shapes)
     train_iterator = train_dataset.make_one_shot_iterator()
     dev_iterator = dev_dataset.make_one_shot_iterator()
+    train_eval_iterator = train_eval_dataset.make_one_shot_iterator()
     logger.info('Initialize the model...')
     if args.model == 'DIMM':
         model = DIMM_Model(args, iterator, dim, logger)
+    elif args.model == 'DIMM_causal':
+        model = DIMM_Model(args, iterator, dim, logger, causal=True)
     elif args.model == 'BIGRU':
         model = bi_RNN_Model(args, iterator, dim, logger)
     # model = sep_RNN_Model(args, iterator, dim, logger)
     # model = TCN(args, iterator, dim, logger)
     # model = SAND(args, iterator, dim, logger)
+    control = TrainControl(model)
+
     sess_config = tf.ConfigProto(intra_op_parallelism_threads=8,
                                  inter_op_parallelism_threads=8,
                                  allow_soft_placement=True)
     sess_config.gpu_options.allow_growth = True
+    if args.xla == 'auto':
+        sess_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
 
     with tf.Session(config=sess_config) as sess:
         # writer = tf.summary.FileWriter(args.summary_dir)
         sess.run(tf.global_variables_initializer())
+        # 梯度累加的变量
+        sess.run(tf.local_variables_initializer())
         saver = tf.train.Saver()
         train_handle = sess.run(train_iterator.string_handle())
         dev_handle = sess.run(dev_iterator.string_handle())
+        train_eval_handle = sess.run(train_eval_iterator.string_handle())
         max_sum, max_epoch, task_sum = 0, 0, 0
         train_roc = 0
         roc_save, patience = 0, 0
@@ -183,14 +231,12 @@ def train(args, file_paths, dim):
         if args.is_map:
             index_W = tf.get_default_graph().get_tensor_by_name('input_encoding/index/dense/W:0')
             medicine_W = tf.get_default_graph().get_tensor_by_name('input_encoding/medicine/dense/W:0')
-        sess.run(tf.assign(model.lr, tf.constant(lr, dtype=tf.float32)))
-        sess.run(tf.assign(model.is_train, tf.constant(True, dtype=tf.bool)))
-        sess.run(tf.assign(model.n_batch, tf.constant(args.train_batch, dtype=tf.int32)))
+        control.set(sess, lr=lr, is_train=True, n_batch=args.train_batch)
+        # 之后的训练与评估不再向图中添加 op
+        tf.get_default_graph().finalize()
 
         for _ in range(1, args.num_steps + 1):
-            global_step = sess.run(model.global_step) + 1
-            # sess.run(tf.assign(model.global_step, tf.constant(global_step + 1, dtype=tf.int32)))
-            loss, train_op = sess.run([model.loss, model.train_op], feed_dict={handle: train_handle})
+            global_step, loss = control.train_step(sess, feed_dict={handle: train_handle})
             if global_step % args.period == 0:
                 logger.info('Period point {} Loss {}'.format(global_step, loss))
                 # loss_sum = tf.Summary(value=[tf.Summary.Value(tag='model/loss', simple_value=loss), ])
@@ -198,9 +244,9 @@ def train(args, file_paths, dim):
 
             if global_step % args.checkpoint == 0:
                 logger.info('Evaluating the model for epoch {}'.format(global_step // args.checkpoint))
-                sess.run(tf.assign(model.is_train, tf.constant(False, dtype=tf.bool)))
+                control.set(sess, is_train=False)
                 train_metrics = evaluate_batch(model, args.eval_num_batches, train_eval_file, sess, 'train',
-                                               handle, train_handle, args.is_point, logger)
+                                               handle, train_eval_handle, args.is_point, logger)
                 logger.info('Train Metrics')
                 logger.info('Loss - {} AUROC - {} AUPRC - {} Acc - {} Pse - {}'.format(train_metrics['loss'],
                                                                                        train_metrics['roc'],
@@ -212,13 +258,13 @@ def train(args, file_paths, dim):
                 if train_metrics['roc'] > train_roc:
                     train_roc = train_metrics['roc']
 
-                sess.run(tf.assign(model.n_batch, tf.constant(args.dev_batch, dtype=tf.int32)))
+                control.set(sess, n_batch=args.dev_batch)
                 dev_loss, dev_metrics, dev_hour_metrics = multi_evaluate(model, dev_total // args.dev_batch,
                                                                          dev_eval_file, sess,
                                                                          handle, dev_handle, args.is_point)
                 # dev_metrics = evaluate_batch(model, dev_total // args.dev_batch, dev_eval_file, sess, 'dev',
                 #                              handle, dev_handle, args.is_point, logger)
-                sess.run(tf.assign(model.is_train, tf.constant(True, dtype=tf.bool)))
+                control.set(sess, is_train=True)
                 roc = 0
                 for t in tasks:
                     logger.info('Dev Metrics')
@@ -248,7 +294,7 @@ def train(args, file_paths, dim):
                     roc_save = roc
                     patience = 0
                     logger.info('Learning rate reduced to {}'.format(lr))
-                sess.run(tf.assign(model.lr, tf.constant(lr, dtype=tf.float32)))
+                control.set(sess, lr=lr)
 
                 if task_sum > max_sum:
                     max_hour = dev_hour_metrics
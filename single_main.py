@@ -1,4 +1,5 @@
 import os
+import time
 import argparse
 import logging
 import ujson as json
@@ -12,7 +13,11 @@ from models.sep_RNN import sep_RNN_Model
 from models.TCN import TCN
 from models.SAnD import SAND
 from models.DIMM import DIMM_Model
-from single_util import get_record_parser, evaluate_batch, get_batch_dataset, get_dataset
+from models.control import TrainControl
+from models.timing import StepTimer
+from models.memory_plan import plan_batch_size
+from single_util import get_record_parser, evaluate_batch, get_batch_dataset, get_dataset, \
+    get_packed_batch_dataset, to_segments, get_train_eval_dataset
 import warnings
 
 warnings.filterwarnings(action='ignore', category=UserWarning, module='tensorflow')
@@ -42,10 +47,30 @@ def parse_args():
                                 help='num of step')
     train_settings.add_argument('--period', type=int, default=40,
                                 help='period to save batch loss')
+    train_settings.add_argument('--step_timing', type=bool, default=False,
+                                help='time the input wait and session run of the train steps, logged every period')
+    train_settings.add_argument('--trace_steps', type=int, nargs='*', default=[],
+                                help='train steps at which a FULL_TRACE chrome trace timeline is written to '
+                                     'summary_dir')
     train_settings.add_argument('--checkpoint', type=int, default=160,
                                 help='checkpoint for evaluation')
     train_settings.add_argument('--eval_num_batches', type=int, default=40,
                                 help='num of batches for evaluation')
+    train_settings.add_argument('--async_eval', type=bool, default=False,
+                                help='only write checkpoints, evaluation is left to a --evaluate process')
+    train_settings.add_argument('--eval_timeout', type=int, default=3600,
+                                help='seconds the --evaluate process waits for a new checkpoint')
+    train_settings.add_argument('--ps_hosts', default='',
+                                help='comma separated host:port of the parameter servers, for distributed training')
+    train_settings.add_argument('--worker_hosts', default='',
+                                help='comma separated host:port of the workers, distributed training if set')
+    train_settings.add_argument('--job_name', default='worker', choices=['ps', 'worker'],
+                                help='job of this process in distributed training')
+    train_settings.add_argument('--task_index', type=int, default=0,
+                                help='index of this process in its job, worker 0 is the chief')
+    train_settings.add_argument('--session_threads', type=int, default=8,
+                                help='intra and inter op threads of the session, of the trainer and the '
+                                     'evaluator each')
 
     train_settings.add_argument('--optim', default='adam',
                                 help='optimizer type')
@@ -57,8 +82,13 @@ def parse_args():
                                 help='dropout keep rate')
     train_settings.add_argument('--train_batch', type=int, default=32,
                                 help='train batch size')
+    train_settings.add_argument('--accum_steps', type=int, default=1,
+                                help='micro-batches accumulated per update, num_steps counts updates')
     train_settings.add_argument('--dev_batch', type=int, default=64,
                                 help='dev batch size')
+    train_settings.add_argument('--mem_budget', type=int, default=0,
+                                help='memory budget in MB, DIMM sets train_batch and dev_batch to the largest that '
+                                     'fit, 0 to disable')
     train_settings.add_argument('--epochs', type=int, default=30,
                                 help='train epochs')
     train_settings.add_argument('--patience', type=int, default=2,
@@ -75,6 +105,8 @@ def parse_args():
                                 help='size of LSTM hidden units')
     model_settings.add_argument('--use_cudnn', type=bool, default=True,
                                 help='whether to use cudnn rnn')
+    model_settings.add_argument('--cudnn_compatible', type=bool, default=False,
+                                help='run the cudnn gru weights with CudnnCompatibleGRUCell, e.g. on cpu')
     model_settings.add_argument('--n_layer', type=int, default=2,
                                 help='num of layers')
     model_settings.add_argument('--num_threads', type=int, default=8,
@@ -111,6 +143,29 @@ def parse_args():
                                 help='num of block for step attention')
     model_settings.add_argument('--head_stp', type=int, default=4,
                                 help='num of step attention head')
+    model_settings.add_argument('--window_ipt', type=int, default=0,
+                                help='sliding window of the input attentions in steps, 0 for full attention')
+    model_settings.add_argument('--window_stp', type=int, default=0,
+                                help='sliding window of the step attention in steps, 0 for full attention')
+    model_settings.add_argument('--att_chunk', type=int, default=0,
+                                help='compute full attention this many queries at a time to save memory, 0 to disable')
+    model_settings.add_argument('--recompute', type=bool, default=False,
+                                help='recompute the attention layers in the backward pass instead of storing them')
+    model_settings.add_argument('--share_ipt', type=bool, default=False,
+                                help='share layer norms and key/value projections across the input attentions')
+    model_settings.add_argument('--packed', type=bool, default=False,
+                                help='run the position-wise layers and the loss on the real steps only and mask padded '
+                                     'keys, a different model from the padded one, checkpoints are not interchangeable')
+    model_settings.add_argument('--pack_stays', type=bool, default=False,
+                                help='pack several short stays into one training row, DIMM only')
+    model_settings.add_argument('--pack_window', type=int, default=128,
+                                help='num of shuffled stays packed together')
+    model_settings.add_argument('--xla', default='none', choices=['none', 'auto', 'scope'],
+                                help='XLA auto-clustering of the whole graph, or jit scope on the model body')
+    model_settings.add_argument('--len_bucket', type=int, default=0,
+                                help='round batch lengths up to a multiple of this, bounds the XLA recompilations. '
+                                     'Only where padding does not change the outputs: DIMM with --packed or causal, '
+                                     'BIGRU without cuDNN, and not with --is_point')
     model_settings.add_argument('--atten', type=bool, default=False,
                                 help='whether to use TCN attention')
     model_settings.add_argument('--highway', type=bool, default=False,
@@ -140,6 +195,44 @@ def parse_args():
     return parser.parse_args()
 
 
+def build_model(args, iterator, dim, logger):
+    if args.model == 'DIMM':
+        model = DIMM_Model(args, iterator, dim, logger)
+    elif args.model == 'DIMM_causal':
+        model = DIMM_Model(args, iterator, dim, logger, causal=True)
+    elif args.model == 'BIGRU':
+        model = bi_RNN_Model(args, iterator, dim, logger)
+    elif args.model == 'SAND':
+        T = args.max_len
+        M = args.inter_M
+        W = np.zeros((T, M), dtype=np.float32)
+        for t in range(1, T + 1):
+            s = M * t / T
+            for m in range(1, M + 1):
+                W[t - 1, m - 1] = (1 - abs(s - m) / M) ** 2
+        model = SAND(args, iterator, dim, logger, W, M)
+    # model = sep_RNN_Model(args, iterator, dim, logger)
+    # model = TCN(args, iterator, dim, logger)
+    return model
+
+
+def plan_batches(args, dim, logger):
+    """
+    Sets train_batch and dev_batch to the largest batch sizes whose estimated peak memory fits in --mem_budget,
+    see models/memory_plan.py. The trainer and the --evaluate process plan the same sizes.
+    """
+    if args.model not in ['DIMM', 'DIMM_causal']:
+        raise NotImplementedError('Batch sizes are only planned for DIMM')
+    budget = args.mem_budget * 2 ** 20
+    for name, is_train in [('train_batch', True), ('dev_batch', False)]:
+        batch, peak = plan_batch_size(args, dim, budget, is_train, causal=args.model == 'DIMM_causal')
+        if batch == 0:
+            raise ValueError('Not even one stay of {} steps fits in {} MB'.format(args.max_len, args.mem_budget))
+        logger.info('Planned {} {}, estimated peak {:.0f} MB of {} MB'.format(name, batch, peak / 2 ** 20,
+                                                                            args.mem_budget))
+        setattr(args, name, batch)
+
+
 def train(args, file_paths, shape_meta):
     logger = logging.getLogger('Medical')
     logger.info('Loading train eval file...')
@@ -159,44 +252,79 @@ def train(args, file_paths, shape_meta):
     dev_total = dev_meta['total']
     dim = shape_meta['dim']
     max_len = args.max_len
+    if args.mem_budget:
+        plan_batches(args, dim, logger)
     logger.info('Total dev data {}'.format(dev_total))
     logger.info('Index dim {} Medicine dim {}'.format(dim[0], dim[1]))
 
-    parser = get_record_parser(max_len, dim)
-    train_dataset = get_batch_dataset(file_paths.train_record_file, parser, args)
-    dev_dataset = get_dataset(file_paths.dev_record_file, parser, args)
-    handle = tf.placeholder(tf.string, shape=[])
-    iterator = tf.data.Iterator.from_string_handle(handle, train_dataset.output_types, train_dataset.output_shapes)
-    train_iterator = train_dataset.make_one_shot_iterator()
-    dev_iterator = dev_dataset.make_one_shot_iterator()
-    logger.info('Initialize the model...')
-    if args.model == 'DIMM':
-        model = DIMM_Model(args, iterator, dim, logger)
-    elif args.model == 'BIGRU':
-        model = bi_RNN_Model(args, iterator, dim, logger)
-    elif args.model == 'SAND':
-        T = max_len
-        M = args.inter_M
-        W = np.zeros((T, M), dtype=np.float32)
-        for t in range(1, T + 1):
-            s = M * t / T
-            for m in range(1, M + 1):
-                W[t - 1, m - 1] = (1 - abs(s - m) / M) ** 2
-        model = SAND(args, iterator, dim, logger, W, M)
-    # model = sep_RNN_Model(args, iterator, dim, logger)
-    # model = TCN(args, iterator, dim, logger)
-
-    sess_config = tf.ConfigProto(intra_op_parallelism_threads=8,
-                                 inter_op_parallelism_threads=8,
+    sess_config = tf.ConfigProto(intra_op_parallelism_threads=args.session_threads,
+                                 inter_op_parallelism_threads=args.session_threads,
                                  allow_soft_placement=True)
     sess_config.gpu_options.allow_growth = True
+    if args.xla == 'auto':
+        sess_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
 
-    with tf.Session(config=sess_config) as sess:
+    # 分布式训练：变量放在 parameter server 上，各 worker 异步更新，读取互不相交的训练数据
+    target, device, shard, is_chief = '', None, None, True
+    if args.worker_hosts:
+        if not args.async_eval:
+            raise NotImplementedError('Distributed training is evaluated by a --evaluate process, set --async_eval')
+        if args.accum_steps > 1:
+            raise NotImplementedError('Gradient accumulation is not supported in distributed training')
+        cluster = tf.train.ClusterSpec({'ps': args.ps_hosts.split(','), 'worker': args.worker_hosts.split(',')})
+        if args.job_name == 'worker':
+            sess_config.device_filters.extend(['/job:ps', '/job:worker/task:{}'.format(args.task_index)])
+        server = tf.train.Server(cluster, job_name=args.job_name, task_index=args.task_index, config=sess_config)
+        if args.job_name == 'ps':
+            server.join()
+            return
+        target = server.target
+        worker_device = '/job:worker/task:{}'.format(args.task_index)
+        device = tf.train.replica_device_setter(worker_device=worker_device, cluster=cluster)
+        shard = (cluster.num_tasks('worker'), args.task_index)
+        is_chief = args.task_index == 0
+
+    parser = get_record_parser(max_len, dim)
+    with tf.device(device):
+        if args.pack_stays:
+            if args.model != 'DIMM':
+                raise NotImplementedError('Packed stays are only supported by DIMM')
+            # 训练集的指标按住院记录统计，使用未拼接的训练数据
+            train_dataset = get_packed_batch_dataset(file_paths.train_record_file, parser, args, shard)
+            dev_dataset = get_dataset(file_paths.dev_record_file, parser, args).map(to_segments)
+            train_eval_dataset = get_train_eval_dataset(file_paths.train_record_file, parser, args).map(to_segments)
+        else:
+            train_dataset = get_batch_dataset(file_paths.train_record_file, parser, args, shard)
+            dev_dataset = get_dataset(file_paths.dev_record_file, parser, args)
+            train_eval_dataset = get_train_eval_dataset(file_paths.train_record_file, parser, args)
+        handle = tf.placeholder(tf.string, shape=[])
+        iterator = tf.data.Iterator.from_string_handle(handle, train_dataset.output_types,
+                                                       train_dataset.output_shapes)
+        train_iterator = train_dataset.make_one_shot_iterator()
+        dev_iterator = dev_dataset.make_one_shot_iterator()
+        train_eval_iterator = train_eval_dataset.make_one_shot_iterator()
+        logger.info('Initialize the model...')
+        model = build_model(args, iterator, dim, logger)
+        control = TrainControl(model)
+        uninitialized = tf.report_uninitialized_variables(tf.global_variables())
+
+    with tf.Session(target, config=sess_config) as sess:
         writer = tf.summary.FileWriter(args.summary_dir)
-        sess.run(tf.global_variables_initializer())
+        timer = None
+        if is_chief and (args.step_timing or args.trace_steps):
+            timer = StepTimer(model, writer, args.summary_dir, args.trace_steps)
+        if is_chief:
+            sess.run(tf.global_variables_initializer())
+        else:
+            # 等待 chief 初始化 parameter server 上的变量
+            while len(sess.run(uninitialized)):
+                time.sleep(1)
+        # 梯度累加的变量
+        sess.run(tf.local_variables_initializer())
         saver = tf.train.Saver()
         train_handle = sess.run(train_iterator.string_handle())
         dev_handle = sess.run(dev_iterator.string_handle())
+        train_eval_handle = sess.run(train_eval_iterator.string_handle())
         max_acc, max_roc, max_prc, max_pse, max_sum, max_epoch = 0, 0, 0, 0, 0, 0
         train_roc, roc_save, patience = 0, 0, 0
         max_hour = []
@@ -206,24 +334,57 @@ def train(args, file_paths, shape_meta):
         if args.is_map:
             index_W = tf.get_default_graph().get_tensor_by_name('input_encoding/index/dense/W:0')
             medicine_W = tf.get_default_graph().get_tensor_by_name('input_encoding/medicine/dense/W:0')
-        sess.run(tf.assign(model.lr, tf.constant(lr, dtype=tf.float32)))
-        sess.run(tf.assign(model.is_train, tf.constant(True, dtype=tf.bool)))
-        sess.run(tf.assign(model.n_batch, tf.constant(args.train_batch, dtype=tf.int32)))
-
-        for _ in range(1, args.num_steps + 1):
-            global_step = sess.run(model.global_step) + 1
-            # sess.run(tf.assign(model.global_step, tf.constant(global_step + 1, dtype=tf.int32)))
-            loss, train_op = sess.run([model.loss, model.train_op], feed_dict={handle: train_handle})
+        if is_chief:
+            control.set(sess, lr=lr, is_train=True, n_batch=args.train_batch)
+        else:
+            # 学习率由 chief 设置
+            control.set(sess, is_train=True, n_batch=args.train_batch)
+        # 之后的训练与评估不再向图中添加 op
+        tf.get_default_graph().finalize()
+        eval_state_file = os.path.join(args.model_dir, 'eval_state.json')
+        if args.async_eval and is_chief and os.path.exists(eval_state_file):
+            os.remove(eval_state_file)
+
+        # 分布式训练时 global step 由所有 worker 共同推进
+        global_step, last_save, n_step = sess.run(model.global_step), 0, 0
+        start_t = time.time()
+        while global_step < args.num_steps:
+            if timer is not None:
+                global_step, loss = timer.train_step(control, sess, n_step + 1, feed_dict={handle: train_handle})
+            else:
+                global_step, loss = control.train_step(sess, feed_dict={handle: train_handle})
+            n_step += 1
+            if n_step == 1:
+                start_t = time.time()
+            if not is_chief:
+                continue
             if global_step % args.period == 0:
                 logger.info('Period point {} Loss {}'.format(global_step, loss))
                 loss_sum = tf.Summary(value=[tf.Summary.Value(tag='model/loss', simple_value=loss), ])
                 writer.add_summary(loss_sum, global_step)
+                if timer is not None:
+                    stats, summ = timer.summaries()
+                    logger.info('Input wait {input_wait_ms:.1f} ms Run {run_ms:.1f} ms Examples/s '
+                                '{examples_per_sec:.1f} Timesteps/s {timesteps_per_sec:.1f} '
+                                'Padding {padding_ratio:.2f}'.format(**stats))
+                    writer.add_summary(summ, global_step)
 
-            if global_step % args.checkpoint == 0:
+            if args.async_eval and (global_step - last_save >= args.checkpoint or global_step >= args.num_steps):
+                # 评估由 --evaluate 进程完成，这里只保存模型并读取其调整后的学习率
+                saver.save(sess, os.path.join(args.model_dir, 'model'), global_step=global_step)
+                last_save = global_step
+                if os.path.exists(eval_state_file):
+                    with open(eval_state_file, 'r') as fh:
+                        eval_lr = json.load(fh)['lr']
+                    if eval_lr != lr:
+                        lr = eval_lr
+                        control.set(sess, lr=lr)
+                        logger.info('Learning rate set to {} by the evaluator'.format(lr))
+            elif global_step % args.checkpoint == 0:
                 logger.info('Evaluating the model for epoch {}'.format(global_step // args.checkpoint))
-                sess.run(tf.assign(model.is_train, tf.constant(False, dtype=tf.bool)))
+                control.set(sess, is_train=False)
                 train_metrics, _, summ = evaluate_batch(model, args.eval_num_batches, train_eval_file, sess, 'train',
-                                                        handle, train_handle, args.is_point, logger)
+                                                        handle, train_eval_handle, args.is_point, logger)
                 logger.info('Train Metrics')
                 logger.info('Loss - {} AUROC - {} AUPRC - {} Acc - {} Pse - {}'.format(train_metrics['loss'],
                                                                                        train_metrics['roc'],
@@ -236,10 +397,10 @@ def train(args, file_paths, shape_meta):
                     train_roc = train_metrics['roc']
                     NAMES = train_metrics['name']
 
-                sess.run(tf.assign(model.n_batch, tf.constant(args.dev_batch, dtype=tf.int32)))
+                control.set(sess, n_batch=args.dev_batch)
                 dev_metrics, hour_metrics, summ = evaluate_batch(model, dev_total // args.dev_batch, dev_eval_file,
                                                                  sess, 'dev', handle, dev_handle, args.is_point, logger)
-                sess.run(tf.assign(model.is_train, tf.constant(True, dtype=tf.bool)))
+                control.set(sess, is_train=True)
                 logger.info('Dev Metrics')
                 logger.info('Loss - {} AUCROC - {} AUCPRC - {} Acc - {} Pse - {}'.format(dev_metrics['loss'],
                                                                                          dev_metrics['roc'],
@@ -262,7 +423,7 @@ def train(args, file_paths, shape_meta):
                     logger.info('Learning rate reduced to {}'.format(lr))
                     roc_save = roc
                     patience = 0
-                sess.run(tf.assign(model.lr, tf.constant(lr, dtype=tf.float32)))
+                control.set(sess, lr=lr)
 
                 max_acc = max(dev_metrics['acc'], max_acc)
                 max_roc = max(dev_metrics['roc'], max_roc)
@@ -282,6 +443,10 @@ def train(args, file_paths, shape_meta):
                     if args.is_map:
                         iw = sess.run(index_W)
                         mw = sess.run(medicine_W)
+        logger.info('Worker {} ran {} steps in {:.2f} s after the first'.format(args.task_index, n_step - 1,
+                                                                                time.time() - start_t))
+        if args.async_eval:
+            return
         logger.info('Max Train AUROC - {}'.format(train_roc))
         logger.info('Max AUROC - {}'.format(max_roc))
         logger.info('Max AUPRC - {}'.format(max_prc))
@@ -315,6 +480,148 @@ def train(args, file_paths, shape_meta):
             np.savetxt(os.path.join(args.result_dir, args.task + '_medicine_W.txt'), mw, fmt='%.6f', delimiter=',')
 
 
+def evaluate(args, file_paths, shape_meta):
+    """
+    Evaluator for train with --async_eval. Runs as a separate process, restores every new checkpoint in the
+    model dir, evaluates it on the train subset and the dev set, keeps the best model and writes back the
+    learning rate for the trainer, so that training never waits on evaluation.
+    """
+    logger = logging.getLogger('Medical')
+    logger.info('Loading train eval file...')
+    with open(file_paths.train_eval_file, "r") as fh:
+        train_eval_file = json.load(fh)
+    logger.info('Loading dev eval file...')
+    with open(file_paths.dev_eval_file, "r") as fh:
+        dev_eval_file = json.load(fh)
+    with open(file_paths.dev_meta, "r") as fh:
+        dev_total = json.load(fh)['total']
+    dim = shape_meta['dim']
+    if args.mem_budget:
+        plan_batches(args, dim, logger)
+
+    parser = get_record_parser(args.max_len, dim)
+    train_eval_dataset = get_train_eval_dataset(file_paths.train_record_file, parser, args)
+    dev_dataset = get_dataset(file_paths.dev_record_file, parser, args)
+    if args.pack_stays:
+        train_eval_dataset = train_eval_dataset.map(to_segments)
+        dev_dataset = dev_dataset.map(to_segments)
+    handle = tf.placeholder(tf.string, shape=[])
+    iterator = tf.data.Iterator.from_string_handle(handle, dev_dataset.output_types, dev_dataset.output_shapes)
+    train_eval_iterator = train_eval_dataset.make_one_shot_iterator()
+    dev_iterator = dev_dataset.make_one_shot_iterator()
+    logger.info('Initialize the model...')
+    model = build_model(args, iterator, dim, logger)
+    control = TrainControl(model)
+
+    sess_config = tf.ConfigProto(intra_op_parallelism_threads=args.session_threads,
+                                 inter_op_parallelism_threads=args.session_threads,
+                                 allow_soft_placement=True)
+    sess_config.gpu_options.allow_growth = True
+    if args.xla == 'auto':
+        sess_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+    with tf.Session(config=sess_config) as sess:
+        writer = tf.summary.FileWriter(args.summary_dir)
+        saver = tf.train.Saver()
+        train_eval_handle = sess.run(train_eval_iterator.string_handle())
+        dev_handle = sess.run(dev_iterator.string_handle())
+        max_acc, max_roc, max_prc, max_pse, max_sum, max_epoch = 0, 0, 0, 0, 0, 0
+        train_roc, roc_save, patience = 0, 0, 0
+        max_hour = []
+        NAMES = None
+        FALSE = []
+        lr = args.lr
+        if args.is_map:
+            index_W = tf.get_default_graph().get_tensor_by_name('input_encoding/index/dense/W:0')
+            medicine_W = tf.get_default_graph().get_tensor_by_name('input_encoding/medicine/dense/W:0')
+        tf.get_default_graph().finalize()
+        eval_state_file = os.path.join(args.model_dir, 'eval_state.json')
+
+        # 训练较快时只评估最新的 checkpoint
+        for checkpoint in tf.train.checkpoints_iterator(args.model_dir, timeout=args.eval_timeout):
+            saver.restore(sess, checkpoint)
+            global_step = sess.run(model.global_step)
+            logger.info('Evaluating the model for epoch {}'.format(global_step // args.checkpoint))
+            control.set(sess, is_train=False, n_batch=args.dev_batch)
+            train_metrics, _, summ = evaluate_batch(model, args.eval_num_batches, train_eval_file, sess, 'train',
+                                                    handle, train_eval_handle, args.is_point, logger)
+            logger.info('Train Metrics')
+            logger.info('Loss - {} AUROC - {} AUPRC - {} Acc - {} Pse - {}'.format(train_metrics['loss'],
+                                                                                   train_metrics['roc'],
+                                                                                   train_metrics['prc'],
+                                                                                   train_metrics['acc'],
+                                                                                   train_metrics['pse']))
+            for s in summ:
+                writer.add_summary(s, global_step)
+            if train_metrics['roc'] > train_roc:
+                train_roc = train_metrics['roc']
+                NAMES = train_metrics['name']
+
+            dev_metrics, hour_metrics, summ = evaluate_batch(model, dev_total // args.dev_batch, dev_eval_file,
+                                                             sess, 'dev', handle, dev_handle, args.is_point, logger)
+            logger.info('Dev Metrics')
+            logger.info('Loss - {} AUCROC - {} AUCPRC - {} Acc - {} Pse - {}'.format(dev_metrics['loss'],
+                                                                                     dev_metrics['roc'],
+                                                                                     dev_metrics['prc'],
+                                                                                     dev_metrics['acc'],
+                                                                                     dev_metrics['pse']))
+            FALSE.append({'Step': global_step, 'FP': dev_metrics['fp'], 'FN': dev_metrics['fn']})
+            for s in summ:
+                writer.add_summary(s, global_step)
+            writer.flush()
+
+            roc = dev_metrics['roc']
+            if roc > roc_save:
+                roc_save = roc
+                patience = 0
+            else:
+                patience += 1
+            if patience >= args.patience:
+                lr /= 2.0
+                logger.info('Learning rate reduced to {}'.format(lr))
+                roc_save = roc
+                patience = 0
+            with open(eval_state_file + '.tmp', 'w') as fh:
+                json.dump({'step': int(global_step), 'lr': lr}, fh)
+            os.replace(eval_state_file + '.tmp', eval_state_file)
+
+            max_acc = max(dev_metrics['acc'], max_acc)
+            max_roc = max(dev_metrics['roc'], max_roc)
+            max_prc = max(dev_metrics['prc'], max_prc)
+            max_pse = max(dev_metrics['pse'], max_pse)
+            dev_sum = dev_metrics['roc'] + dev_metrics['prc'] + dev_metrics['pse']
+            if dev_sum > max_sum:
+                max_hour = hour_metrics
+                max_sum = dev_sum
+                max_epoch = global_step // args.checkpoint
+                # 最优模型记录在 best_checkpoint 中，不影响 checkpoints_iterator 读取的 checkpoint 文件
+                filename = os.path.join(args.model_dir, "model_{}.ckpt".format(global_step))
+                saver.save(sess, filename, latest_filename='best_checkpoint')
+                with open(os.path.join(args.result_dir, 'best.json'), 'w') as fh:
+                    json.dump({'step': int(global_step), 'checkpoint': filename, 'roc': dev_metrics['roc'],
+                               'prc': dev_metrics['prc'], 'pse': dev_metrics['pse'], 'acc': dev_metrics['acc']}, fh)
+                if args.is_map:
+                    iw = sess.run(index_W)
+                    mw = sess.run(medicine_W)
+            if global_step >= args.num_steps:
+                break
+        logger.info('Max Train AUROC - {}'.format(train_roc))
+        logger.info('Max AUROC - {}'.format(max_roc))
+        logger.info('Max AUPRC - {}'.format(max_prc))
+        logger.info('Max Acc - {}'.format(max_acc))
+        logger.info('Max Pse - {}'.format(max_pse))
+        logger.info('Max Epoch - {}'.format(max_epoch))
+        with open(os.path.join(args.result_dir, 'Hour.pkl'), 'wb') as f:
+            pkl.dump(max_hour, f)
+        with open(os.path.join(args.result_dir, 'FALSE.pkl'), 'wb') as f:
+            pkl.dump(FALSE, f)
+        with open(os.path.join(args.result_dir, 'NAME.pkl'), 'wb') as f:
+            pkl.dump(NAMES, f)
+        if args.is_map and max_sum > 0:
+            np.savetxt(os.path.join(args.result_dir, args.task + '_index_W.txt'), iw, fmt='%.6f', delimiter=',')
+            np.savetxt(os.path.join(args.result_dir, args.task + '_medicine_W.txt'), mw, fmt='%.6f', delimiter=',')
+
+
 def run():
     """
     Prepares and runs the whole system.
@@ -376,6 +683,10 @@ def run():
             shape_meta = json.load(fh)
         fh.close()
         train(args, file_paths, shape_meta)
+    if args.evaluate:
+        with open(file_paths.shape_meta, 'r') as fh:
+            shape_meta = json.load(fh)
+        evaluate(args, file_paths, shape_meta)
 
 
 if __name__ == '__main__':
@@ -26,14 +26,98 @@ def get_record_parser(max_len, dim):
     return parse
 
 
-def get_batch_dataset(record_file, parser, config):
+def get_batch_dataset(record_file, parser, config, shard=None):
     num_threads = tf.constant(config.num_threads, dtype=tf.int32)
-    dataset = tf.data.TFRecordDataset(record_file).map(parser, num_parallel_calls=num_threads).shuffle(
+    dataset = shard_records(record_file, shard).map(parser, num_parallel_calls=num_threads).shuffle(
         config.capacity).batch(config.train_batch).repeat()
 
     return dataset
 
 
+def shard_records(record_file, shard=None):
+    """The records of record_file, or with shard = (num_shards, index) only every num_shards-th of them, so that
+    distributed workers read disjoint parts of the data."""
+    dataset = tf.data.TFRecordDataset(record_file)
+    if shard is not None:
+        dataset = dataset.shard(*shard)
+    return dataset
+
+
+def to_segments(patient_id, index, medicine, seq_len, label):
+    """Puts unpacked stays into the layout of get_packed_batch_dataset, one segment per row."""
+    segment_ids = tf.sequence_mask(seq_len, tf.shape(index)[-2], dtype=tf.int32)
+    labels = tf.ones_like(segment_ids) * tf.expand_dims(label, -1)
+    return patient_id, index, medicine, seq_len, labels, segment_ids
+
+
+def pack_stays(patient_ids, index, medicine, seq_lens, labels):
+    """
+    Packs a window of stays into as few rows of max_len steps as possible, first fit with the longest stays
+    first. A stay is never split over rows.
+    Returns:
+        the id of the first stay, index, medicine, total length, per-step labels and 1..k segment ids per row
+    """
+    max_len = index.shape[1]
+    rows = []
+    for i in np.argsort(-seq_lens, kind='stable'):
+        for row in rows:
+            if row[0] + seq_lens[i] <= max_len:
+                row[0] += seq_lens[i]
+                row[1].append(i)
+                break
+        else:
+            rows.append([seq_lens[i], [i]])
+    n_row = len(rows)
+    row_ids = np.zeros(n_row, dtype=patient_ids.dtype)
+    row_index = np.zeros((n_row,) + index.shape[1:], dtype=np.float32)
+    row_medicine = np.zeros((n_row,) + medicine.shape[1:], dtype=np.float32)
+    row_lens = np.zeros(n_row, dtype=np.int32)
+    row_labels = np.zeros((n_row, max_len), dtype=np.int32)
+    segment_ids = np.zeros((n_row, max_len), dtype=np.int32)
+    for r, (length, stays) in enumerate(rows):
+        row_ids[r], row_lens[r], start = patient_ids[stays[0]], length, 0
+        for k, i in enumerate(stays):
+            end = start + seq_lens[i]
+            row_index[r, start:end] = index[i, :seq_lens[i]]
+            row_medicine[r, start:end] = medicine[i, :seq_lens[i]]
+            row_labels[r, start:end] = labels[i]
+            segment_ids[r, start:end] = k + 1
+            start = end
+    return row_ids, row_index, row_medicine, row_lens, row_labels, segment_ids
+
+
+def get_packed_batch_dataset(record_file, parser, config, shard=None):
+    """Training batches of rows packed with several short stays, see pack_stays."""
+    num_threads = tf.constant(config.num_threads, dtype=tf.int32)
+
+    def pack(patient_ids, index, medicine, seq_lens, labels):
+        packed = tf.py_func(pack_stays, [patient_ids, index, medicine, seq_lens, labels],
+                            [tf.int64, tf.float32, tf.float32, tf.int32, tf.int32, tf.int32], stateful=False)
+        for tensor, shape in zip(packed, [[None], index.shape, medicine.shape, [None], [None, config.max_len],
+                                          [None, config.max_len]]):
+            tensor.set_shape(shape)
+        return tf.data.Dataset.from_tensor_slices(tuple(packed))
+
+    dataset = shard_records(record_file, shard).map(parser, num_parallel_calls=num_threads).shuffle(
+        config.capacity).batch(config.pack_window).flat_map(pack).shuffle(config.capacity).batch(
+        config.train_batch).repeat()
+
+    return dataset
+
+
+def get_train_eval_dataset(record_file, parser, config):
+    """
+    A fixed random subset of eval_num_batches train batches for the train metrics. It is parsed once, then
+    served from the cache on every evaluation, and never draws from the training stream.
+    """
+    num_threads = tf.constant(config.num_threads, dtype=tf.int32)
+    dataset = tf.data.TFRecordDataset(record_file).shuffle(config.capacity, seed=23333).take(
+        config.eval_num_batches * config.train_batch).map(parser, num_parallel_calls=num_threads).cache().batch(
+        config.train_batch).repeat()
+
+    return dataset
+
+
 def get_dataset(record_file, parser, config):
     num_threads = tf.constant(config.num_threads, dtype=tf.int32)
     dataset = tf.data.TFRecordDataset(record_file).map(
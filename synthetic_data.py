@@ -0,0 +1,131 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+n_index = 205
+n_medicine = 241
+columns = ['subject_id', 'hadm_id', 'icustay_id'] + ['index_{}'.format(i) for i in range(n_index)] + ['sep'] + \
+          ['medicine_{}'.format(i) for i in range(n_medicine)]
+
+
+def parse_args(argv=None):
+    """
+    Parses command line arguments, or argv if given.
+    """
+    parser = argparse.ArgumentParser('Medical')
+    parser.add_argument('--raw_dir', default='data/raw_data/',
+                        help='the dir to store raw data')
+    parser.add_argument('--task', default='synthetic',
+                        help='the task name, stays are written to raw_dir/task/train and raw_dir/task/test')
+    parser.add_argument('--num_train', type=int, default=2000,
+                        help='num of train stays')
+    parser.add_argument('--num_test', type=int, default=500,
+                        help='num of test stays')
+    parser.add_argument('--len_dist', default='lognormal', choices=['lognormal', 'uniform', 'fixed'],
+                        help='distribution of the stay lengths')
+    parser.add_argument('--len_median', type=int, default=72,
+                        help='median length of the lognormal distribution in steps')
+    parser.add_argument('--len_sigma', type=float, default=0.8,
+                        help='sigma of the lognormal distribution')
+    parser.add_argument('--min_len', type=int, default=6,
+                        help='min length in steps')
+    parser.add_argument('--max_len', type=int, default=720,
+                        help='max length in steps, also the fixed length')
+    parser.add_argument('--medicine_density', type=float, default=0.02,
+                        help='fraction of non zero medicine values')
+    parser.add_argument('--medicine_run', type=float, default=12,
+                        help='mean num of steps a medicine is given once started')
+    parser.add_argument('--index_missing', type=float, default=0.3,
+                        help='fraction of missing index values, left empty in the csv')
+    parser.add_argument('--pos_rate', type=float, default=0.1,
+                        help='fraction of stays with label 1')
+    parser.add_argument('--seed', type=int, default=23333,
+                        help='random seed')
+    return parser.parse_args(argv)
+
+
+def sample_lengths(rng, num, config):
+    if config.len_dist == 'fixed':
+        lengths = np.full(num, config.max_len)
+    elif config.len_dist == 'uniform':
+        lengths = rng.randint(config.min_len, config.max_len + 1, num)
+    else:
+        lengths = np.round(config.len_median * rng.lognormal(0., config.len_sigma, num))
+    return np.clip(lengths, config.min_len, config.max_len).astype(np.int64)
+
+
+class Cohort(object):
+    """
+    Per-column statistics shared by all stays: index values are an AR(1) walk around a per-column level, and
+    a positive stay drifts away from it on a few columns towards its end. Medicines are given in runs of
+    geometric length, with per-column start rates that average to the given density.
+    """
+
+    def __init__(self, rng, config):
+        self.config = config
+        self.level = rng.uniform(0., 100., n_index)
+        self.scale = self.level * rng.uniform(0.05, 0.3, n_index) + 0.1
+        self.signal = rng.choice(n_index, 10, replace=False)
+        rate = rng.gamma(0.5, size=n_medicine)
+        self.start_rate = np.minimum(rate / rate.mean() * config.medicine_density / config.medicine_run, 1.)
+        self.dose = rng.lognormal(0., 1., n_medicine)
+
+    def stay(self, rng, length, label):
+        index = np.empty((length, n_index))
+        state = rng.randn(n_index)
+        for t in range(length):
+            state = 0.9 * state + np.sqrt(1 - 0.9 ** 2) * rng.randn(n_index)
+            index[t] = state
+        if label:
+            index[:, self.signal] += np.linspace(0., 1.5, length)[:, None]
+        index = self.level + self.scale * index
+        index[rng.rand(length, n_index) < self.config.index_missing] = np.nan
+
+        medicine = np.zeros((length, n_medicine))
+        for t, m in zip(*np.nonzero(rng.rand(length, n_medicine) < self.start_rate)):
+            run = rng.geometric(1. / self.config.medicine_run)
+            medicine[t:t + run, m] = self.dose[m] * rng.lognormal(0., 0.3)
+        return index, medicine
+
+
+def write_stays(cohort, rng, data_dir, start_id, num, config):
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    lengths = sample_lengths(rng, num, config)
+    labels = (rng.rand(num) < config.pos_rate).astype(np.int64)
+    for i, (length, label) in enumerate(tqdm(list(zip(lengths, labels)))):
+        stay_id = start_id + i
+        index, medicine = cohort.stay(rng, length, label)
+        ids = np.tile([[stay_id, stay_id, stay_id]], [length, 1])
+        frame = pd.DataFrame(np.concatenate([ids, index, np.full((length, 1), np.nan), medicine], axis=1),
+                             columns=columns)
+        frame[columns[:3]] = frame[columns[:3]].astype(np.int64)
+        # 文件名以标签开头，与 divide_data 的约定一致
+        frame.to_csv(os.path.join(data_dir, '{}_{:06d}.csv'.format(label, stay_id)), index=False,
+                     float_format='%.4g')
+    return lengths
+
+
+def generate(config):
+    """Writes the train and test stays of a synthetic cohort, returns their lengths."""
+    rng = np.random.RandomState(config.seed)
+    cohort = Cohort(rng, config)
+    task_dir = os.path.join(config.raw_dir, config.task)
+    train_lengths = write_stays(cohort, rng, os.path.join(task_dir, 'train'), 0, config.num_train, config)
+    test_lengths = write_stays(cohort, rng, os.path.join(task_dir, 'test'), config.num_train, config.num_test,
+                               config)
+    return train_lengths, test_lengths
+
+
+def run():
+    args = parse_args()
+    train_lengths, test_lengths = generate(args)
+    lengths = np.concatenate([train_lengths, test_lengths])
+    print('Wrote {} stays of {} to {} steps, median {}, {} steps in total'.format(
+        len(lengths), lengths.min(), lengths.max(), int(np.median(lengths)), lengths.sum()))
+
+
+if __name__ == '__main__':
+    run()
@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import *
-import numpy as np
 
 
 class layer_normalization(nn.Module):
@@ -23,65 +22,65 @@ class layer_normalization(nn.Module):
 
 
 class positional_encoding(nn.Module):
-    def __init__(self, num_units, zeros_pad=True, scale=True):
+    def __init__(self, num_units, zeros_pad=True, scale=True, max_len=720):
         '''Sinusoidal Positional_Encoding.
         Args:
           num_units: Output dimensionality
           zero_pad: Boolean. If True, all the values of the first row (id = 0) should be constant zero
           scale: Boolean. If True, the output will be multiplied by sqrt num_units(check details from paper)
+          max_len: Number of positions precomputed in the lookup table, longer inputs rebuild it
         '''
         super(positional_encoding, self).__init__()
         self.num_units = num_units
         self.zeros_pad = zeros_pad
         self.scale = scale
+        # 由公式推出、不参与训练，不写入 state_dict，旧的 checkpoint 仍可严格加载
+        self.register_buffer('lookup_table', self._build_table(max_len), persistent=False)
 
-    def forward(self, inputs):
-        # inputs: A 2d Tensor with shape of (N, T).
-        N, T = inputs.size()[0: 2]
-
+    def _build_table(self, max_len):
         # First part of the PE function: sin and cos argument
-        position_ind = Variable(torch.unsqueeze(torch.arange(0, T), 0).repeat(N, 1).long())
-        position_enc = torch.Tensor([
-            [pos / np.power(10000, 2. * i / self.num_units) for i in range(self.num_units)]
-            for pos in range(T)])
+        position = torch.arange(0, max_len, dtype=torch.float64).unsqueeze(1)  # (T, 1)
+        div_term = torch.pow(10000., 2. * torch.arange(0, self.num_units, dtype=torch.float64) / self.num_units)
+        position_enc = position / div_term  # (T, num_units)
 
         # Second part, apply the cosine to even columns and sin to odds.
         position_enc[:, 0::2] = torch.sin(position_enc[:, 0::2])  # dim 2i
         position_enc[:, 1::2] = torch.cos(position_enc[:, 1::2])  # dim 2i+1
 
-        # Convert to a Variable
-        lookup_table = Variable(position_enc)
-
         if self.zeros_pad:
-            lookup_table = torch.cat((Variable(torch.zeros(1, self.num_units)),
-                                      lookup_table[1:, :]), 0)
-            padding_idx = 0
-        else:
-            padding_idx = -1
-
-        outputs = self._backend.Embedding.apply(
-            position_ind, lookup_table, padding_idx, None, 2, False, False)  # copied from torch.nn.modules.sparse.py
+            position_enc[0, :] = 0.
 
         if self.scale:
-            outputs = outputs * self.num_units ** 0.5
+            position_enc = position_enc * self.num_units ** 0.5
 
-        return outputs
+        return position_enc.float()
+
+    def forward(self, inputs):
+        # inputs: A 2d Tensor with shape of (N, T).
+        N, T = inputs.size()[0: 2]
+        if T > self.lookup_table.size(0):
+            self.lookup_table = self._build_table(T).to(self.lookup_table.device)
+
+        # The positions of every row are 0..T-1, so the lookup is a slice broadcast over the batch
+        return self.lookup_table[:T].unsqueeze(0).expand(N, T, self.num_units)
 
 
 class Multihead_Attention(nn.Module):
-    def __init__(self, num_units, num_heads=8, dropout=0, causality=False):
+    def __init__(self, num_units, num_heads=8, dropout=0, causality=False, fused=True):
         '''Applies multihead attention.
         Args:
             num_units: A scalar. Attention size.
             dropout: A floating point number.
             causality: Boolean. If true, units that reference the future are masked.
             num_heads: An int. Number of heads.
+            fused: Boolean. If true, use F.scaled_dot_product_attention when it is available.
         '''
         super(Multihead_Attention, self).__init__()
         self.num_units = num_units
         self.num_heads = num_heads
         self.dropout_rate = dropout
         self.causality = causality
+        self.fused = fused and hasattr(F, 'scaled_dot_product_attention')
         self.Q_proj = nn.Sequential(nn.Linear(self.num_units, self.num_units), nn.ReLU())
         self.K_proj = nn.Sequential(nn.Linear(self.num_units, self.num_units), nn.ReLU())
         self.V_proj = nn.Sequential(nn.Linear(self.num_units, self.num_units), nn.ReLU())
@@ -90,65 +89,58 @@ class Multihead_Attention(nn.Module):
 
         self.normalization = layer_normalization(self.num_units)
 
+    def split_heads(self, x):
+        # (N, T, C) -> (N, h, T, C/h)
+        N, T = x.size()[0: 2]
+        return x.view(N, T, self.num_heads, self.num_units // self.num_heads).transpose(1, 2)
+
     def forward(self, mini_batch):
         # keys, values: same shape of [N, T_k, C_k]
         # queries: A 3d Variable with shape of [N, T_q, C_q]
         if mini_batch.size()[-1] != self.num_units:
             mini_batch = mini_batch.transpose(1, 2)
+        N, T = mini_batch.size()[0: 2]
 
-        # Linear projections
-        Q = self.Q_proj(mini_batch)  # (N, T_q, C)
-        K = self.K_proj(mini_batch)  # (N, T_q, C)
-        V = self.V_proj(mini_batch)  # (N, T_q, C)
-
-        # Split and concat
-        Q_ = torch.cat(torch.chunk(Q, self.num_heads, dim=2), dim=0)  # (h*N, T_q, C/h)
-        K_ = torch.cat(torch.chunk(K, self.num_heads, dim=2), dim=0)  # (h*N, T_q, C/h)
-        V_ = torch.cat(torch.chunk(V, self.num_heads, dim=2), dim=0)  # (h*N, T_q, C/h)
-
-        # Multiplication
-        outputs = torch.bmm(Q_, K_.permute(0, 2, 1))  # (h*N, T_q, T_k)
-
-        # Scale
-        outputs = outputs / (K_.size()[-1] ** 0.5)
+        # Linear projections and split heads
+        Q_ = self.split_heads(self.Q_proj(mini_batch))  # (N, h, T_q, C/h)
+        K_ = self.split_heads(self.K_proj(mini_batch))  # (N, h, T_k, C/h)
+        V_ = self.split_heads(self.V_proj(mini_batch))  # (N, h, T_k, C/h)
 
-        # Key Masking
-        key_masks = torch.sign(torch.abs(torch.sum(mini_batch, dim=-1)))  # (N, T_k)
-        key_masks = key_masks.repeat(self.num_heads, 1)  # (h*N, T_k)
-        key_masks = torch.unsqueeze(key_masks, 1).repeat(1, mini_batch.size()[1], 1)  # (h*N, T_q, T_k)
-
-        padding = Variable(torch.ones(*outputs.size()).cuda() * (-2 ** 32 + 1))
-        condition = key_masks.eq(0.).float()
-        outputs = padding * condition + outputs * (1. - condition)
+        # Key Masking, broadcast over heads and queries
+        non_pad = torch.sum(mini_batch, dim=-1).ne(0.)  # (N, T)
+        masks = non_pad[:, None, None, :]  # (N, 1, 1, T_k)
 
         # Causality = Future blinding
         if self.causality:
-            diag_vals = torch.ones(*outputs[0, :, :].size()) .cuda() # (T_q, T_k)
-            tril = torch.tril(diag_vals, diagonal=0)  # (T_q, T_k)
-            # print(tril)
-            masks = Variable(torch.unsqueeze(tril, 0).repeat(outputs.size()[0], 1, 1))  # (h*N, T_q, T_k)
-
-            padding = Variable(torch.ones(*masks.size()).cuda() * (-2 ** 32 + 1))
-            condition = masks.eq(0.).float()
-            outputs = padding * condition + outputs * (1. - condition)
-
-        # Activation
-        outputs = F.softmax(outputs, dim=-1)  # (h*N, T_q, T_k)
+            tril = torch.ones(T, T, dtype=torch.bool, device=mini_batch.device).tril()  # (T_q, T_k)
+            masks = masks & tril  # (N, 1, T_q, T_k)
 
         # Query Masking
-        query_masks = torch.sign(torch.abs(torch.sum(mini_batch, dim=-1)))  # (N, T_q)
-        query_masks = query_masks.repeat(self.num_heads, 1)  # (h*N, T_q)
-        query_masks = torch.unsqueeze(query_masks, 2).repeat(1, 1, mini_batch.size()[1])  # (h*N, T_q, T_k)
-        outputs = outputs * query_masks
+        query_masks = non_pad[:, None, :, None]  # (N, 1, T_q, 1)
+
+        if self.fused:
+            # rows without any visible key are NaN in the fused kernel, also in the gradients of Q/K/V, and only
+            # padded queries can have them: those see every key and are zeroed afterwards
+            outputs = F.scaled_dot_product_attention(Q_, K_, V_, attn_mask=masks | ~query_masks,
+                                                     dropout_p=self.dropout_rate if self.training else 0.)
+            outputs = outputs.masked_fill(~query_masks, 0.)  # (N, h, T_q, C/h)
+        else:
+            # Multiplication and scale
+            outputs = torch.matmul(Q_, K_.transpose(2, 3)) / (K_.size()[-1] ** 0.5)  # (N, h, T_q, T_k)
+            outputs = outputs.masked_fill(~masks, -2 ** 32 + 1)
+
+            # Activation
+            outputs = F.softmax(outputs, dim=-1)  # (N, h, T_q, T_k)
+            outputs = outputs * query_masks.float()
 
-        # Dropouts
-        outputs = self.output_dropout(outputs)  # (h*N, T_q, T_k)
+            # Dropouts
+            outputs = self.output_dropout(outputs)  # (N, h, T_q, T_k)
 
-        # Weighted sum
-        outputs = torch.bmm(outputs, V_)  # (h*N, T_q, C/h)
+            # Weighted sum
+            outputs = torch.matmul(outputs, V_)  # (N, h, T_q, C/h)
 
         # Restore shape
-        outputs = torch.cat(torch.chunk(outputs, self.num_heads, dim=0), dim=2)  # (N, T_q, C)
+        outputs = outputs.transpose(1, 2).reshape(N, T, self.num_units)  # (N, T_q, C)
 
         # Residual connection
         outputs += mini_batch
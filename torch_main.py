@@ -4,9 +4,13 @@ import logging
 import random
 import ujson as json
 import pickle as pkl
+import time
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 # from torch_preprocess import run_prepare
 from torch_model import TCN
 from torch_utils import get_batch, compute_loss, evaluate_batch, FocalLoss
@@ -36,6 +40,12 @@ def parse_args():
     train_settings = parser.add_argument_group('train settings')
     train_settings.add_argument('--disable_cuda', action='store_true',
                                 help='Disable CUDA')
+    train_settings.add_argument('--distributed', action='store_true',
+                                help='data parallel training, one process per rank, launched with torchrun')
+    train_settings.add_argument('--dist_backend', default='gloo',
+                                help='torch.distributed backend')
+    train_settings.add_argument('--intra_threads', type=int, default=0,
+                                help='intra-op threads per process, 0 means cpu count / world size')
     train_settings.add_argument('--lr', type=float, default=5e-4,
                                 help='learning rate')
     train_settings.add_argument('--clip', type=float, default=-1,
@@ -110,12 +120,12 @@ def parse_args():
     return parser.parse_args()
 
 
-def train_one_epoch(model, optimizer, train_num, train_file, data_dim, args, logger):
+def train_one_epoch(model, optimizer, train_file, data_dim, args, logger):
     model.train()
     train_loss = []
     n_batch_loss = 0
     weight = torch.from_numpy(np.array([0.8, 0.2], dtype=np.float32)).to(args.device)
-    for batch_idx, batch in enumerate(range(0, train_num, args.batch_train)):
+    for batch_idx, batch in enumerate(range(0, len(train_file), args.batch_train)):
         start_idx = batch
         end_idx = start_idx + args.batch_train
         indexes, medicines, labels, seq_lens = get_batch(train_file[start_idx:end_idx], data_dim, args.device)
@@ -181,6 +191,14 @@ def train(args, file_paths):
     logger.info('Initialize the model...')
     model = TCN(input_size=dim[0]+dim[1], output_size=args.n_class, n_channel=[args.n_filter]*args.n_level,
                 n_kernel=args.n_kernel, dropout=args.dropout, logger=logger).to(device=args.device)
+    eval_model = model
+    sampler = None
+    if args.distributed:
+        # 每个进程只训练 DistributedSampler 划分给它的病人，梯度在 backward 中 all-reduce
+        model = DistributedDataParallel(model, device_ids=[args.device.index] if args.device.type == 'cuda' else None)
+        sampler = DistributedSampler(train_file, num_replicas=args.world_size, rank=args.rank)
+        logger.info('Data parallel training over {} processes, {} patients per process'.format(args.world_size,
+                                                                                             len(sampler)))
     lr = args.lr
     optimizer = getattr(optim, args.optim)(model.parameters(), lr=lr, weight_decay=args.weight_decay)
     # scheduler = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.9)
@@ -190,12 +208,36 @@ def train(args, file_paths):
     FALSE = []
     for ep in range(1, args.epochs + 1):
         logger.info('Training the model for epoch {}'.format(ep))
-        avg_loss = train_one_epoch(model, optimizer, train_num, train_file, dim, args, logger)
+        if sampler is not None:
+            sampler.set_epoch(ep)
+            epoch_file = [train_file[idx] for idx in sampler]
+        else:
+            epoch_file = train_file
+        start_t = time.time()
+        avg_loss = train_one_epoch(model, optimizer, epoch_file, dim, args, logger)
+        epoch_t = time.time() - start_t
+        if args.distributed:
+            avg_loss = torch.tensor([avg_loss], dtype=torch.float64)
+            dist.all_reduce(avg_loss)
+            avg_loss = avg_loss.item() / args.world_size
         logger.info('Epoch {} AvgLoss {}'.format(ep, avg_loss))
+        logger.info('Epoch {} train time {:.1f} s, {:.1f} samples/s over {} processes'.format(
+            ep, epoch_t, len(epoch_file) * args.world_size / epoch_t, args.world_size))
 
-        logger.info('Evaluating the model for epoch {}'.format(ep))
-        eval_metrics = evaluate_batch(model, eval_num, args.batch_eval, eval_file, dim, args.device, 'eval',
-                                      args.is_point, logger)
+        # 只在 rank 0 上评估，其余进程等待评估结果来更新学习率
+        dev_roc = torch.zeros(1, dtype=torch.float64)
+        if args.rank == 0:
+            logger.info('Evaluating the model for epoch {}'.format(ep))
+            eval_metrics = evaluate_batch(eval_model, eval_num, args.batch_eval, eval_file, dim, args.device, 'eval',
+                                          args.is_point, logger)
+            dev_roc[0] = eval_metrics['roc']
+        if args.distributed:
+            dist.broadcast(dev_roc, 0)
+        scheduler.step(metrics=dev_roc.item())
+        if sampler is None:
+            random.shuffle(train_file)
+        if args.rank != 0:
+            continue
         logger.info('Dev Loss: {}'.format(eval_metrics['loss']))
         logger.info('Dev Acc: {}'.format(eval_metrics['acc']))
         logger.info('Dev AUROC: {}'.format(eval_metrics['roc']))
@@ -210,9 +252,9 @@ def train(args, file_paths):
         if dev_sum > max_sum:
             max_sum = dev_sum
             max_epoch = ep
-        scheduler.step(metrics=eval_metrics['roc'])
-        random.shuffle(train_file)
 
+    if args.rank != 0:
+        return
     logger.info('Max Acc {}'.format(max_acc))
     logger.info('Max AUROC {}'.format(max_roc))
     logger.info('Max AUPRC {}'.format(max_prc))
@@ -247,9 +289,18 @@ def run():
     os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     torch.manual_seed(args.seed)
+    args.rank, args.world_size = 0, 1
+    if args.distributed:
+        # torchrun 通过环境变量传入 RANK / WORLD_SIZE / MASTER_ADDR / MASTER_PORT
+        dist.init_process_group(backend=args.dist_backend, init_method='env://')
+        args.rank, args.world_size = dist.get_rank(), dist.get_world_size()
+        if args.rank != 0:
+            logger.setLevel(logging.WARNING)
+    if args.intra_threads > 0 or args.distributed:
+        torch.set_num_threads(args.intra_threads or max(1, os.cpu_count() // args.world_size))
     args.device = None
     if torch.cuda.is_available() and not args.disable_cuda:
-        args.device = torch.device('cuda')
+        args.device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)) if args.distributed else 0)
     else:
         args.device = torch.device('cpu')
     logger.info('Preparing the directories...')
@@ -260,7 +311,7 @@ def run():
     args.summary_dir = args.summary_dir + args.task
     for dir_path in [args.raw_dir, args.preprocessed_dir, args.model_dir, args.result_dir, args.summary_dir]:
         if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
+            os.makedirs(dir_path, exist_ok=True)
 
     class FilePaths(object):
         def __init__(self):
@@ -273,14 +324,18 @@ def run():
             self.shape_meta = os.path.join(args.preprocessed_dir, 'shape_meta.pkl')
 
     file_paths = FilePaths()
-    if args.prepare:
+    if args.prepare and args.rank == 0:
         # max_seq_len, index_dim = run_prepare(args, file_paths)
         run_prepare(args)
         # with open(file_paths.shape_meta, 'wb') as fh:
         #     pkl.dump({'max_len': max_seq_len, 'dim': index_dim}, fh)
         # fh.close()
+    if args.distributed:
+        dist.barrier()
     if args.train:
         train(args, file_paths)
+    if args.distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
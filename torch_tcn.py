@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.utils import weight_norm
 from torch_attention import Multihead_Attention
 
@@ -17,23 +18,47 @@ class Chomp1d(nn.Module):
         return x[:, :, :-self.chomp_size].contiguous()
 
 
+class CausalConv1d(nn.Conv1d):
+    """
+    只在左侧补零的因果卷积
+    与 Conv1d(padding=p) + Chomp1d(p) 输出一致，但不计算右侧padding对应的输出，也没有chomp的拷贝
+    """
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1):
+        super(CausalConv1d, self).__init__(in_channels, out_channels, kernel_size, stride, 0, dilation)
+        self.left_padding = padding
+
+    def forward(self, x):
+        if self.left_padding > 0:
+            x = F.pad(x, (self.left_padding, 0))
+        return super(CausalConv1d, self).forward(x)
+
+
 class TemporalBlock(nn.Module):
-    def __init__(self, n_inputs, n_outputs, kernel_size, stride, dilation, padding, dropout=0.2):
+    def __init__(self, n_inputs, n_outputs, kernel_size, stride, dilation, padding, dropout=0.2, left_pad=True):
         super(TemporalBlock, self).__init__()
-        # 定义第一个扩散卷积层
-        self.conv1 = weight_norm(nn.Conv1d(n_inputs, n_outputs, kernel_size, stride, padding, dilation))
-        # 根据第一个卷积层的输出与padding大小实现因果卷积
-        self.chomp1 = Chomp1d(padding)
+        if left_pad:
+            # 左侧补零的因果卷积，无需chomp
+            self.conv1 = weight_norm(CausalConv1d(n_inputs, n_outputs, kernel_size, stride, padding, dilation))
+            self.conv2 = weight_norm(CausalConv1d(n_outputs, n_outputs, kernel_size, stride, padding, dilation))
+        else:
+            # 定义第一个扩散卷积层
+            self.conv1 = weight_norm(nn.Conv1d(n_inputs, n_outputs, kernel_size, stride, padding, dilation))
+            self.conv2 = weight_norm(nn.Conv1d(n_outputs, n_outputs, kernel_size, stride, padding, dilation))
         self.relu1 = nn.ReLU()
         # 在先前输出结果上添加激活函数与dropout 完成第一个卷积
         self.dropout1 = nn.Dropout2d(dropout)
-
-        self.conv2 = weight_norm(nn.Conv1d(n_outputs, n_outputs, kernel_size, stride, padding, dilation))
-        # padding保证了输入序列与输出序列的长度相等，但卷积前的通道数与卷积后的通道数不一定一样
-        self.chomp2 = Chomp1d(padding)
         self.relu2 = nn.ReLU()
         self.dropout2 = nn.Dropout2d(dropout)
 
+        if left_pad:
+            # chomp 的位置用 Identity 占位，net.* 的参数名与原实现一致，两种实现的 state_dict 可以互相严格加载
+            self.chomp1 = nn.Identity()
+            self.chomp2 = nn.Identity()
+        else:
+            # 根据卷积层的输出与padding大小实现因果卷积
+            # padding保证了输入序列与输出序列的长度相等，但卷积前的通道数与卷积后的通道数不一定一样
+            self.chomp1 = Chomp1d(padding)
+            self.chomp2 = Chomp1d(padding)
         # 将卷积模块的所有组件通过Sequential 方法依次堆叠
         self.net = nn.Sequential(self.conv1, self.chomp1, self.relu1, self.dropout1,
                                  self.conv2, self.chomp2, self.relu2, self.dropout2)
@@ -55,7 +80,7 @@ class TemporalBlock(nn.Module):
 
 
 class TemporalConvNet(nn.Module):
-    def __init__(self, num_inputs, num_channels, kernel_size=2, dropout=0.2):
+    def __init__(self, num_inputs, num_channels, kernel_size=2, dropout=0.2, left_pad=True):
         super(TemporalConvNet, self).__init__()
         layers = []
         # num_channels 为各层卷积的输出通道数或卷积核数量 长度即需要执行的卷积层数量
@@ -67,7 +92,8 @@ class TemporalConvNet(nn.Module):
             in_channels = num_inputs if i == 0 else num_channels[i - 1]
             out_channels = num_channels[i]
             layers += [TemporalBlock(in_channels, out_channels, kernel_size, stride=1, dilation=dilation_size,
-                                     padding=(kernel_size - 1) * dilation_size, dropout=dropout)]
+                                     padding=(kernel_size - 1) * dilation_size, dropout=dropout,
+                                     left_pad=left_pad)]
             # layers += [Multihead_Attention(out_channels, num_heads=1, dropout=dropout)]
 
         self.network = nn.Sequential(*layers)
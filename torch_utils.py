@@ -30,15 +30,8 @@ def get_batch(samples, dim, device):
 def _sequence_mask(sequence_length, max_len=None):
     if max_len is None:
         max_len = sequence_length.data.max()
-    batch_size = sequence_length.size(0)
-    seq_range = torch.arange(0, max_len).long()
-    seq_range_expand = seq_range.unsqueeze(0).expand(batch_size, max_len)
-    seq_range_expand = Variable(seq_range_expand)
-    if sequence_length.is_cuda:
-        seq_range_expand = seq_range_expand.cuda()
-    seq_length_expand = (sequence_length.unsqueeze(1).expand_as(seq_range_expand))
-
-    return seq_range_expand < seq_length_expand
+    seq_range = torch.arange(0, max_len, dtype=sequence_length.dtype, device=sequence_length.device)
+    return seq_range.unsqueeze(0) < sequence_length.unsqueeze(1)
 
 
 def compute_loss(logits, target, length):
@@ -75,62 +68,78 @@ def compute_loss(logits, target, length):
     return loss
 
 
-def evaluate_batch(model, data_num, batch_size, eval_file, dim, device, data_type, is_point, logger):
-    losses = []
-    pre_labels, pre_scores, ref = [], [], []
-    fp = []
-    fn = []
-    metrics = {}
-    pre_points = {3: [], 18: [], 36: [], 72: [], 144: [], 216: []}
-    ref_points = {3: [], 18: [], 36: [], 72: [], 144: [], 216: []}
-    model.eval()
-    for batch_idx, batch in enumerate(range(0, data_num, batch_size)):
-        start_idx = batch
-        end_idx = start_idx + batch_size
-        indexes, medicines, labels, seq_lens = get_batch(eval_file[start_idx:end_idx], dim, device)
-        outputs = model(indexes, medicines)
-        outputs = outputs.detach()
-        loss = compute_loss(logits=outputs, target=labels, length=seq_lens).item()
-        losses.append(loss)
-        output_labels = torch.max(outputs.cpu(), 2)[1].numpy()
-        output_scores = outputs.cpu()[:, :, 1].numpy()
-        labels = labels.cpu().numpy()
-        seq_lens = seq_lens.cpu().numpy()
-
-        for pre_label, pre_score, label, seq_len in zip(output_labels, output_scores, labels, seq_lens):
-            if is_point:
-                pre_labels.append(pre_label[seq_len - 1])
-                ref.append(label[seq_len - 1])
-            else:
-                pre_labels += pre_label[:seq_len].tolist()
-                pre_scores += pre_score[:seq_len].tolist()
-                ref += label[:seq_len].tolist()
+HOURS = [3, 18, 36, 72, 144, 216]
 
-            # if data_type == 'dev':
-            #     if sample['label'] == 1 and final_pre_label == 0:
-            #         fp.append(sample['name'])
-            #     if sample['label'] == 0 and final_pre_label == 1:
-            #         fn.append(sample['name'])
-            for k, v in pre_points.items():
-                if seq_len >= k:
-                    v.append(pre_label[k - 1])
-                    ref_points[k].append(label[k - 1])
 
-    metrics['loss'] = np.mean(losses)
-    metrics['acc'] = accuracy_score(ref, pre_labels)
-    metrics['roc'] = roc_auc_score(ref, pre_scores)
-    (precisions, recalls, thresholds) = precision_recall_curve(ref, pre_scores)
+def _collect_batch(outputs, labels, seq_lens, is_point, hours):
+    """
+    Selects the valid steps and the hour points of a batch with masked tensor ops on the model's device.
+    Returns (labels, scores, refs) of the valid steps and (labels, scores, refs, valid) of shape [batch, n_hours].
+    """
+    max_len = outputs.size(1)
+    pre_scores = functional.softmax(outputs, dim=-1)[:, :, 1]
+    pre_labels = torch.max(outputs, 2)[1]
+    if is_point:
+        last = (seq_lens - 1).unsqueeze(1)
+        steps = (pre_labels.gather(1, last).squeeze(1), pre_scores.gather(1, last).squeeze(1),
+                 labels.gather(1, last).squeeze(1))
+    else:
+        mask = _sequence_mask(seq_lens, max_len)
+        steps = (pre_labels[mask], pre_scores[mask], labels[mask])
+    # 长度不足的病人在该时间点无效，下标截断只是为了避免越界
+    point_idx = (hours - 1).clamp(max=max_len - 1)
+    valid = seq_lens.unsqueeze(1) >= hours.unsqueeze(0)
+    points = (pre_labels[:, point_idx], pre_scores[:, point_idx], labels[:, point_idx], valid)
+    return steps, points
+
+
+def cal_metrics(ref, pred_scores, pred_labels):
+    metrics = {}
+    metrics['acc'] = accuracy_score(ref, pred_labels)
+    metrics['roc'] = roc_auc_score(ref, pred_scores)
+    (precisions, recalls, thresholds) = precision_recall_curve(ref, pred_scores)
     metrics['prc'] = auc(recalls, precisions)
-    metrics['pse'] = np.max([min(x, y) for (x, y) in zip(precisions, recalls)])
+    metrics['pse'] = np.max(np.minimum(precisions, recalls))
+    return metrics
+
+
+def evaluate(model, batches, device, data_type, is_point, logger):
+    """
+    Runs the model over batches of (indexes, medicines, labels, seq_lens) and computes all metrics once at the end.
+    """
+    losses, steps, points = [], [], []
+    hours = torch.tensor(HOURS, dtype=torch.long, device=device)
+    model.eval()
+    with torch.no_grad():
+        for batch in batches:
+            indexes, medicines, labels, seq_lens = tuple(map(lambda x: x.to(device), batch))
+            outputs = model(indexes, medicines)
+            losses.append(compute_loss(logits=outputs, target=labels, length=seq_lens))
+            batch_steps, batch_points = _collect_batch(outputs, labels, seq_lens, is_point, hours)
+            steps.append(batch_steps)
+            points.append(batch_points)
+
+    pre_labels, pre_scores, ref = [torch.cat(t).cpu().numpy() for t in zip(*steps)]
+    point_labels, point_scores, point_ref, point_valid = [torch.cat(t).cpu().numpy() for t in zip(*points)]
+    metrics = cal_metrics(ref, pre_scores, pre_labels)
+    metrics['loss'] = torch.stack(losses).mean().item()
     if data_type == 'eval':
-        metrics['fp'] = fp
-        metrics['fn'] = fn
-    for k, v in pre_points.items():
-        logger.info('{} hour confusion matrix. AUCROC : {}'.format(int(k / 3), roc_auc_score(ref_points[k], v)))
-        logger.info(confusion_matrix(ref_points[k], v))
+        metrics['fp'] = []
+        metrics['fn'] = []
+    for i, k in enumerate(HOURS):
+        valid = point_valid[:, i]
+        logger.info('{} hour confusion matrix. AUCROC : {}'.format(
+            int(k / 3), roc_auc_score(point_ref[valid, i], point_scores[valid, i])))
+        logger.info(confusion_matrix(point_ref[valid, i], point_labels[valid, i]))
     logger.info('Full confusion matrix')
     logger.info(confusion_matrix(ref, pre_labels))
     return metrics
+
+
+def evaluate_batch(model, data_num, batch_size, eval_file, dim, device, data_type, is_point, logger):
+    batches = (get_batch(eval_file[start_idx:start_idx + batch_size], dim, device)
+               for start_idx in range(0, data_num, batch_size))
+    return evaluate(model, batches, device, data_type, is_point, logger)
     # tn, fp, fn, tp = confusion_matrix(auc_ref, auc_pre).ravel()
     # loss_sum = tf.Summary(value=[tf.Summary.Value(tag='{}/loss'.format(data_type), simple_value=metrics['loss']), ])
     # acc_sum = tf.Summary(value=[tf.Summary.Value(tag='{}/acc'.format(data_type), simple_value=metrics['acc']), ])
@@ -171,58 +180,7 @@ def train_one_epoch(model, optimizer, loader, args, logger):
 
 
 def evaluate_one_epoch(model, loader, device, data_type, is_point, logger):
-    losses = []
-    pre_labels, pre_scores, ref = [], [], []
-    fp = []
-    fn = []
-    metrics = {}
-    pre_points = {3: [], 18: [], 36: [], 72: [], 144: [], 216: []}
-    ref_points = {3: [], 18: [], 36: [], 72: [], 144: [], 216: []}
-    model.eval()
-    weight = torch.from_numpy(np.array([0.5, 0.5], dtype=np.float32)).to(device)
-    for step, batch in enumerate(loader):
-        indexes, medicines, labels, seq_lens = tuple(map(lambda x: x.to(device), batch))
-        outputs = model(indexes, medicines)
-        outputs = outputs.detach()
-        loss = compute_loss(logits=outputs, target=labels, length=seq_lens).item()
-        # criterion = torch.nn.CrossEntropyLoss()
-        # loss = criterion(outputs.view(-1, 2), labels.view(-1)).item()
-        losses.append(loss)
-        output_labels = torch.max(outputs.cpu(), 2)[1].numpy()
-        output_scores = functional.softmax(outputs).cpu()[:, :, 1].numpy()
-        # output_scores = outputs.cpu()[:, :, 1].numpy()
-        labels = labels.cpu().numpy()
-        seq_lens = seq_lens.cpu().numpy()
-
-        for pre_label, pre_score, label, seq_len in zip(output_labels, output_scores, labels, seq_lens):
-            if is_point:
-                pre_labels.append(pre_label[seq_len - 1])
-                ref.append(label[seq_len - 1])
-            else:
-                pre_labels += pre_label[:seq_len].tolist()
-                pre_scores += pre_score[:seq_len].tolist()
-                ref += label[:seq_len].tolist()
-
-            for k, v in pre_points.items():
-                if seq_len >= k:
-                    v.append(pre_label[k - 1])
-                    ref_points[k].append(label[k - 1])
-
-    metrics['loss'] = np.mean(losses)
-    metrics['acc'] = accuracy_score(ref, pre_labels)
-    metrics['roc'] = roc_auc_score(ref, pre_scores)
-    (precisions, recalls, thresholds) = precision_recall_curve(ref, pre_scores)
-    metrics['prc'] = auc(recalls, precisions)
-    metrics['pse'] = np.max([min(x, y) for (x, y) in zip(precisions, recalls)])
-    if data_type == 'eval':
-        metrics['fp'] = fp
-        metrics['fn'] = fn
-    for k, v in pre_points.items():
-        logger.info('{} hour confusion matrix. AUCROC : {}'.format(int(k / 3), roc_auc_score(ref_points[k], v)))
-        logger.info(confusion_matrix(ref_points[k], v))
-    logger.info('Full confusion matrix')
-    logger.info(confusion_matrix(ref, pre_labels))
-    return metrics
+    return evaluate(model, loader, device, data_type, is_point, logger)
 
 
 class FocalLoss(torch.nn.Module):